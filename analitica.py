@@ -0,0 +1,140 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from sqlalchemy import BigInteger, case, cast, func, or_, select
+
+from models import EstadoTurno, Turno
+from estadisticas import epoch_sql, inicio_espera_sql
+
+DIAS_SEMANA = ['lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo']
+CELDAS = 7 * 24
+SEGUNDOS_DIA = 86400
+# Límites (en minutos) del histograma de tiempos de espera
+LIMITES_ESPERA_MIN = [0, 5, 10, 15, 30, 45, 60, 90, 120, np.inf]
+
+CODIGO_ESTADO = {
+    EstadoTurno.PENDIENTE: 0,
+    EstadoTurno.LLAMADO: 1,
+    EstadoTurno.ATENDIDO: 2,
+    EstadoTurno.CANCELADO: 3,
+}
+
+
+# Cada turno viaja como un solo entero de 64 bits para evitar crear millones
+# de objetos Python: minuto de la cita | espera en segundos + 1 | estado
+BITS_ESTADO = 2
+BITS_ESPERA = 21
+MAX_ESPERA_SEG = 2 ** BITS_ESPERA - 2
+
+
+def _leer_columnas(conn, desde, hasta, servicio_id):
+    """Trae en bloque los datos mínimos de cada turno, empaquetados y numéricos.
+
+    Devuelve arreglos de NumPy: epoch de la cita (segundos), espera en
+    segundos (-1 si no fue llamado) y código de estado.
+    """
+    t = Turno.__table__
+    dialecto = conn.dialect.name
+
+    inicio = datetime.combine(desde, time.min)
+    fin = datetime.combine(hasta + timedelta(days=1), time.min)
+
+    # Hora local de la cita; la espera se mide en UTC (ver inicio_espera)
+    minuto_cita = cast(func.round(epoch_sql(t.c.fecha_cita, dialecto) / 60), BigInteger)
+    espera = cast(
+        epoch_sql(t.c.tiempo_llamado, dialecto) - inicio_espera_sql(t, dialecto, inicio, fin), BigInteger
+    )
+    espera_acotada = case(
+        (or_(t.c.tiempo_llamado.is_(None), t.c.fecha_creacion.is_(None)), 0),
+        (espera < 0, 1),
+        (espera > MAX_ESPERA_SEG, MAX_ESPERA_SEG + 1),
+        else_=espera + 1
+    )
+    codigo_estado = case(
+        *((t.c.estado == estado, codigo) for estado, codigo in CODIGO_ESTADO.items()),
+        else_=CODIGO_ESTADO[EstadoTurno.PENDIENTE]
+    )
+    empaquetado = (
+        minuto_cita * 2 ** (BITS_ESPERA + BITS_ESTADO)
+        + espera_acotada * 2 ** BITS_ESTADO
+        + codigo_estado
+    )
+
+    consulta = select(empaquetado).where(t.c.fecha_cita >= inicio, t.c.fecha_cita < fin)
+    if servicio_id:
+        consulta = consulta.where(t.c.servicio_id == servicio_id)
+
+    # Se lee directo del cursor del driver: el procesamiento de filas de
+    # SQLAlchemy cuesta más que la consulta misma con cientos de miles de turnos
+    filas = conn.execute(consulta).cursor.fetchall()
+    datos = np.fromiter((fila[0] for fila in filas), dtype=np.int64, count=len(filas))
+
+    estado = datos & (2 ** BITS_ESTADO - 1)
+    espera_seg = ((datos >> BITS_ESTADO) & (2 ** BITS_ESPERA - 1)).astype(np.float64) - 1
+    cita = (datos >> (BITS_ESPERA + BITS_ESTADO)).astype(np.float64) * 60
+    return cita, espera_seg, estado
+
+
+def _matriz(valores, decimales=None):
+    matriz = valores.reshape(7, 24)
+    if decimales is None:
+        return matriz.astype(np.int64).tolist()
+    redondeada = np.round(matriz, decimales)
+    return [[None if np.isnan(v) else float(v) for v in fila] for fila in redondeada]
+
+
+def calcular_heatmap(conn, desde, hasta, servicio_id=None, hoy=None):
+    """Matrices día de semana x hora de llegadas, esperas y ausencias.
+
+    Las llegadas se ubican por ``fecha_cita``; la espera va del alta (o de
+    la hora de la cita, si se reservó antes) a ``tiempo_llamado``, como en
+    los acumulados de ``estadisticas``. Se cuentan como ausencias los turnos
+    cancelados y los que quedaron pendientes en días ya pasados.
+    """
+    hoy = hoy or datetime.now().date()
+    cita, espera, estado = _leer_columnas(conn, desde, hasta, servicio_id)
+
+    dias = np.floor(cita / SEGUNDOS_DIA).astype(np.int64)
+    # 1970-01-01 fue jueves: desplazar para que el lunes sea 0
+    dia_semana = (dias + 3) % 7
+    hora = ((cita - dias * SEGUNDOS_DIA) // 3600).astype(np.int64)
+    celda = dia_semana * 24 + hora
+
+    llegadas = np.bincount(celda, minlength=CELDAS)
+
+    con_espera = espera >= 0
+    suma_espera = np.bincount(celda[con_espera], weights=espera[con_espera], minlength=CELDAS)
+    cantidad_espera = np.bincount(celda[con_espera], minlength=CELDAS)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        espera_promedio = suma_espera / cantidad_espera / 60
+
+    dia_hoy = (hoy - datetime(1970, 1, 1).date()).days
+    ausente = (estado == CODIGO_ESTADO[EstadoTurno.CANCELADO]) | (
+        (estado == CODIGO_ESTADO[EstadoTurno.PENDIENTE]) & (dias < dia_hoy)
+    )
+    ausencias = np.bincount(celda[ausente], minlength=CELDAS)
+
+    # Cuántas veces aparece cada día de la semana en el rango, para promediar
+    rango = np.arange(np.datetime64(desde), np.datetime64(hasta + timedelta(days=1)))
+    ocurrencias = np.bincount((rango.astype(np.int64) + 3) % 7, minlength=7)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        llegadas_promedio = llegadas.reshape(7, 24) / ocurrencias[:, None]
+
+    histograma, _ = np.histogram(espera[con_espera] / 60, bins=LIMITES_ESPERA_MIN)
+
+    return {
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'servicio_id': servicio_id,
+        'total_turnos': int(cita.size),
+        'dias': DIAS_SEMANA,
+        'horas': list(range(24)),
+        'llegadas': _matriz(llegadas),
+        'llegadas_promedio': _matriz(llegadas_promedio.ravel(), 2),
+        'espera_promedio_min': _matriz(espera_promedio, 1),
+        'ausencias': _matriz(ausencias),
+        'histograma_espera': {
+            'limites_min': [float(v) if np.isfinite(v) else None for v in LIMITES_ESPERA_MIN],
+            'conteos': histograma.tolist()
+        }
+    }
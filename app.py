@@ -1,8 +1,10 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request, g
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import time
+import click
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,13 +17,82 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', f'sqlite:///{o
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'jwt-clave-secreta')
 
+# Logs JSON escritos en segundo plano con id por petición (REGISTRO_NIVEL, REGISTRO_FORMATO)
+from registro import configurar_registro
+configurar_registro(app)
+
+# Tamaño máximo de los logos subidos (bytes); el margen cubre la envoltura multipart
+app.config['MAX_LOGO_BYTES'] = int(os.getenv('MAX_LOGO_BYTES', 2 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_LOGO_BYTES'] + 64 * 1024
+
+# Horas de validez extra de los QR después del día de la cita
+app.config['QR_TOKEN_GRACIA_HORAS'] = int(os.getenv('QR_TOKEN_GRACIA_HORAS', 0))
+
+# Cada cuántos segundos se compara la cola en memoria con la base
+app.config['COLA_RECONCILIACION_SEGUNDOS'] = int(os.getenv('COLA_RECONCILIACION_SEGUNDOS', 10))
+
+# Turnos sin cita en la cola: 'por_hora' (entre las citas) o 'citas_primero'
+app.config['COLA_POLITICA_SIN_CITA'] = os.getenv('COLA_POLITICA_SIN_CITA', 'por_hora')
+
+# Vigencia de la instantánea de /api/tablero compartida por todas las TVs
+app.config['TABLERO_TTL_SEGUNDOS'] = float(os.getenv('TABLERO_TTL_SEGUNDOS', 1))
+
+# Una base de datos por sucursal (SUCURSALES=centro,norte)
+from sucursales import configurar_sucursales, SucursalMiddleware, en_sucursal, CLAVE_ENTORNO
+configurar_sucursales(app)
+app.wsgi_app = SucursalMiddleware(
+    app.wsgi_app, app.config['SUCURSALES'], app.config['SUCURSALES_POR_SUBDOMINIO']
+)
+
+# Perfilado de peticiones a pedido (PERFIL_TOKEN, PERFIL_MUESTREO)
+from perfilador import configurar_perfilador, PerfiladorMiddleware
+configurar_perfilador(app)
+app.wsgi_app = PerfiladorMiddleware(app.wsgi_app, app.config)
+
+# Captura de tráfico para `flask replay` (CAPTURA_HABILITADA, CAPTURA_MUESTREO)
+from captura import configurar_captura, CapturaMiddleware
+configurar_captura(app)
+app.wsgi_app = CapturaMiddleware(app.wsgi_app, app.config)
+
+# Detrás de un proxy inverso: cuántos saltos de X-Forwarded-* son de confianza
+# (0 = ninguno). Sin esto todos los clientes comparten la IP del proxy y su
+# cubeta de límites de solicitudes.
+from werkzeug.middleware.proxy_fix import ProxyFix
+app.config['PROXY_SALTOS'] = int(os.getenv('PROXY_SALTOS', 0))
+if app.config['PROXY_SALTOS']:
+    saltos = app.config['PROXY_SALTOS']
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=saltos, x_proto=saltos, x_host=saltos)
+
+# Réplicas de lectura opcionales (DATABASE_URL_REPLICA, DATABASE_URL_REPLICA_<CODIGO>)
+from replicas import configurar_replicas, snapshot_sqlite
+configurar_replicas(app)
+
 # Importar modelos y configurar db
-from models import db, Turno, Servicio, Configuracion, Cola, EstadoTurno, TipoRegistro
+from models import db, Turno, Servicio, Configuracion, Cola, Ventanilla, Cambio, EstadoTurno, TipoRegistro
+from migraciones import aplicar_migraciones
+from cola_memoria import cola_memoria, configurar_reconciliacion
 db.init_app(app)
+configurar_reconciliacion(app.config['COLA_RECONCILIACION_SEGUNDOS'])
+
+import cola_diaria
+if app.config['COLA_POLITICA_SIN_CITA'] not in cola_diaria.POLITICAS_SIN_CITA:
+    raise ValueError(f"COLA_POLITICA_SIN_CITA debe ser una de: {', '.join(cola_diaria.POLITICAS_SIN_CITA)}")
+
+# Avisos por teléfono a los clientes (NOTIFICACIONES_TRANSPORTE, NOTIFICACIONES_AVISO_LUGARES)
+from notificaciones import configurar_notificaciones, despachador
+configurar_notificaciones(app)
 
 cors = CORS(app)
 jwt = JWTManager(app)
 
+@app.before_request
+def identificar_sucursal():
+    g.sucursal = request.environ.get(CLAVE_ENTORNO)
+
+# Límite de solicitudes de kioscos, compartido entre workers (LIMITES_DB)
+from limites import configurar_limites
+configurar_limites(app)
+
 # Ruta para el frontend
 @app.route('/')
 def index():
@@ -30,17 +101,183 @@ def index():
 # Importar modelos y rutas después de configurar la app
 from routes import *
 
-if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        # Crear configuración por defecto si no existe
-        config = Configuracion.query.first()
-        if not config:
-            config_default = Configuracion(
-                nombre_empresa="Mi Empresa",
-                logo_url="static/img/logo-default.png"
+def inicializar_base():
+    """Aplica migraciones y crea la configuración por defecto si no existe"""
+    aplicar_migraciones(db.session.get_bind())
+    config = Configuracion.query.first()
+    if not config:
+        config_default = Configuracion(
+            nombre_empresa="Mi Empresa",
+            logo_url="static/img/logo-default.png"
+        )
+        db.session.add(config_default)
+        db.session.commit()
+
+@app.cli.command('migrar')
+def migrar():
+    """Crea las tablas y aplica las migraciones pendientes en todas las sucursales"""
+    inicializar_base()
+    for codigo in app.config['SUCURSALES']:
+        with en_sucursal(codigo):
+            inicializar_base()
+    print('Migraciones aplicadas')
+
+@app.cli.command('recalcular-estadisticas')
+def recalcular_estadisticas():
+    """Reconstruye la tabla de acumulados diarios desde los turnos"""
+    import estadisticas
+    for codigo in [None] + app.config['SUCURSALES']:
+        with en_sucursal(codigo):
+            estadisticas.recalcular(db.session.connection())
+            db.session.commit()
+    print('Estadísticas recalculadas')
+
+@app.cli.command('podar-cambios')
+@click.option('--dias', type=int, default=7, help='Conservar los cambios de los últimos N días')
+def podar_cambios(dias):
+    """Borra del registro de cambios lo que ningún cliente debería necesitar"""
+    limite = datetime.utcnow() - timedelta(days=dias)
+    for codigo in [None] + app.config['SUCURSALES']:
+        with en_sucursal(codigo):
+            # Se conserva siempre el último para no perder la versión actual
+            ultimo = db.session.query(db.func.max(Cambio.id)).scalar() or 0
+            borrados = Cambio.query.filter(
+                Cambio.fecha < limite, Cambio.id < ultimo
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            print(f'{codigo or "principal"}: {borrados} cambios borrados')
+
+@app.cli.command('generar-horarios')
+@click.option('--dias', type=int, default=30, help='Días a generar desde hoy')
+def generar_horarios(dias):
+    """Genera por adelantado los horarios de citas (tabla slots)"""
+    import horarios
+    for codigo in [None] + app.config['SUCURSALES']:
+        with en_sucursal(codigo):
+            creados = horarios.generar(
+                db.session.connection(), Configuracion.query.first(), datetime.now().date(), dias
             )
-            db.session.add(config_default)
             db.session.commit()
+            print(f'{codigo or "principal"}: {creados} horarios creados')
+
+@app.cli.command('enviar-notificaciones')
+def enviar_notificaciones():
+    """Envía ahora las notificaciones pendientes, sin esperar al hilo de fondo"""
+    print(f'{despachador.procesar_pendientes()} notificaciones procesadas')
+
+@app.cli.command('benchmark-qr')
+@click.option('--repeticiones', type=int, default=200)
+def benchmark_qr(repeticiones):
+    """Compara tamaño y tiempo de generación de los formatos de QR"""
+    import base64
+    import io
+    import qrcode
+    from imagenes_qr import imagen_qr, matriz_qr, png_qr, svg_qr, TAMANOS
+
+    tokens = [f'AQAAB{n:05d}NZABnVhYw.c2lnbmF0dXJlMTIz' for n in range(repeticiones)]
+
+    def anterior(datos):
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(datos)
+        qr.make(fit=True)
+        buffer = io.BytesIO()
+        qr.make_image(fill_color="black", back_color="white").save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def medir(generar):
+        inicio = time.perf_counter()
+        for token in tokens:
+            contenido = generar(token)
+        return contenido, (time.perf_counter() - inicio) * 1000 / repeticiones
+
+    print(f"{'formato':<20}{'bytes':>8}{'base64':>8}{'ms/QR':>8}{'en caché':>10}")
+    contenido, ms = medir(anterior)
+    print(f"{'anterior':<20}{len(contenido):>8}{len(base64.b64encode(contenido)):>8}{ms:>8.2f}{'-':>10}")
+    for formato, generador in (('png', png_qr), ('svg', svg_qr)):
+        for tamano, medidas in TAMANOS.items():
+            contenido, ms = medir(lambda datos: generador(
+                matriz_qr.__wrapped__(datos), medidas['modulo'], medidas['margen']
+            ))
+            for token in tokens:
+                imagen_qr(token, formato, tamano)
+            _, ms_cache = medir(lambda datos: imagen_qr(datos, formato, tamano))
+            print(f'{formato + " " + tamano:<20}{len(contenido):>8}'
+                  f'{len(base64.b64encode(contenido)):>8}{ms:>8.2f}{ms_cache:>10.3f}')
+
+@app.cli.command('replay')
+@click.argument('archivos', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--url', default='http://127.0.0.1:5000', help='Instancia contra la que se reproduce')
+@click.option('--velocidad', type=float, default=1.0, help='1 = tiempo real, 10 = diez veces más rápido, 0 = sin esperas')
+@click.option('--concurrencia', type=int, default=16, help='Peticiones simultáneas como máximo')
+@click.option('--mover-fechas/--fechas-originales', default=True, help='Llevar las fechas de la captura a hoy')
+@click.option('--reporte', type=click.Path(dir_okay=False), help='Guardar el resumen en JSON')
+@click.option('--comparar', type=click.Path(exists=True, dir_okay=False), help='Reporte JSON de otra versión')
+def replay(archivos, url, velocidad, concurrencia, mover_fechas, reporte, comparar):
+    """Reproduce tráfico capturado y muestra la latencia por ruta"""
+    import json
+    from captura import cargar_trazas, reproducir, resumen_latencias
+
+    registros = cargar_trazas(archivos)
+    print(f'Reproduciendo {len(registros)} peticiones contra {url}')
+    inicio = time.perf_counter()
+    resumen = resumen_latencias(reproducir(registros, url, velocidad, concurrencia, mover_fechas))
+    print(f'Terminado en {time.perf_counter() - inicio:.1f} s')
+
+    anterior = {}
+    if comparar:
+        with open(comparar) as archivo:
+            anterior = json.load(archivo)
+    print(f"{'ruta':<44}{'n':>6}{'err':>5}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}" + (f"{'Δp50':>9}{'Δp99':>9}" if anterior else ''))
+    for ruta, datos in resumen.items():
+        linea = f"{ruta:<44}{datos['cantidad']:>6}{datos['errores']:>5}{datos['p50']:>9.1f}{datos['p90']:>9.1f}{datos['p99']:>9.1f}{datos['max']:>9.1f}"
+        if ruta in anterior:
+            linea += f"{datos['p50'] - anterior[ruta]['p50']:>+9.1f}{datos['p99'] - anterior[ruta]['p99']:>+9.1f}"
+        print(linea)
+    if reporte:
+        with open(reporte, 'w') as archivo:
+            json.dump(resumen, archivo, indent=2)
+
+@app.cli.command('materializar-cola')
+@click.option('--fecha', type=click.DateTime(formats=['%Y-%m-%d']), help='Día a materializar (por defecto hoy)')
+def materializar_cola(fecha):
+    """Vuelca a la cola las citas del día; para correr al cambiar de día"""
+    fecha = fecha.date() if fecha else datetime.now().date()
+    for codigo in [None] + app.config['SUCURSALES']:
+        with en_sucursal(codigo):
+            agregados = cola_diaria.materializar(db.session, fecha)
+            db.session.commit()
+            if agregados is None:
+                print(f'{codigo or "principal"}: {fecha} ya estaba materializado')
+            else:
+                print(f'{codigo or "principal"}: {agregados} turnos agregados a la cola del {fecha}')
+
+@app.cli.command('snapshot-replica')
+@click.option('--intervalo', type=int, default=0, help='Repetir cada N segundos (0 = una sola vez)')
+def snapshot_replica(intervalo):
+    """Copia cada base SQLite principal sobre su réplica SQLite"""
+    while True:
+        for codigo, nombre in app.config['REPLICAS'].items():
+            with en_sucursal(codigo):
+                principal = db.session.get_bind()
+            replica = db.engines[nombre]
+            if principal.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+                continue
+            snapshot_sqlite(principal.url.database, replica.url.database)
+            print(f'Réplica {nombre} actualizada')
+        if not intervalo:
+            break
+        time.sleep(intervalo)
+
+if __name__ == '__main__':
+    with app.app_context():
+        inicializar_base()
+        # Volcar las citas de hoy a la cola y precargarla en memoria
+        cola_diaria.asegurar(datetime.now().date())
+        cola_memoria.cargar()
+        for codigo in app.config['SUCURSALES']:
+            with en_sucursal(codigo):
+                inicializar_base()
+                cola_diaria.asegurar(datetime.now().date())
+                cola_memoria.cargar()
     
     app.run(debug=True, host='0.0.0.0', port=8080)
@@ -0,0 +1,145 @@
+import re
+
+from sqlalchemy import text
+
+# Peso de cada columna en el ranking (bm25 de FTS5): un número de turno o
+# un teléfono que coincide pesan más que un nombre
+PESOS_FTS = (1.0, 4.0, 8.0)  # nombre_cliente, telefono, numero_turno
+# Coincidencias más recientes que se ordenan por relevancia
+VENTANA_RANKING = 500
+SEPARADORES_TELEFONO = (' ', '-', '.', '(', ')', '+', '/')
+PALABRA = re.compile(r'\w+', re.UNICODE)
+EXPRESION_PG = (
+    "turnos_unaccent(lower(nombre_cliente || ' ' || coalesce(telefono, '') || ' ' "
+    "|| regexp_replace(coalesce(telefono, ''), '[^0-9]', '', 'g') || ' ' || numero_turno))"
+)
+
+
+def _solo_digitos(columna):
+    """SQL que quita de un teléfono los separadores habituales"""
+    expresion = f"coalesce({columna}, '')"
+    for separador in SEPARADORES_TELEFONO:
+        expresion = f"replace({expresion}, '{separador}', '')"
+    return expresion
+
+
+def _crear_indice_sqlite(conn):
+    existe = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'turnos_fts'"
+    )).first()
+    if existe:
+        return
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE turnos_fts USING fts5("
+        "nombre_cliente, telefono, numero_turno, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ))
+    valores_nuevos = f"new.id, new.nombre_cliente, {_solo_digitos('new.telefono')}, new.numero_turno"
+    conn.execute(text(f'''
+        CREATE TRIGGER turnos_fts_alta AFTER INSERT ON turnos BEGIN
+            INSERT INTO turnos_fts (rowid, nombre_cliente, telefono, numero_turno)
+            VALUES ({valores_nuevos});
+        END
+    '''))
+    conn.execute(text('''
+        CREATE TRIGGER turnos_fts_baja AFTER DELETE ON turnos BEGIN
+            DELETE FROM turnos_fts WHERE rowid = old.id;
+        END
+    '''))
+    conn.execute(text(f'''
+        CREATE TRIGGER turnos_fts_cambio
+        AFTER UPDATE OF nombre_cliente, telefono, numero_turno ON turnos BEGIN
+            DELETE FROM turnos_fts WHERE rowid = old.id;
+            INSERT INTO turnos_fts (rowid, nombre_cliente, telefono, numero_turno)
+            VALUES ({valores_nuevos});
+        END
+    '''))
+    conn.execute(text(f'''
+        INSERT INTO turnos_fts (rowid, nombre_cliente, telefono, numero_turno)
+        SELECT id, nombre_cliente, {_solo_digitos('telefono')}, numero_turno FROM turnos
+    '''))
+
+
+def _crear_indice_postgres(conn):
+    conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    conn.execute(text('CREATE EXTENSION IF NOT EXISTS unaccent'))
+    # unaccent() no es IMMUTABLE y no se puede indexar directamente
+    conn.execute(text('''
+        CREATE OR REPLACE FUNCTION turnos_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT public.unaccent('public.unaccent', $1) $$
+    '''))
+    conn.execute(text(
+        f'CREATE INDEX IF NOT EXISTS ix_turnos_busqueda_trgm ON turnos '
+        f'USING gin ({EXPRESION_PG} gin_trgm_ops)'
+    ))
+
+
+def crear_indice(conn):
+    """Índice de búsqueda de turnos por nombre, teléfono y número.
+
+    SQLite: tabla FTS5 sin acentos, con prefijos indexados y triggers que la
+    mantienen al día. Postgres: índice GIN de trigramas (pg_trgm) sobre el
+    texto sin acentos. Otros motores buscan con LIKE, sin índice.
+    """
+    if conn.dialect.name == 'sqlite':
+        _crear_indice_sqlite(conn)
+    elif conn.dialect.name == 'postgresql':
+        _crear_indice_postgres(conn)
+
+
+def consulta_fts(q):
+    """Convierte lo que escribió el usuario en una consulta FTS5 de prefijos.
+
+    Todas las palabras deben coincidir; si el texto parece un teléfono
+    (solo dígitos y separadores) también se busca con los dígitos juntos.
+    """
+    palabras = PALABRA.findall(q)
+    if not palabras:
+        return None
+    consulta = ' '.join(f'"{palabra}"*' for palabra in palabras)
+    digitos = ''.join(c for c in q if c.isdigit())
+    if len(palabras) > 1 and digitos and all(c.isdigit() or c in SEPARADORES_TELEFONO for c in q.strip()):
+        consulta = f'({consulta}) OR "{digitos}"*'
+    return consulta
+
+
+def buscar_ids(conn, q, limite, desplazamiento=0):
+    """Ids de turnos que coinciden con ``q``, del más relevante al menos"""
+    dialecto = conn.dialect.name
+    parametros = {'limite': limite, 'desplazamiento': desplazamiento}
+
+    if dialecto == 'sqlite':
+        consulta = consulta_fts(q)
+        if consulta is None:
+            return []
+        parametros['q'] = consulta
+        parametros['ventana'] = max(VENTANA_RANKING, desplazamiento + limite)
+        # FTS5 recorre los rowid en orden y corta en la ventana: solo se
+        # puntúan las coincidencias más recientes, no las miles de un prefijo corto
+        filas = conn.execute(text(
+            'SELECT id FROM ('
+            f'  SELECT rowid AS id, bm25(turnos_fts, {", ".join(map(str, PESOS_FTS))}) AS puntaje'
+            '  FROM turnos_fts WHERE turnos_fts MATCH :q ORDER BY rowid DESC LIMIT :ventana'
+            ') ORDER BY puntaje, id DESC LIMIT :limite OFFSET :desplazamiento'
+        ), parametros)
+        return [fila[0] for fila in filas]
+
+    palabras = [palabra.lower() for palabra in PALABRA.findall(q)]
+    if not palabras:
+        return []
+    if dialecto == 'postgresql':
+        expresion = EXPRESION_PG
+        condiciones = [f"{expresion} LIKE '%' || turnos_unaccent(:p{i}) || '%'" for i in range(len(palabras))]
+        orden = f'similarity({expresion}, turnos_unaccent(:q)) DESC, id DESC'
+    else:
+        expresion = "lower(nombre_cliente || ' ' || coalesce(telefono, '') || ' ' || numero_turno)"
+        condiciones = [f"{expresion} LIKE '%' || :p{i} || '%'" for i in range(len(palabras))]
+        orden = 'id DESC'
+    parametros.update({f'p{i}': palabra for i, palabra in enumerate(palabras)})
+    parametros['q'] = ' '.join(palabras)
+    filas = conn.execute(text(
+        f"SELECT id FROM turnos WHERE {' AND '.join(condiciones)} "
+        f'ORDER BY {orden} LIMIT :limite OFFSET :desplazamiento'
+    ), parametros)
+    return [fila[0] for fila in filas]
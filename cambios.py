@@ -0,0 +1,94 @@
+from datetime import datetime
+
+from sqlalchemy import event, func, insert, literal, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from models import Cambio, Cola, Turno
+from sucursales import sucursal_actual
+
+ENTIDADES = {Turno: 'turno', Cola: 'cola'}
+# Clave del lock de Postgres que ordena las escrituras del registro
+LOCK_CAMBIOS = 370001
+CLAVE_PENDIENTE = 'cambios_sin_confirmar'
+
+# Funciones a llamar con el código de sucursal cuando se confirman cambios
+_observadores = []
+
+
+def al_confirmar(funcion):
+    """Registra ``funcion(sucursal)``; se llama tras cada commit con cambios"""
+    _observadores.append(funcion)
+    return funcion
+
+
+def _preparar_escritura(conn):
+    """En Postgres los ids de secuencia se pueden confirmar fuera de orden;
+    un lock de transacción hace que cada versión sea visible después de las
+    anteriores y ``/api/sync`` nunca se salte un cambio. SQLite ya serializa
+    las escrituras."""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('SELECT pg_advisory_xact_lock(:clave)'), {'clave': LOCK_CAMBIOS})
+    conn.info[CLAVE_PENDIENTE] = sucursal_actual()
+
+
+def _insertar(conn, filas):
+    _preparar_escritura(conn)
+    ahora = datetime.utcnow()
+    conn.execute(insert(Cambio.__table__), [
+        {'entidad': entidad, 'entidad_id': entidad_id, 'operacion': operacion, 'fecha': ahora}
+        for entidad, entidad_id, operacion in filas
+    ])
+
+
+def registrar(conn, entidad, ids, operacion='cambio'):
+    """Anota cambios hechos con UPDATE directo (fuera del ORM)"""
+    if ids:
+        _insertar(conn, [(entidad, entidad_id, operacion) for entidad_id in ids])
+
+
+def registrar_seleccion(conn, entidad, ids_query, operacion='cambio'):
+    """Anota en bloque los ids que devuelve una consulta (UPDATE masivos)"""
+    _preparar_escritura(conn)
+    ids = ids_query.subquery()
+    conn.execute(insert(Cambio.__table__).from_select(
+        ['entidad', 'entidad_id', 'operacion', 'fecha'],
+        select(literal(entidad), ids.c[0], literal(operacion), literal(datetime.utcnow()))
+    ))
+
+
+def version_actual(session):
+    return session.query(func.max(Cambio.id)).scalar() or 0
+
+
+@event.listens_for(Session, 'after_flush')
+def _anotar_cambios(session, flush_context):
+    """Cada alta, cambio o baja de Turno/Cola hecha con el ORM queda
+    registrada en la misma transacción"""
+    filas = []
+    for objetos, operacion in (
+        (session.new, 'alta'), (session.dirty, 'cambio'), (session.deleted, 'baja')
+    ):
+        for obj in objetos:
+            entidad = ENTIDADES.get(type(obj))
+            if entidad is None:
+                continue
+            if operacion == 'cambio' and not session.is_modified(obj, include_collections=False):
+                continue
+            filas.append((entidad, obj.id, operacion))
+
+    if filas:
+        _insertar(session.connection(), filas)
+
+
+@event.listens_for(Engine, 'commit')
+def _avisar_cambios(conn):
+    if CLAVE_PENDIENTE in conn.info:
+        sucursal = conn.info.pop(CLAVE_PENDIENTE)
+        for funcion in _observadores:
+            funcion(sucursal)
+
+
+@event.listens_for(Engine, 'rollback')
+def _olvidar_cambios(conn):
+    conn.info.pop(CLAVE_PENDIENTE, None)
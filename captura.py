@@ -0,0 +1,334 @@
+import hashlib
+import hmac
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Valores que identifican a una persona: se reemplazan por seudónimos
+CAMPOS_SENSIBLES = {'nombre_cliente', 'telefono', 'observaciones', 'q', 'qr_data'}
+MAX_CUERPO_CAPTURADO = 64 * 1024
+RUTA_EXCLUIDA = re.compile(r'/api/admin/')
+FECHA = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})(?!\d)')  # también dentro de fechas ISO con hora
+SEGMENTO_NUMERICO = re.compile(r'/\d+(?=/|$)')
+SEGMENTO_FECHA = re.compile(r'/\d{4}-\d{2}-\d{2}(?=/|$)')
+LETRAS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def configurar_captura(app):
+    """Captura de tráfico para reproducirlo con ``flask replay``; apagada por defecto.
+
+    Cada petición a ``/api/`` se guarda como una línea JSON (método, ruta,
+    parámetros y cuerpo seudonimizados, estado y duración) en archivos
+    ``.ndjson`` que rotan por tamaño.
+    """
+    app.config['CAPTURA_HABILITADA'] = os.getenv('CAPTURA_HABILITADA', 'False') == 'True'
+    app.config['CAPTURA_MUESTREO'] = float(os.getenv('CAPTURA_MUESTREO', 1))
+    app.config['CAPTURA_DIR'] = os.getenv('CAPTURA_DIR', os.path.join(app.instance_path, 'capturas'))
+    app.config['CAPTURA_MAX_MB'] = float(os.getenv('CAPTURA_MAX_MB', 50))
+    app.config['CAPTURA_MAX_ARCHIVOS'] = int(os.getenv('CAPTURA_MAX_ARCHIVOS', 20))
+
+
+def seudonimo(valor, clave):
+    """Mismo largo y clase de caracteres, derivado de un HMAC: un mismo
+    valor da siempre el mismo seudónimo y no se puede revertir"""
+    resumen = hmac.new(clave, valor.encode('utf-8'), hashlib.sha256).digest()
+    salida = []
+    for i, caracter in enumerate(valor):
+        byte = resumen[i % len(resumen)] ^ i
+        if caracter.isdigit():
+            salida.append(str(byte % 10))
+        elif caracter.isalpha():
+            letra = LETRAS[byte % len(LETRAS)]
+            salida.append(letra.upper() if caracter.isupper() else letra)
+        else:
+            salida.append(caracter)
+    return ''.join(salida)
+
+
+def anonimizar(datos, clave, sensible=False):
+    """Copia de ``datos`` con los campos sensibles seudonimizados"""
+    if isinstance(datos, dict):
+        return {k: anonimizar(v, clave, sensible or k in CAMPOS_SENSIBLES) for k, v in datos.items()}
+    if isinstance(datos, list):
+        return [anonimizar(v, clave, sensible) for v in datos]
+    if sensible and isinstance(datos, str):
+        return seudonimo(datos, clave)
+    return datos
+
+
+class ArchivoRotativo:
+    """NDJSON de un proceso; abre otro archivo al pasar ``max_bytes``"""
+
+    def __init__(self, carpeta, max_bytes, max_archivos):
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        self.max_archivos = max_archivos
+        self._lock = threading.Lock()
+        self._archivo = None
+        self._pid = None
+
+    def _abrir(self):
+        os.makedirs(self.carpeta, exist_ok=True)
+        nombre = f"captura-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}.ndjson"
+        self._archivo = open(os.path.join(self.carpeta, nombre), 'a', encoding='utf-8')
+        self._pid = os.getpid()
+        self._podar()
+
+    def _podar(self):
+        archivos = sorted(
+            (e for e in os.scandir(self.carpeta) if e.name.endswith('.ndjson')),
+            key=lambda e: e.name
+        )
+        for entrada in archivos[:max(0, len(archivos) - self.max_archivos)]:
+            try:
+                os.remove(entrada.path)
+            except FileNotFoundError:
+                pass  # otro worker ya lo borró
+
+    def escribir(self, registro):
+        linea = json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._archivo is None or self._pid != os.getpid():
+                self._abrir()
+            elif self._archivo.tell() >= self.max_bytes:
+                self._archivo.close()
+                self._abrir()
+            self._archivo.write(linea)
+            self._archivo.flush()
+
+
+class CapturaMiddleware:
+    """Registra las peticiones a la API; el cuerpo se lee y se repone en
+    ``wsgi.input`` para que la aplicación lo reciba intacto"""
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+        self._clave = hashlib.sha256(f"captura:{config['SECRET_KEY']}".encode()).digest()
+        self._salida = None
+
+    def _capturar(self, environ):
+        if not self.config['CAPTURA_HABILITADA']:
+            return False
+        ruta = environ.get('PATH_INFO', '')
+        if '/api/' not in ruta or RUTA_EXCLUIDA.search(ruta):
+            return False
+        muestreo = self.config['CAPTURA_MUESTREO']
+        return muestreo >= 1 or random.random() < muestreo
+
+    def _leer_cuerpo(self, environ):
+        """Cuerpo JSON anonimizado, o None si no es JSON o es muy grande"""
+        try:
+            largo = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            largo = 0
+        if not largo or largo > MAX_CUERPO_CAPTURADO or 'json' not in environ.get('CONTENT_TYPE', ''):
+            return None, largo
+        crudo = environ['wsgi.input'].read(largo)
+        environ['wsgi.input'] = io.BytesIO(crudo)
+        try:
+            return anonimizar(json.loads(crudo), self._clave), largo
+        except ValueError:
+            return None, largo
+
+    def __call__(self, environ, start_response):
+        if not self._capturar(environ):
+            return self.wsgi_app(environ, start_response)
+
+        cuerpo, largo = self._leer_cuerpo(environ)
+        estado = {}
+
+        def registrar_inicio(status, headers, exc_info=None):
+            estado['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        inicio = time.time()
+        t0 = time.perf_counter()
+        resultado = self.wsgi_app(environ, registrar_inicio)
+        try:
+            respuesta = [b''.join(resultado)]
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+        duracion = time.perf_counter() - t0
+
+        try:
+            self._escribir({
+                'ts': round(inicio, 4),
+                'metodo': environ.get('REQUEST_METHOD'),
+                'ruta': environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                'args': anonimizar(dict(parse_qsl(environ.get('QUERY_STRING', ''))), self._clave),
+                'tipo': environ.get('CONTENT_TYPE') or None,
+                'cuerpo': cuerpo,
+                'largo': largo,
+                'status': estado.get('status'),
+                'bytes': len(respuesta[0]),
+                'duracion_ms': round(duracion * 1000, 2)
+            })
+        except OSError as e:
+            logger.warning('No se pudo guardar la captura: %s', e)
+        return respuesta
+
+    def _escribir(self, registro):
+        if self._salida is None:
+            self._salida = ArchivoRotativo(
+                self.config['CAPTURA_DIR'],
+                int(self.config['CAPTURA_MAX_MB'] * 1024 * 1024),
+                self.config['CAPTURA_MAX_ARCHIVOS']
+            )
+        self._salida.escribir(registro)
+
+
+# ---- reproducción ----
+
+def cargar_trazas(rutas):
+    """Registros de uno o más archivos NDJSON, ordenados por hora.
+
+    Se omiten las peticiones cuyo cuerpo no se guardó (archivos subidos,
+    JSON demasiado grande): no se pueden repetir.
+    """
+    registros = []
+    for ruta in rutas:
+        with open(ruta, encoding='utf-8') as archivo:
+            for linea in archivo:
+                if not linea.strip():
+                    continue
+                registro = json.loads(linea)
+                if registro.get('cuerpo') is not None or not registro.get('largo'):
+                    registros.append(registro)
+    registros.sort(key=lambda registro: registro['ts'])
+    return registros
+
+
+def mover_fechas(valor, dias):
+    """Corre ``dias`` días las fechas AAAA-MM-DD dentro de ``valor``
+
+    >>> mover_fechas({'fecha': '2025-08-21', 'fecha_cita': '2025-08-21T10:00:00'}, 2)
+    {'fecha': '2025-08-23', 'fecha_cita': '2025-08-23T10:00:00'}
+    >>> mover_fechas('/api/cola?fecha=2025-08-21&n=2025-08-211', 1)
+    '/api/cola?fecha=2025-08-22&n=2025-08-211'
+    """
+    if not dias:
+        return valor
+    if isinstance(valor, dict):
+        return {k: mover_fechas(v, dias) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [mover_fechas(v, dias) for v in valor]
+    if isinstance(valor, str):
+        def correr(coincidencia):
+            try:
+                fecha = date(*map(int, coincidencia.groups()))
+            except ValueError:
+                return coincidencia.group(0)
+            return (fecha + timedelta(days=dias)).isoformat()
+        return FECHA.sub(correr, valor)
+    return valor
+
+
+def plantilla_ruta(metodo, ruta):
+    """``GET /api/turno/15`` -> ``GET /api/turno/<id>``, para agrupar latencias"""
+    ruta = SEGMENTO_FECHA.sub('/<fecha>', ruta)
+    return f"{metodo} {SEGMENTO_NUMERICO.sub('/<id>', ruta)}"
+
+
+class Cliente:
+    """Una conexión HTTP reutilizable por hilo"""
+
+    def __init__(self, url_base):
+        partes = urlsplit(url_base)
+        self.host = partes.hostname
+        self.puerto = partes.port or (443 if partes.scheme == 'https' else 80)
+        self.clase = http.client.HTTPSConnection if partes.scheme == 'https' else http.client.HTTPConnection
+        self.prefijo = partes.path.rstrip('/')
+        self._local = threading.local()
+
+    def pedir(self, metodo, ruta, cuerpo=None):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = self._local.conexion = self.clase(self.host, self.puerto, timeout=30)
+        cabeceras = {'Content-Type': 'application/json'} if cuerpo is not None else {}
+        try:
+            conexion.request(metodo, self.prefijo + ruta, body=cuerpo, headers=cabeceras)
+            respuesta = conexion.getresponse()
+            respuesta.read()
+        except (OSError, http.client.HTTPException):
+            conexion.close()
+            self._local.conexion = None
+            raise
+        if respuesta.will_close:
+            conexion.close()
+            self._local.conexion = None
+        return respuesta.status
+
+
+def reproducir(registros, url_base, velocidad=1.0, concurrencia=16, mover_a_hoy=True):
+    """Envía los registros respetando sus tiempos relativos (``velocidad``
+    veces más rápido; 0 = sin esperas) y devuelve ``[(ruta, status, ms)]``"""
+    if not registros:
+        return []
+    cliente = Cliente(url_base)
+    inicio_traza = registros[0]['ts']
+    dias = (date.today() - datetime.fromtimestamp(inicio_traza).date()).days if mover_a_hoy else 0
+    resultados = []
+    lock = threading.Lock()
+
+    def enviar(registro):
+        ruta = mover_fechas(registro['ruta'], dias)
+        args = mover_fechas(registro.get('args') or {}, dias)
+        if args:
+            ruta = f'{ruta}?{urlencode(args)}'
+        cuerpo = registro.get('cuerpo')
+        datos = json.dumps(mover_fechas(cuerpo, dias)).encode('utf-8') if cuerpo is not None else None
+        t0 = time.perf_counter()
+        try:
+            status = cliente.pedir(registro['metodo'], ruta, datos)
+        except (OSError, http.client.HTTPException):
+            status = None
+        ms = (time.perf_counter() - t0) * 1000
+        with lock:
+            resultados.append((plantilla_ruta(registro['metodo'], registro['ruta']), status, ms))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        for registro in registros:
+            if velocidad > 0:
+                espera = (registro['ts'] - inicio_traza) / velocidad - (time.perf_counter() - inicio)
+                if espera > 0:
+                    time.sleep(espera)
+            ejecutor.submit(enviar, registro)
+    return resultados
+
+
+def percentil(ordenados, p):
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def resumen_latencias(resultados):
+    """Por ruta: cantidad, errores (5xx o sin respuesta) y p50/p90/p99/máx en ms"""
+    por_ruta = {}
+    for ruta, status, ms in resultados:
+        por_ruta.setdefault(ruta, []).append((status, ms))
+    resumen = {}
+    for ruta, filas in por_ruta.items():
+        tiempos = sorted(ms for _, ms in filas)
+        resumen[ruta] = {
+            'cantidad': len(filas),
+            'errores': sum(1 for status, _ in filas if status is None or status >= 500),
+            'p50': round(percentil(tiempos, 50), 2),
+            'p90': round(percentil(tiempos, 90), 2),
+            'p99': round(percentil(tiempos, 99), 2),
+            'max': round(tiempos[-1], 2),
+            'total': round(sum(tiempos), 2)
+        }
+    return dict(sorted(resumen.items(), key=lambda item: item[1]['total'], reverse=True))
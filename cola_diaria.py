@@ -0,0 +1,158 @@
+import threading
+from datetime import datetime, time, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import Integer, case, cast, exists, func, insert, literal, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Cola, ColaMaterializada, EstadoTurno, ORDEN_PRIORIDAD, PrioridadTurno, Turno
+from cola_memoria import cola_memoria
+from sucursales import sucursal_actual
+from estadisticas import epoch_sql
+from horarios import desfase_sql, desfases, hora_local
+import cambios
+
+SEGUNDOS_DIA = 24 * 60 * 60
+# Cómo se ubica en la cola un turno sin cita (sin horario reservado)
+POR_HORA = 'por_hora'            # por hora de llegada, entre las citas
+CITAS_PRIMERO = 'citas_primero'  # después de todas las citas del día
+POLITICAS_SIN_CITA = (POR_HORA, CITAS_PRIMERO)
+
+
+def segundos_del_dia(momento):
+    return momento.hour * 3600 + momento.minute * 60 + momento.second
+
+
+def llegada(turno):
+    """Hora local del alta del turno (``fecha_creacion`` se guarda en UTC)"""
+    if turno.fecha_creacion is None:
+        return datetime.now()
+    return hora_local(turno.fecha_creacion.replace(tzinfo=timezone.utc))
+
+
+def posicion(turno, politica):
+    """Posición en la cola del día: las citas por su hora, los turnos sin
+    cita por su hora de llegada según ``politica``.
+
+    ``posicion_sql`` es la misma regla para el volcado en bloque.
+    """
+    if turno.slot_id is not None:
+        return segundos_del_dia(turno.fecha_cita)
+    segundos = segundos_del_dia(llegada(turno))
+    return segundos + SEGUNDOS_DIA if politica == CITAS_PRIMERO else segundos
+
+
+def _segundos_sql(columna, dialecto):
+    """``segundos_del_dia`` en SQL"""
+    if dialecto == 'sqlite':
+        return cast(func.strftime('%s', columna), Integer) - cast(func.strftime('%s', func.date(columna)), Integer)
+    if dialecto == 'postgresql':
+        return cast(func.extract('epoch', columna - func.date_trunc('day', columna)), Integer)
+    return func.time_to_sec(columna)
+
+
+def posicion_sql(t, politica, dialecto, tramos):
+    """``posicion`` sobre las columnas de la tabla de turnos; ``tramos``
+    (de ``horarios.desfases``) cubren las fechas de alta"""
+    if dialecto == 'sqlite':
+        # Segundos enteros, como segundos_del_dia (julianday pierde precisión)
+        epoch = cast(func.strftime('%s', t.c.fecha_creacion), Integer)
+    else:
+        epoch = cast(func.floor(epoch_sql(t.c.fecha_creacion, dialecto)), Integer)
+    # UTC a hora local: se resta el desfase
+    segundos = (epoch - cast(desfase_sql(t.c.fecha_creacion, tramos, utc=True), Integer)) % SEGUNDOS_DIA
+    if politica == CITAS_PRIMERO:
+        segundos = segundos + SEGUNDOS_DIA
+    return case(
+        (or_(t.c.slot_id.isnot(None), t.c.fecha_creacion.is_(None)), _segundos_sql(t.c.fecha_cita, dialecto)),
+        else_=segundos
+    )
+
+
+def _marcar(conn, fecha):
+    """Reserva el día para este proceso; False si otro ya lo materializó"""
+    tabla = ColaMaterializada.__table__
+    fila = {'fecha': fecha, 'turnos': 0, 'fecha_creacion': datetime.utcnow()}
+    dialecto = conn.dialect.name
+    if dialecto in ('sqlite', 'postgresql'):
+        insertar = sqlite.insert if dialecto == 'sqlite' else postgresql.insert
+        # En Postgres espera a que confirme la otra transacción con la misma fecha
+        return conn.execute(insertar(tabla).on_conflict_do_nothing(index_elements=['fecha']), fila).rowcount == 1
+    if conn.execute(select(tabla.c.fecha).where(tabla.c.fecha == fecha)).first():
+        return False
+    conn.execute(insert(tabla), fila)
+    return True
+
+
+def materializar(session, fecha, politica=None):
+    """Vuelca a la cola, en un solo INSERT ... SELECT, los turnos pendientes
+    del día que todavía no están en ella, ubicados como en ``posicion``
+    (``politica`` por defecto: ``COLA_POLITICA_SIN_CITA``).
+
+    Idempotente: la fila de ``colas_materializadas`` se inserta primero y
+    solo la transacción que la crea hace el volcado. Devuelve la cantidad
+    de turnos agregados, o None si el día ya estaba materializado.
+    """
+    conn = session.connection()
+    if not _marcar(conn, fecha):
+        return None
+
+    politica = politica or current_app.config['COLA_POLITICA_SIN_CITA']
+    t = Turno.__table__
+    c = Cola.__table__
+    desde = datetime.combine(fecha, time.min)
+    del_dia = (
+        t.c.fecha_cita >= desde,
+        t.c.fecha_cita < desde + timedelta(days=1),
+        t.c.estado == EstadoTurno.PENDIENTE,
+        ~exists().where(c.c.turno_id == t.c.id, c.c.fecha == fecha)
+    )
+    # Los turnos pueden haberse dado de alta días antes
+    primera, ultima = conn.execute(
+        select(func.min(t.c.fecha_creacion), func.max(t.c.fecha_creacion)).where(*del_dia)
+    ).one()
+    tramos = desfases(primera or desde, ultima or desde)
+    prioridad = case(
+        *[(t.c.prioridad == clase, orden) for clase, orden in ORDEN_PRIORIDAD.items()],
+        else_=ORDEN_PRIORIDAD[PrioridadTurno.NORMAL]
+    )
+    pendientes = select(
+        t.c.id,
+        posicion_sql(t, politica, conn.dialect.name, tramos),
+        literal(fecha, c.c.fecha.type),
+        t.c.servicio_id,
+        t.c.estado,
+        prioridad
+    ).where(*del_dia)
+
+    ultimo_id = conn.execute(select(func.max(c.c.id))).scalar() or 0
+    agregados = conn.execute(insert(c).from_select(
+        ['turno_id', 'posicion', 'fecha', 'servicio_id', 'estado', 'prioridad'], pendientes
+    )).rowcount
+    if agregados:
+        cambios.registrar_seleccion(
+            conn, 'cola', select(c.c.id).where(c.c.id > ultimo_id, c.c.fecha == fecha), 'alta'
+        )
+    marcas = ColaMaterializada.__table__
+    conn.execute(marcas.update().where(marcas.c.fecha == fecha).values(turnos=agregados))
+    return agregados
+
+
+# Días que este proceso ya sabe materializados, para no consultar en cada petición
+_materializadas = set()
+_lock = threading.Lock()
+
+
+def asegurar(fecha):
+    """Materializa ``fecha`` en la sucursal actual si nadie lo hizo todavía"""
+    clave = (sucursal_actual(), fecha)
+    if clave in _materializadas:
+        return
+    with _lock:
+        if clave in _materializadas:
+            return
+        agregados = materializar(db.session, fecha)
+        db.session.commit()
+        if agregados:
+            cola_memoria.cargar(fecha)
+        _materializadas.add(clave)
@@ -0,0 +1,201 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.local import LocalProxy
+
+from models import db, Cola, EstadoTurno, ORDEN_PRIORIDAD, PrioridadTurno
+from sucursales import sucursal_actual
+
+logger = logging.getLogger(__name__)
+
+PRIORIDAD_NORMAL = ORDEN_PRIORIDAD[PrioridadTurno.NORMAL]
+
+
+class ColaEnMemoria:
+    """Espejo en memoria de los turnos pendientes, un heap por día y servicio.
+
+    Cada entrada es ``(prioridad, posicion, cola_id, turno_id)``; las bajas
+    son perezosas (se descartan al llegar a la cabeza del heap). La base de
+    datos sigue siendo la fuente de verdad: con varios workers cada uno
+    tiene su espejo, así que ``reconciliar`` lo compara periódicamente con
+    la cola real y lo reconstruye si encuentra diferencias.
+    """
+
+    def __init__(self, intervalo_reconciliacion=10):
+        self.intervalo_reconciliacion = intervalo_reconciliacion
+        self._lock = threading.RLock()
+        self._heaps = {}       # fecha -> {servicio_id: heap}
+        self._vigentes = {}    # cola_id -> (fecha, servicio_id, entrada)
+        self._ultima_carga = {}  # fecha -> time.monotonic()
+
+    # ---- carga y reconciliación ----
+    def _filas_pendientes(self, fecha):
+        return db.session.query(
+            Cola.id, Cola.turno_id, Cola.servicio_id, Cola.prioridad, Cola.posicion
+        ).filter(
+            Cola.fecha == fecha,
+            Cola.estado == EstadoTurno.PENDIENTE
+        ).all()
+
+    def _reconstruir(self, fecha, filas):
+        # Se descarta el día recargado y los anteriores: un worker que corre
+        # muchos días no acumula los heaps de cada uno
+        for dia in [dia for dia in self._heaps if dia <= fecha]:
+            del self._heaps[dia]
+        for dia in [dia for dia in self._ultima_carga if dia < fecha]:
+            del self._ultima_carga[dia]
+        for cola_id in [cid for cid, (f, _, _) in self._vigentes.items() if f <= fecha]:
+            del self._vigentes[cola_id]
+        for fila in filas:
+            self._agregar(fecha, fila.servicio_id, fila.prioridad, fila.posicion, fila.id, fila.turno_id)
+        self._ultima_carga[fecha] = time.monotonic()
+
+    def cargar(self, fecha=None):
+        """Carga (o recarga) desde la base los pendientes de un día"""
+        fecha = fecha or date.today()
+        filas = self._filas_pendientes(fecha)
+        with self._lock:
+            self._reconstruir(fecha, filas)
+
+    def reconciliar(self, fecha=None):
+        """Compara el espejo con la base; devuelve True si había diferencias"""
+        fecha = fecha or date.today()
+        filas = self._filas_pendientes(fecha)
+        with self._lock:
+            en_memoria = {cid for cid, (f, _, _) in self._vigentes.items() if f == fecha}
+            desfasado = en_memoria != {fila.id for fila in filas}
+            if desfasado:
+                logger.warning(
+                    'Cola en memoria desfasada para %s (%d en memoria, %d en base); reconstruyendo',
+                    fecha, len(en_memoria), len(filas)
+                )
+            self._reconstruir(fecha, filas)
+        return desfasado
+
+    def _asegurar_vigente(self, fecha):
+        ultima = self._ultima_carga.get(fecha)
+        if ultima is None:
+            self.cargar(fecha)
+        elif time.monotonic() - ultima >= self.intervalo_reconciliacion:
+            self.reconciliar(fecha)
+
+    # ---- operaciones ----
+    def _agregar(self, fecha, servicio_id, prioridad, posicion, cola_id, turno_id):
+        if cola_id in self._vigentes:
+            self._quitar(cola_id)
+        prioridad = PRIORIDAD_NORMAL if prioridad is None else prioridad
+        entrada = (prioridad, posicion, cola_id, turno_id)
+        heapq.heappush(self._heaps.setdefault(fecha, {}).setdefault(servicio_id, []), entrada)
+        self._vigentes[cola_id] = (fecha, servicio_id, entrada)
+
+    def _quitar(self, cola_id):
+        self._vigentes.pop(cola_id, None)
+
+    def agregar(self, fecha, servicio_id, prioridad, posicion, cola_id, turno_id):
+        with self._lock:
+            if fecha in self._ultima_carga:
+                self._agregar(fecha, servicio_id, prioridad, posicion, cola_id, turno_id)
+
+    def quitar(self, cola_id):
+        with self._lock:
+            self._quitar(cola_id)
+
+    def _cabeza(self, heap):
+        while heap:
+            entrada = heap[0]
+            vigente = self._vigentes.get(entrada[2])
+            if vigente is not None and vigente[2] == entrada:
+                return entrada
+            heapq.heappop(heap)
+        return None
+
+    def siguiente(self, fecha=None, servicios=None):
+        """Devuelve ``(cola_id, turno_id)`` del próximo pendiente o None.
+
+        ``servicios`` (ids) limita la búsqueda a los servicios de una ventanilla.
+        """
+        fecha = fecha or date.today()
+        self._asegurar_vigente(fecha)
+        with self._lock:
+            mejor = None
+            for servicio_id, heap in self._heaps.get(fecha, {}).items():
+                if servicios and servicio_id not in servicios:
+                    continue
+                cabeza = self._cabeza(heap)
+                if cabeza is not None and (mejor is None or cabeza < mejor):
+                    mejor = cabeza
+            return (mejor[2], mejor[3]) if mejor else None
+
+    def pendientes(self, fecha=None):
+        fecha = fecha or date.today()
+        with self._lock:
+            return sum(1 for f, _, _ in self._vigentes.values() if f == fecha)
+
+
+# Un espejo por sucursal; ``cola_memoria`` apunta al de la petición en curso
+_espejos = {}
+_espejos_lock = threading.Lock()
+_intervalo_reconciliacion = 10
+
+
+def configurar_reconciliacion(segundos):
+    global _intervalo_reconciliacion
+    _intervalo_reconciliacion = segundos
+    for espejo_sucursal in _espejos.values():
+        espejo_sucursal.intervalo_reconciliacion = segundos
+
+
+def espejo(codigo=None):
+    with _espejos_lock:
+        if codigo not in _espejos:
+            _espejos[codigo] = ColaEnMemoria(_intervalo_reconciliacion)
+        return _espejos[codigo]
+
+
+cola_memoria = LocalProxy(lambda: espejo(sucursal_actual()))
+
+
+# ---- sincronización con la sesión ----
+# Los cambios en filas de Cola hechos por el ORM se anotan al hacer flush y
+# se aplican al espejo solo cuando la transacción se confirma.
+
+def registrar_baja(session, cola_id):
+    """Anota la salida de la cola de un turno actualizado con UPDATE directo"""
+    session.info.setdefault('cola_memoria', []).append((sucursal_actual(), 'quitar', cola_id))
+
+
+@event.listens_for(Session, 'after_flush')
+def _anotar_cambios_cola(session, flush_context):
+    cambios = session.info.setdefault('cola_memoria', [])
+    codigo = sucursal_actual()
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Cola):
+            continue
+        if obj.estado in (None, EstadoTurno.PENDIENTE):
+            cambios.append((codigo, 'agregar', (
+                obj.fecha, obj.servicio_id, obj.prioridad, obj.posicion, obj.id, obj.turno_id
+            )))
+        else:
+            cambios.append((codigo, 'quitar', obj.id))
+    for obj in session.deleted:
+        if isinstance(obj, Cola):
+            cambios.append((codigo, 'quitar', obj.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _aplicar_cambios_cola(session):
+    for codigo, operacion, valor in session.info.pop('cola_memoria', []):
+        if operacion == 'agregar':
+            espejo(codigo).agregar(*valor)
+        else:
+            espejo(codigo).quitar(valor)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_cambios_cola(session):
+    session.info.pop('cola_memoria', None)
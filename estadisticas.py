@@ -0,0 +1,227 @@
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_, case, delete, event, extract, func, inspect, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import EstadisticaDiaria, EstadoTurno, TipoRegistro, Turno
+from horarios import desfase_sql, desfases, hora_utc
+
+CAMPOS_TURNO = (
+    'fecha_cita', 'servicio_id', 'estado', 'tipo_registro',
+    'fecha_creacion', 'tiempo_llamado', 'tiempo_atencion'
+)
+
+COLUMNA_ESTADO = {
+    EstadoTurno.PENDIENTE: 'pendientes',
+    EstadoTurno.LLAMADO: 'llamados',
+    EstadoTurno.ATENDIDO: 'atendidos',
+    EstadoTurno.CANCELADO: 'cancelados',
+}
+
+CONTADORES = (
+    'total', 'pendientes', 'llamados', 'atendidos', 'cancelados', 'qr', 'manual',
+    'espera_segundos', 'esperas', 'atencion_segundos', 'atenciones'
+)
+
+
+def instantanea(turno):
+    """Valores del turno que afectan los acumulados"""
+    return {campo: getattr(turno, campo) for campo in CAMPOS_TURNO}
+
+
+def _instantanea_anterior(turno):
+    """Valores del turno tal como estaban en la base antes de modificarlo"""
+    estado = inspect(turno)
+    anterior = {}
+    for campo in CAMPOS_TURNO:
+        historial = estado.attrs[campo].history
+        if historial.deleted:
+            anterior[campo] = historial.deleted[0]
+        else:
+            anterior[campo] = getattr(turno, campo)
+    return anterior
+
+
+def inicio_espera(fecha_creacion, fecha_cita):
+    """La espera corre desde el alta o, si se reservó antes, desde la hora de
+    la cita: la anticipación de la reserva no es tiempo en la fila.
+
+    En UTC, como ``fecha_creacion`` y ``tiempo_llamado``; ``fecha_cita`` es
+    hora local.
+    """
+    if fecha_cita:
+        cita = hora_utc(fecha_cita)
+        if cita > fecha_creacion:
+            return cita
+    return fecha_creacion
+
+
+def epoch_sql(columna, dialecto):
+    """Segundos desde 1970 de una columna DateTime (en la zona en que se guardó)"""
+    if dialecto == 'sqlite':
+        return (func.julianday(columna) - 2440587.5) * 86400.0
+    return extract('epoch', columna)
+
+
+def inicio_espera_sql(t, dialecto, desde, hasta):
+    """``inicio_espera`` sobre las columnas de la tabla de turnos, en
+    segundos desde 1970 (UTC), para citas entre ``desde`` y ``hasta``"""
+    cita = epoch_sql(t.c.fecha_cita, dialecto) + desfase_sql(t.c.fecha_cita, desfases(desde, hasta))
+    creacion = epoch_sql(t.c.fecha_creacion, dialecto)
+    return case((and_(t.c.fecha_cita.isnot(None), cita > creacion), cita), else_=creacion)
+
+
+def contribucion(datos):
+    """Clave ``(fecha, servicio_id, hora)`` y aporte de un turno a los acumulados"""
+    fecha_cita = datos['fecha_cita']
+    estado = datos['estado'] or EstadoTurno.PENDIENTE
+    valores = dict.fromkeys(CONTADORES, 0)
+    valores['total'] = 1
+    valores[COLUMNA_ESTADO[estado]] = 1
+    valores['qr' if datos['tipo_registro'] == TipoRegistro.QR else 'manual'] = 1
+
+    if datos['tiempo_llamado'] and datos['fecha_creacion']:
+        inicio = inicio_espera(datos['fecha_creacion'], fecha_cita)
+        valores['espera_segundos'] = max((datos['tiempo_llamado'] - inicio).total_seconds(), 0)
+        valores['esperas'] = 1
+    if datos['tiempo_atencion'] and datos['tiempo_llamado']:
+        valores['atencion_segundos'] = (datos['tiempo_atencion'] - datos['tiempo_llamado']).total_seconds()
+        valores['atenciones'] = 1
+
+    return (fecha_cita.date(), datos['servicio_id'], fecha_cita.hour), valores
+
+
+def _sumar(conn, clave, valores):
+    """Suma ``valores`` a la fila de la clave, creándola si no existe"""
+    tabla = EstadisticaDiaria.__table__
+    fecha, servicio_id, hora = clave
+    dialecto = conn.dialect.name
+
+    if dialecto in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialecto == 'sqlite' else postgresql.insert
+        stmt = insert(tabla).values(fecha=fecha, servicio_id=servicio_id, hora=hora, **valores)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['fecha', 'servicio_id', 'hora'],
+            set_={campo: tabla.c[campo] + stmt.excluded[campo] for campo in valores}
+        )
+        conn.execute(stmt)
+        return
+
+    condicion = and_(tabla.c.fecha == fecha, tabla.c.servicio_id == servicio_id, tabla.c.hora == hora)
+    resultado = conn.execute(
+        update(tabla).where(condicion).values({campo: tabla.c[campo] + v for campo, v in valores.items()})
+    )
+    if resultado.rowcount == 0:
+        conn.execute(tabla.insert().values(fecha=fecha, servicio_id=servicio_id, hora=hora, **valores))
+
+
+def aplicar_delta(conn, antes, despues):
+    """Actualiza los acumulados con la diferencia entre dos estados de un turno"""
+    deltas = {}
+    for datos, signo in ((antes, -1), (despues, 1)):
+        if datos is None:
+            continue
+        clave, valores = contribucion(datos)
+        acumulado = deltas.setdefault(clave, dict.fromkeys(CONTADORES, 0))
+        for campo, valor in valores.items():
+            acumulado[campo] += signo * valor
+
+    for clave, valores in deltas.items():
+        valores = {campo: valor for campo, valor in valores.items() if valor}
+        if valores:
+            _sumar(conn, clave, valores)
+
+
+@event.listens_for(Session, 'before_flush')
+def _acumular_cambios_turnos(session, flush_context, instances):
+    """Mantiene los acumulados al día con cada alta, cambio o baja de turnos"""
+    cambios = []
+    for obj in session.new:
+        if isinstance(obj, Turno):
+            cambios.append((None, instantanea(obj)))
+    for obj in session.dirty:
+        if isinstance(obj, Turno) and session.is_modified(obj):
+            antes, despues = _instantanea_anterior(obj), instantanea(obj)
+            if antes != despues:
+                cambios.append((antes, despues))
+    for obj in session.deleted:
+        if isinstance(obj, Turno):
+            cambios.append((_instantanea_anterior(obj), None))
+
+    if cambios:
+        conn = session.connection()
+        for antes, despues in cambios:
+            aplicar_delta(conn, antes, despues)
+
+
+def _segundos_entre(fin, inicio, dialecto):
+    if dialecto == 'sqlite':
+        return (func.julianday(fin) - func.julianday(inicio)) * 86400.0
+    return extract('epoch', fin - inicio)
+
+
+def recalcular(conn, fechas=None):
+    """Reconstruye los acumulados desde la tabla de turnos.
+
+    Sin ``fechas`` recalcula todo el historial (backfill); con fechas solo
+    esos días, por ejemplo después de un UPDATE masivo.
+    """
+    tabla = EstadisticaDiaria.__table__
+    t = Turno.__table__
+    dialecto = conn.dialect.name
+
+    def contar(condicion):
+        return func.coalesce(func.sum(case((condicion, 1), else_=0)), 0)
+
+    def sumar(condicion, valor):
+        return func.coalesce(func.sum(case((condicion, valor), else_=0)), 0)
+
+    con_espera = and_(t.c.tiempo_llamado.isnot(None), t.c.fecha_creacion.isnot(None))
+    con_atencion = and_(t.c.tiempo_atencion.isnot(None), t.c.tiempo_llamado.isnot(None))
+    fecha = func.date(t.c.fecha_cita)
+    hora = extract('hour', t.c.fecha_cita)
+
+    borrar = delete(tabla)
+    if fechas is None:
+        desde, hasta = conn.execute(select(func.min(t.c.fecha_cita), func.max(t.c.fecha_cita))).one()
+        if desde is None:
+            conn.execute(borrar)
+            return
+    else:
+        fechas = sorted(set(fechas))
+        if not fechas:
+            return
+        desde = datetime.combine(fechas[0], time.min)
+        hasta = datetime.combine(fechas[-1], time.max)
+    espera = epoch_sql(t.c.tiempo_llamado, dialecto) - inicio_espera_sql(t, dialecto, desde, hasta)
+
+    consulta = select(
+        fecha, t.c.servicio_id, hora,
+        func.count(),
+        contar(or_(t.c.estado == EstadoTurno.PENDIENTE, t.c.estado.is_(None))),
+        contar(t.c.estado == EstadoTurno.LLAMADO),
+        contar(t.c.estado == EstadoTurno.ATENDIDO),
+        contar(t.c.estado == EstadoTurno.CANCELADO),
+        contar(t.c.tipo_registro == TipoRegistro.QR),
+        contar(t.c.tipo_registro != TipoRegistro.QR),
+        # Llamados antes de la hora de la cita: espera cero
+        sumar(and_(con_espera, espera > 0), espera),
+        contar(con_espera),
+        sumar(con_atencion, _segundos_entre(t.c.tiempo_atencion, t.c.tiempo_llamado, dialecto)),
+        contar(con_atencion),
+    ).group_by(fecha, t.c.servicio_id, hora)
+
+    if fechas is not None:
+        # Rangos sobre fecha_cita para aprovechar su índice
+        rangos = [datetime.combine(f, time.min) for f in fechas]
+        consulta = consulta.where(or_(*(
+            and_(t.c.fecha_cita >= inicio, t.c.fecha_cita < inicio + timedelta(days=1))
+            for inicio in rangos
+        )))
+        borrar = borrar.where(tabla.c.fecha.in_(fechas))
+
+    conn.execute(borrar)
+    conn.execute(tabla.insert().from_select(
+        ['fecha', 'servicio_id', 'hora'] + list(CONTADORES), consulta
+    ))
@@ -0,0 +1,235 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import case, delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import EstadoTurno, Slot, Turno
+
+# Hora que recibe un fecha_cita sin hora: no indica un horario reservado
+HORA_SOLO_FECHA = time(9, 0)
+
+
+class HorarioCompleto(Exception):
+    """El horario pedido ya no tiene lugares libres"""
+
+
+def horas_del_dia(config, dia):
+    """Inicio de cada horario de citas del día según la configuración"""
+    if not config or not config.horario_inicio or not config.horario_fin or not config.intervalo_citas:
+        return []
+    if config.intervalo_citas <= 0:
+        return []
+    actual = datetime.combine(dia, config.horario_inicio)
+    fin = datetime.combine(dia, config.horario_fin)
+    paso = timedelta(minutes=config.intervalo_citas)
+    horas = []
+    while actual < fin:
+        horas.append(actual)
+        actual += paso
+    return horas
+
+
+def hora_local(momento):
+    """Hora local sin zona: los horarios y las citas se guardan así"""
+    if momento.tzinfo is not None:
+        return momento.astimezone().replace(tzinfo=None)
+    return momento
+
+
+def hora_utc(momento):
+    """Hora UTC sin zona, como ``fecha_creacion`` y ``tiempo_llamado``; una
+    hora sin zona se toma como local"""
+    return momento.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def desfases(desde, hasta):
+    """Segundos a sumar a una hora local para pasarla a UTC entre ``desde``
+    y ``hasta`` (horas locales sin zona).
+
+    Devuelve tramos ``(limite, desfase)``: el desfase vale para las horas
+    anteriores a ``limite``; el último tramo (``limite`` None) no tiene fin.
+    Varios tramos solo si en el rango hay cambios de horario de verano.
+    """
+    tramos = []
+    actual = datetime.combine(desde.date() - timedelta(days=1), time.min)
+    fin = datetime.combine(hasta.date() + timedelta(days=2), time.min)
+    anterior = None
+    while actual < fin:
+        desfase = (hora_utc(actual) - actual).total_seconds()
+        if anterior is not None and desfase != anterior:
+            tramos.append((actual, anterior))
+        anterior = desfase
+        actual += timedelta(hours=1)
+    tramos.append((None, anterior))
+    return tramos
+
+
+def desfase_sql(columna, tramos, utc=False):
+    """Desfase de ``desfases`` que corresponde a cada fila según ``columna``,
+    que guarda hora local o, con ``utc``, hora UTC"""
+    if len(tramos) == 1:
+        return tramos[0][1]
+    return case(
+        *[(columna < (limite + timedelta(seconds=valor) if utc else limite), valor)
+          for limite, valor in tramos[:-1]],
+        else_=tramos[-1][1]
+    )
+
+
+def _rango(dia):
+    inicio = datetime.combine(dia, time.min)
+    return inicio, inicio + timedelta(days=1)
+
+
+def _insertar_ignorando(conn, filas):
+    """Inserta horarios; los que otra petición ya creó se ignoran"""
+    tabla = Slot.__table__
+    dialecto = conn.dialect.name
+    if dialecto in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialecto == 'sqlite' else postgresql.insert
+        conn.execute(insert(tabla).on_conflict_do_nothing(index_elements=['inicio']), filas)
+        return
+    conn.execute(tabla.insert(), filas)
+
+
+def _enlazar_turnos(conn, desde, hasta):
+    """Asigna a los horarios libres los turnos que ya tenían exactamente esa
+    hora (registrados antes de generar el día).
+
+    Los que están a ``HORA_SOLO_FECHA`` se dejan sin horario: pueden ser
+    turnos con solo la fecha. Solo toca horarios sin reservas: en uno
+    ocupado el contador ya es correcto y recalcularlo competiría con las
+    reservas en curso.
+    """
+    t = Turno.__table__
+    s = Slot.__table__
+    filas = conn.execute(select(t.c.id, t.c.fecha_cita).where(
+        t.c.slot_id.is_(None),
+        t.c.estado != EstadoTurno.CANCELADO,
+        t.c.fecha_cita >= desde,
+        t.c.fecha_cita < hasta
+    )).all()
+    if not filas:
+        return
+    libres = dict(conn.execute(select(s.c.inicio, s.c.id).where(
+        s.c.inicio >= desde, s.c.inicio < hasta, s.c.ocupados == 0
+    )).all())
+
+    por_slot = defaultdict(list)
+    for turno_id, fecha_cita in filas:
+        slot_id = libres.get(fecha_cita)
+        if slot_id and fecha_cita.time() != HORA_SOLO_FECHA:
+            por_slot[slot_id].append(turno_id)
+
+    for slot_id, ids in por_slot.items():
+        conn.execute(update(t).where(t.c.id.in_(ids)).values(slot_id=slot_id))
+        # Reservas dobles anteriores a esta tabla: la capacidad las cubre
+        conn.execute(update(s).where(s.c.id == slot_id, s.c.ocupados == 0).values(
+            ocupados=len(ids),
+            capacidad=case((s.c.capacidad < len(ids), len(ids)), else_=s.c.capacidad)
+        ))
+
+
+def generar_dia(conn, config, dia):
+    """Crea los horarios del día que falten; devuelve cuántos creó"""
+    horas = horas_del_dia(config, dia)
+    if not horas:
+        return 0
+    s = Slot.__table__
+    desde, hasta = _rango(dia)
+    existentes = set(conn.execute(
+        select(s.c.inicio).where(s.c.inicio >= desde, s.c.inicio < hasta)
+    ).scalars())
+    nuevas = [hora for hora in horas if hora not in existentes]
+    if not nuevas:
+        return 0
+    capacidad = config.capacidad_horario or 1
+    _insertar_ignorando(conn, [
+        {'inicio': hora, 'capacidad': capacidad, 'ocupados': 0} for hora in nuevas
+    ])
+    _enlazar_turnos(conn, desde, hasta)
+    return len(nuevas)
+
+
+def generar(conn, config, desde, dias):
+    """Genera por adelantado los horarios de ``dias`` días desde ``desde``"""
+    return sum(generar_dia(conn, config, desde + timedelta(days=n)) for n in range(dias))
+
+
+def regenerar(conn, config, desde):
+    """Rehace los horarios desde ``desde`` tras un cambio de configuración.
+
+    Los horarios libres se borran y se vuelven a crear con la grilla nueva;
+    los que tienen reservas se conservan con su capacidad ajustada, o
+    cerrados a nuevas reservas si quedaron fuera de la grilla.
+    """
+    s = Slot.__table__
+    inicio_desde = datetime.combine(desde, time.min)
+    dias = {inicio.date() for inicio in conn.execute(
+        select(s.c.inicio).where(s.c.inicio >= inicio_desde)
+    ).scalars()}
+    libres = select(s.c.id).where(s.c.inicio >= inicio_desde, s.c.ocupados == 0)
+    # Turnos cancelados que recordaban ese horario: al reactivarse no lo recuperan
+    t = Turno.__table__
+    conn.execute(update(t).where(t.c.slot_id.in_(libres)).values(slot_id=None))
+    conn.execute(delete(s).where(s.c.inicio >= inicio_desde, s.c.ocupados == 0))
+
+    capacidad = config.capacidad_horario or 1
+    grillas = {}
+    for slot_id, inicio, ocupados in conn.execute(
+        select(s.c.id, s.c.inicio, s.c.ocupados).where(s.c.inicio >= inicio_desde)
+    ).all():
+        dia = inicio.date()
+        if dia not in grillas:
+            grillas[dia] = set(horas_del_dia(config, dia))
+        nueva = max(capacidad, ocupados) if inicio in grillas[dia] else ocupados
+        conn.execute(update(s).where(s.c.id == slot_id).values(capacidad=nueva))
+
+    for dia in sorted(dias):
+        generar_dia(conn, config, dia)
+
+
+def reservar(conn, config, fecha_cita):
+    """Ocupa un lugar en el horario de ``fecha_cita`` y devuelve su id.
+
+    El UPDATE condicional es la reserva: con dos peticiones por el último
+    lugar solo una modifica la fila. Devuelve None si la hora no es
+    exactamente el inicio de un horario de citas.
+
+    Cualquier hora en la grilla reserva, también la de un turno sin cita
+    registrado justo a hh:mm:00; para esos la ruta no llama a esta función
+    (``sin_cita`` en el alta). Las horas de llegada con segundos, como las
+    que mandan los clientes que no envían ``sin_cita``, nunca coinciden
+    con un horario y no consumen lugar.
+    """
+    s = Slot.__table__
+    inicio = hora_local(fecha_cita)
+    if inicio.second or inicio.microsecond:
+        # Ningún horario empieza con segundos: no hace falta consultar
+        return None
+    for _ in range(2):
+        resultado = conn.execute(
+            update(s)
+            .where(s.c.inicio == inicio, s.c.ocupados < s.c.capacidad)
+            .values(ocupados=s.c.ocupados + 1)
+        )
+        slot_id = conn.execute(select(s.c.id).where(s.c.inicio == inicio)).scalar()
+        if resultado.rowcount:
+            return slot_id
+        if slot_id is not None:
+            raise HorarioCompleto(f"No quedan lugares a las {inicio.strftime('%H:%M')} del {inicio.strftime('%d/%m/%Y')}")
+        # Día todavía sin horarios: se generan y se intenta de nuevo
+        if not generar_dia(conn, config, inicio.date()):
+            return None
+    return None
+
+
+def liberar(conn, slot_id, cantidad=1):
+    """Devuelve lugares al horario (turno cancelado)"""
+    s = Slot.__table__
+    conn.execute(
+        update(s)
+        .where(s.c.id == slot_id, s.c.ocupados >= cantidad)
+        .values(ocupados=s.c.ocupados - cantidad)
+    )
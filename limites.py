@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+# Rutas de kiosco: costosas (número, QR, dos commits) y expuestas al público
+RUTAS_KIOSCO = {
+    ('POST', '/api/turnos'),
+    ('POST', '/api/qr/generate'),
+}
+PREFIJO_PERSONAL = '/api/cola/'
+
+
+class AlmacenCubetas:
+    """Cubetas de fichas (token bucket) en un archivo SQLite local.
+
+    Todos los workers de gunicorn de la máquina comparten el archivo; cada
+    consumo es una transacción ``BEGIN IMMEDIATE``, así que recargar y
+    descontar es atómico entre procesos.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+
+    def _conexion(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.ruta, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cubetas ('
+                'clave TEXT PRIMARY KEY, fichas REAL NOT NULL, actualizado REAL NOT NULL)'
+            )
+            # Cubetas de clientes que ya no aparecen
+            conn.execute('DELETE FROM cubetas WHERE actualizado < ?', (time.time() - 86400,))
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def consumir(self, pedidos, ahora=None):
+        """Descuenta una ficha de cada cubeta o de ninguna.
+
+        ``pedidos`` es una lista de ``(clave, capacidad, tasa, minimo)``: la
+        cubeta no puede quedar por debajo de ``minimo`` fichas. Devuelve 0 si
+        se permitió o los segundos a esperar antes de reintentar.
+        """
+        ahora = time.time() if ahora is None else ahora
+        conn = self._conexion()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            nuevos = []
+            espera = 0.0
+            for clave, capacidad, tasa, minimo in pedidos:
+                fila = conn.execute(
+                    'SELECT fichas, actualizado FROM cubetas WHERE clave = ?', (clave,)
+                ).fetchone()
+                fichas = capacidad if fila is None else min(
+                    capacidad, fila[0] + max(0.0, ahora - fila[1]) * tasa
+                )
+                if fichas - 1 < minimo:
+                    espera = max(espera, (minimo + 1 - fichas) / tasa)
+                nuevos.append((clave, fichas - 1))
+            if espera == 0:
+                conn.executemany(
+                    'INSERT INTO cubetas (clave, fichas, actualizado) VALUES (?, ?, ?) '
+                    'ON CONFLICT(clave) DO UPDATE SET fichas = excluded.fichas, '
+                    'actualizado = excluded.actualizado',
+                    [(clave, fichas, ahora) for clave, fichas in nuevos]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return espera
+
+
+def clase_peticion(req):
+    """Clase de prioridad: 'personal' (mostradores), 'kiosco' o None (sin límite)"""
+    if req.path.startswith(PREFIJO_PERSONAL):
+        return 'personal'
+    if (req.method, req.path) in RUTAS_KIOSCO:
+        return 'kiosco'
+    return None
+
+
+def configurar_limites(app):
+    """Límites por cliente y globales para el tráfico de kioscos.
+
+    La cubeta global la comparten kioscos y mostradores, pero los kioscos no
+    pueden bajar de la reserva: cuando hay saturación se descarta primero el
+    tráfico de kioscos y las llamadas del personal siguen pasando.
+    """
+    app.config['LIMITES_HABILITADOS'] = os.getenv('LIMITES_HABILITADOS', 'True') == 'True'
+    app.config['LIMITES_DB'] = os.getenv('LIMITES_DB', os.path.join(app.instance_path, 'limites.db'))
+    # Por cliente (IP): fichas por minuto y ráfaga
+    app.config['LIMITE_KIOSCO_POR_MINUTO'] = float(os.getenv('LIMITE_KIOSCO_POR_MINUTO', 30))
+    app.config['LIMITE_KIOSCO_RAFAGA'] = float(os.getenv('LIMITE_KIOSCO_RAFAGA', 10))
+    # Global: peticiones por segundo que aguanta la base y ráfaga
+    app.config['LIMITE_GLOBAL_POR_SEGUNDO'] = float(os.getenv('LIMITE_GLOBAL_POR_SEGUNDO', 20))
+    app.config['LIMITE_GLOBAL_RAFAGA'] = float(os.getenv('LIMITE_GLOBAL_RAFAGA', 40))
+    # Parte de la cubeta global reservada al personal
+    app.config['LIMITE_RESERVA_PERSONAL'] = float(os.getenv('LIMITE_RESERVA_PERSONAL', 0.25))
+
+    os.makedirs(os.path.dirname(app.config['LIMITES_DB']) or '.', exist_ok=True)
+    app.extensions['limites'] = AlmacenCubetas(app.config['LIMITES_DB'])
+    app.before_request(_aplicar_limites)
+
+
+def _aplicar_limites():
+    config = current_app.config
+    if not config['LIMITES_HABILITADOS']:
+        return None
+    clase = clase_peticion(request)
+    if clase is None:
+        return None
+
+    rafaga_global = config['LIMITE_GLOBAL_RAFAGA']
+    pedidos = []
+    if clase == 'kiosco':
+        pedidos.append((
+            f'cliente:{request.remote_addr}',
+            config['LIMITE_KIOSCO_RAFAGA'], config['LIMITE_KIOSCO_POR_MINUTO'] / 60, 0
+        ))
+        minimo_global = rafaga_global * config['LIMITE_RESERVA_PERSONAL']
+    else:
+        minimo_global = 0
+    pedidos.append(('global', rafaga_global, config['LIMITE_GLOBAL_POR_SEGUNDO'], minimo_global))
+
+    try:
+        espera = current_app.extensions['limites'].consumir(pedidos)
+    except sqlite3.Error as e:
+        # Si el almacén falla se deja pasar: mejor sin límite que sin servicio
+        logger.warning('Límites no disponibles: %s', e)
+        return None
+
+    if espera:
+        respuesta = jsonify({'error': 'Demasiadas solicitudes, intente nuevamente en unos segundos'})
+        respuesta.status_code = 429
+        respuesta.headers['Retry-After'] = str(max(1, math.ceil(espera)))
+        return respuesta
+    return None
@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Carpeta donde se guardan los logos subidos (relativa a la raíz del proyecto)
+UPLOAD_FOLDER = os.path.join('static', 'img', 'uploads')
+UPLOAD_URL = 'static/img/uploads'
+
+# Variantes pre-generadas: nombre -> lado máximo en píxeles
+VARIANTES_LOGO = {
+    'header': 96,
+    'kiosk': 512,
+}
+FORMATOS_VARIANTE = ('png', 'webp')
+
+TAMANO_BLOQUE = 64 * 1024
+
+# Variantes encontradas por logo: el nombre lleva el hash del contenido, así
+# que una vez completas no cambian. Incompletas (generándose) se vuelven a
+# buscar pasados unos segundos.
+_variantes_cache = {}
+_variantes_lock = threading.Lock()
+REVISAR_INCOMPLETAS_SEGUNDOS = 5
+
+
+# Formatos que Pillow debe reconocer en el archivo, no solo en la extensión
+FORMATOS_LOGO = {'PNG', 'JPEG', 'GIF'}
+
+
+class LogoDemasiadoGrande(Exception):
+    """El archivo supera el tamaño máximo permitido"""
+
+
+class LogoInvalido(Exception):
+    """El archivo no es una imagen válida"""
+
+
+def _verificar_imagen(ruta):
+    try:
+        with Image.open(ruta) as img:
+            formato = img.format
+            img.verify()
+    except Exception as e:
+        raise LogoInvalido() from e
+    if formato not in FORMATOS_LOGO:
+        raise LogoInvalido()
+
+
+def guardar_logo(stream, extension, max_bytes):
+    """Guarda el logo en disco por bloques y lo nombra por su hash de contenido.
+
+    ``LogoInvalido`` si el contenido no es una imagen PNG, JPEG o GIF.
+
+    Devuelve ``(nombre_archivo, nuevo)``; ``nuevo`` es False si el mismo
+    contenido ya estaba guardado.
+    """
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    sha = hashlib.sha256()
+    total = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.subida_')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                bloque = stream.read(TAMANO_BLOQUE)
+                if not bloque:
+                    break
+                total += len(bloque)
+                if total > max_bytes:
+                    raise LogoDemasiadoGrande()
+                sha.update(bloque)
+                tmp.write(bloque)
+
+        _verificar_imagen(tmp_path)
+        filename = f'logo_{sha.hexdigest()[:32]}.{extension}'
+        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        if os.path.exists(filepath):
+            os.remove(tmp_path)
+            return filename, False
+
+        os.replace(tmp_path, filepath)
+        return filename, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _carpeta_variantes(filename):
+    return os.path.join(UPLOAD_FOLDER, os.path.splitext(filename)[0])
+
+
+def generar_variantes(filename):
+    """Genera las variantes redimensionadas (PNG y WebP) de un logo"""
+    origen = os.path.join(UPLOAD_FOLDER, filename)
+    carpeta = _carpeta_variantes(filename)
+    os.makedirs(carpeta, exist_ok=True)
+
+    with Image.open(origen) as img:
+        img.load()
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+
+        for nombre, lado in VARIANTES_LOGO.items():
+            variante = img.copy()
+            variante.thumbnail((lado, lado), Image.LANCZOS)
+            for formato in FORMATOS_VARIANTE:
+                destino = os.path.join(carpeta, f'{nombre}.{formato}')
+                if os.path.exists(destino):
+                    continue
+                # Escribir a un temporal y renombrar para no servir archivos a medias
+                tmp = f'{destino}.{threading.get_ident()}.tmp'
+                if formato == 'png':
+                    variante.save(tmp, 'PNG', optimize=True)
+                else:
+                    variante.save(tmp, 'WEBP', quality=85, method=4)
+                os.replace(tmp, destino)
+    with _variantes_lock:
+        _variantes_cache.pop(filename, None)
+
+
+def _generar_variantes_registrando(filename):
+    try:
+        generar_variantes(filename)
+    except Exception:
+        logger.exception('No se pudieron generar las variantes del logo %s', filename)
+
+
+def generar_variantes_en_segundo_plano(filename):
+    """Lanza la generación de variantes sin bloquear la petición"""
+    hilo = threading.Thread(
+        target=_generar_variantes_registrando,
+        args=(filename,),
+        name=f'variantes-{filename}',
+        daemon=True
+    )
+    hilo.start()
+    return hilo
+
+
+def variantes_logo(logo_url):
+    """Devuelve las URLs de las variantes disponibles para un logo subido"""
+    if not logo_url or not logo_url.startswith(f'{UPLOAD_URL}/'):
+        return {}
+
+    filename = logo_url[len(UPLOAD_URL) + 1:]
+    with _variantes_lock:
+        guardado = _variantes_cache.get(filename)
+    if guardado is not None:
+        variantes, completas, instante = guardado
+        if completas or time.monotonic() - instante < REVISAR_INCOMPLETAS_SEGUNDOS:
+            return variantes
+
+    variantes = _buscar_variantes(filename)
+    completas = all(len(variantes.get(nombre, {})) == len(FORMATOS_VARIANTE) for nombre in VARIANTES_LOGO)
+    with _variantes_lock:
+        _variantes_cache[filename] = (variantes, completas, time.monotonic())
+    return variantes
+
+
+def _buscar_variantes(filename):
+    carpeta = _carpeta_variantes(filename)
+    base_url = f'{UPLOAD_URL}/{os.path.splitext(filename)[0]}'
+
+    variantes = {}
+    for nombre in VARIANTES_LOGO:
+        formatos = {
+            formato: f'{base_url}/{nombre}.{formato}'
+            for formato in FORMATOS_VARIANTE
+            if os.path.exists(os.path.join(carpeta, f'{nombre}.{formato}'))
+        }
+        if formatos:
+            variantes[nombre] = formatos
+    return variantes
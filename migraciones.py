@@ -0,0 +1,94 @@
+from sqlalchemy import inspect, text
+
+from models import db, ORDEN_PRIORIDAD, PrioridadTurno
+import busqueda
+import estadisticas
+
+
+def _agregar_columnas_faltantes(conn):
+    """Agrega con ALTER TABLE las columnas nuevas de los modelos.
+
+    ``db.create_all()`` solo crea tablas que no existen, así que las bases
+    anteriores necesitan este paso para recibir columnas agregadas después.
+    """
+    inspector = inspect(conn)
+    tablas = set(inspector.get_table_names())
+
+    for tabla in db.metadata.sorted_tables:
+        if tabla.name not in tablas:
+            continue
+        existentes = {col['name'] for col in inspector.get_columns(tabla.name)}
+        for columna in tabla.columns:
+            if columna.name in existentes:
+                continue
+            tipo = columna.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {tabla.name} ADD COLUMN {columna.name} {tipo}'))
+
+
+def _crear_indices_faltantes(conn):
+    for tabla in db.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            indice.create(conn, checkfirst=True)
+
+
+def _completar_servicio_id(conn):
+    """Enlaza cada turno con su servicio a partir del nombre guardado.
+
+    Los nombres del historial que ya no están en ``servicios`` se crean
+    inactivos para no perder esos turnos en los reportes.
+    """
+    conn.execute(text('''
+        INSERT INTO servicios (nombre, activo)
+        SELECT DISTINCT servicio, :inactivo FROM turnos
+        WHERE servicio_id IS NULL
+          AND servicio NOT IN (SELECT nombre FROM servicios)
+    '''), {'inactivo': False})
+    conn.execute(text('''
+        UPDATE turnos SET
+            servicio_id = (SELECT id FROM servicios WHERE servicios.nombre = turnos.servicio)
+        WHERE servicio_id IS NULL
+    '''))
+
+
+def _completar_cola_despacho(conn):
+    """Copia servicio y estado del turno a las filas de cola que no los tienen"""
+    conn.execute(text('''
+        UPDATE cola SET
+            servicio_id = (SELECT servicio_id FROM turnos WHERE turnos.id = cola.turno_id),
+            estado = (SELECT estado FROM turnos WHERE turnos.id = cola.turno_id)
+        WHERE servicio_id IS NULL OR estado IS NULL
+    '''))
+
+
+def _completar_prioridad_cola(conn):
+    """Las filas de cola anteriores a las prioridades se atienden como normales"""
+    conn.execute(
+        text('UPDATE cola SET prioridad = :normal WHERE prioridad IS NULL'),
+        {'normal': ORDEN_PRIORIDAD[PrioridadTurno.NORMAL]}
+    )
+
+
+def _completar_estadisticas(conn):
+    """Primer llenado de los acumulados diarios a partir del historial"""
+    vacia = conn.execute(text('SELECT COUNT(*) FROM estadisticas_diarias')).scalar() == 0
+    if vacia:
+        estadisticas.recalcular(conn)
+
+
+MIGRACIONES = [
+    _agregar_columnas_faltantes,
+    _completar_servicio_id,
+    _completar_prioridad_cola,
+    _crear_indices_faltantes,
+    _completar_cola_despacho,
+    _completar_estadisticas,
+    busqueda.crear_indice,
+]
+
+
+def aplicar_migraciones(engine):
+    """Crea tablas nuevas y actualiza el esquema existente; es idempotente"""
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for migracion in MIGRACIONES:
+            migracion(conn)
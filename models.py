@@ -1,9 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from enum import Enum
+from logos import variantes_logo
+from sucursales import SesionSucursal
 
-# db será configurado después por app.py
-db = SQLAlchemy()
+# db será configurado después por app.py; cada sesión usa la base de la sucursal actual
+db = SQLAlchemy(session_options={'class_': SesionSucursal})
 
 class EstadoTurno(Enum):
     PENDIENTE = "pendiente"
@@ -15,35 +17,73 @@ class TipoRegistro(Enum):
     QR = "qr"
     MANUAL = "manual"
 
+class PrioridadTurno(Enum):
+    PREFERENCIAL = "preferencial"  # adultos mayores, embarazadas, discapacidad
+    CITA = "cita"
+    NORMAL = "normal"
+
+# Orden de atención de cada clase de prioridad (menor se atiende primero)
+ORDEN_PRIORIDAD = {
+    PrioridadTurno.PREFERENCIAL: 0,
+    PrioridadTurno.CITA: 1,
+    PrioridadTurno.NORMAL: 2,
+}
+
 class Turno(db.Model):
     __tablename__ = 'turnos'
+    # Filtros y reportes por servicio, casi siempre acotados por fecha
+    __table_args__ = (
+        db.Index('ix_turnos_servicio_fecha', 'servicio_id', 'fecha_cita'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     numero_turno = db.Column(db.String(10), unique=True, nullable=False)
     nombre_cliente = db.Column(db.String(100), nullable=False)
     telefono = db.Column(db.String(20))
+    servicio_id = db.Column(db.Integer, db.ForeignKey('servicios.id'))
+    # Nombre del servicio al momento del registro; filtrar siempre por servicio_id
     servicio = db.Column(db.String(100), nullable=False)
+    # Horario reservado; None sin cita previa. Un turno cancelado conserva el
+    # suyo (ya liberado) para volver a ocuparlo si se reactiva
+    slot_id = db.Column(db.Integer, db.ForeignKey('slots.id'))
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
-    fecha_cita = db.Column(db.DateTime, nullable=False)
+    fecha_cita = db.Column(db.DateTime, nullable=False, index=True)
     estado = db.Column(db.Enum(EstadoTurno), default=EstadoTurno.PENDIENTE)
     tipo_registro = db.Column(db.Enum(TipoRegistro), nullable=False)
-    qr_code = db.Column(db.String(255))
+    prioridad = db.Column(db.Enum(PrioridadTurno), default=PrioridadTurno.NORMAL)
+    qr_code = db.Column(db.String(255))  # Sin uso: la imagen se genera en /api/qr/<id>/imagen
     observaciones = db.Column(db.Text)
     tiempo_llamado = db.Column(db.DateTime)
     tiempo_atencion = db.Column(db.DateTime)
     
+    servicio_rel = db.relationship('Servicio', lazy='joined')
+    
+    @property
+    def nombre_servicio(self):
+        """Nombre actual del servicio (sobrevive a que se renombre)"""
+        return self.servicio_rel.nombre if self.servicio_rel else self.servicio
+    
+    @property
+    def qr_url(self):
+        """Imagen del QR (solo turnos registrados por QR)"""
+        if self.tipo_registro != TipoRegistro.QR:
+            return None
+        return f'/api/qr/{self.id}/imagen'
+    
     def to_dict(self):
         return {
             'id': self.id,
             'numero_turno': self.numero_turno,
             'nombre_cliente': self.nombre_cliente,
             'telefono': self.telefono,
-            'servicio': self.servicio,
+            'servicio': self.nombre_servicio,
+            'servicio_id': self.servicio_id,
             'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
             'fecha_cita': self.fecha_cita.isoformat() if self.fecha_cita else None,
             'estado': self.estado.value if self.estado else None,
             'tipo_registro': self.tipo_registro.value if self.tipo_registro else None,
-            'qr_code': self.qr_code,
+            'prioridad': self.prioridad.value if self.prioridad else PrioridadTurno.NORMAL.value,
+            'qr_url': self.qr_url,
             'observaciones': self.observaciones,
             'tiempo_llamado': self.tiempo_llamado.isoformat() if self.tiempo_llamado else None,
             'tiempo_atencion': self.tiempo_atencion.isoformat() if self.tiempo_atencion else None
@@ -80,35 +120,197 @@ class Configuracion(db.Model):
     volumen_voz = db.Column(db.Float, default=0.8)
     tiempo_espera_cancelacion = db.Column(db.Integer, default=30)  # minutos
     reinicio_diario = db.Column(db.Boolean, default=True)
+    capacidad_horario = db.Column(db.Integer, default=1)  # citas por horario
     
     def to_dict(self):
         return {
             'id': self.id,
             'nombre_empresa': self.nombre_empresa,
             'logo_url': self.logo_url,
+            'logo_variantes': variantes_logo(self.logo_url),
             'horario_inicio': self.horario_inicio.strftime('%H:%M') if self.horario_inicio else None,
             'horario_fin': self.horario_fin.strftime('%H:%M') if self.horario_fin else None,
             'intervalo_citas': self.intervalo_citas,
             'voz_habilitada': self.voz_habilitada,
             'volumen_voz': self.volumen_voz,
             'tiempo_espera_cancelacion': self.tiempo_espera_cancelacion,
-            'reinicio_diario': self.reinicio_diario
+            'reinicio_diario': self.reinicio_diario,
+            'capacidad_horario': self.capacidad_horario or 1
+        }
+
+# Servicios que atiende cada ventanilla
+ventanilla_servicios = db.Table(
+    'ventanilla_servicios',
+    db.Column('ventanilla_id', db.Integer, db.ForeignKey('ventanillas.id'), primary_key=True),
+    db.Column('servicio_id', db.Integer, db.ForeignKey('servicios.id'), primary_key=True)
+)
+
+class Ventanilla(db.Model):
+    __tablename__ = 'ventanillas'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(50), nullable=False, unique=True)
+    activa = db.Column(db.Boolean, default=True)
+    
+    servicios = db.relationship('Servicio', secondary=ventanilla_servicios, lazy='selectin')
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'nombre': self.nombre,
+            'activa': self.activa,
+            'servicios': [servicio.nombre for servicio in self.servicios]
         }
 
 class Cola(db.Model):
     __tablename__ = 'cola'
+    # Índice de despacho: siguiente turno pendiente de un servicio en el día
+    __table_args__ = (
+        db.Index('ix_cola_despacho_servicio', 'fecha', 'servicio_id', 'estado', 'prioridad', 'posicion'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     turno_id = db.Column(db.Integer, db.ForeignKey('turnos.id'), nullable=False)
+    # Segundos desde medianoche de la hora de la cita o de llegada (ver cola_diaria)
     posicion = db.Column(db.Integer, nullable=False)
     fecha = db.Column(db.Date, default=lambda: datetime.utcnow().date())
+    # Copias del turno para despachar sin join; se mantienen al cambiar de estado
+    servicio_id = db.Column(db.Integer, db.ForeignKey('servicios.id'))
+    estado = db.Column(db.Enum(EstadoTurno), default=EstadoTurno.PENDIENTE)
+    prioridad = db.Column(db.Integer, default=ORDEN_PRIORIDAD[PrioridadTurno.NORMAL])
+    ventanilla_id = db.Column(db.Integer, db.ForeignKey('ventanillas.id'))
     
     turno = db.relationship('Turno', backref='cola_info')
+    ventanilla = db.relationship('Ventanilla')
     
     def to_dict(self):
         return {
             'id': self.id,
             'turno': self.turno.to_dict() if self.turno else None,
             'posicion': self.posicion,
+            'fecha': self.fecha.isoformat() if self.fecha else None,
+            'ventanilla': self.ventanilla.nombre if self.ventanilla else None
+        }
+
+class ColaMaterializada(db.Model):
+    """Días cuyas citas ya se volcaron a la cola (una fila por día)"""
+    __tablename__ = 'colas_materializadas'
+    
+    fecha = db.Column(db.Date, primary_key=True)
+    turnos = db.Column(db.Integer, nullable=False, default=0)
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class EstadisticaDiaria(db.Model):
+    """Acumulados por día, servicio y hora; se actualizan en cada cambio de turno"""
+    __tablename__ = 'estadisticas_diarias'
+    
+    fecha = db.Column(db.Date, primary_key=True)
+    servicio_id = db.Column(db.Integer, db.ForeignKey('servicios.id'), primary_key=True)
+    hora = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    pendientes = db.Column(db.Integer, nullable=False, default=0)
+    llamados = db.Column(db.Integer, nullable=False, default=0)
+    atendidos = db.Column(db.Integer, nullable=False, default=0)
+    cancelados = db.Column(db.Integer, nullable=False, default=0)
+    qr = db.Column(db.Integer, nullable=False, default=0)
+    manual = db.Column(db.Integer, nullable=False, default=0)
+    espera_segundos = db.Column(db.Float, nullable=False, default=0)  # llamado - inicio_espera (alta o cita)
+    esperas = db.Column(db.Integer, nullable=False, default=0)
+    atencion_segundos = db.Column(db.Float, nullable=False, default=0)  # atención - llamado
+    atenciones = db.Column(db.Integer, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'fecha': self.fecha.isoformat() if self.fecha else None,
+            'servicio_id': self.servicio_id,
+            'hora': self.hora,
+            'total': self.total,
+            'pendientes': self.pendientes,
+            'llamados': self.llamados,
+            'atendidos': self.atendidos,
+            'cancelados': self.cancelados,
+            'qr': self.qr,
+            'manual': self.manual,
+            'espera_segundos': self.espera_segundos,
+            'esperas': self.esperas,
+            'atencion_segundos': self.atencion_segundos,
+            'atenciones': self.atenciones
+        }
+
+class Slot(db.Model):
+    """Horario de cita de un día con su capacidad; se genera desde la configuración"""
+    __tablename__ = 'slots'
+    __table_args__ = (
+        db.CheckConstraint('ocupados >= 0 AND ocupados <= capacidad', name='ck_slots_ocupados'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    inicio = db.Column(db.DateTime, nullable=False, unique=True)
+    capacidad = db.Column(db.Integer, nullable=False, default=1)
+    ocupados = db.Column(db.Integer, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'hora': self.inicio.strftime('%H:%M'),
+            'disponible': self.ocupados < self.capacidad,
+            'cupos': max(self.capacidad - self.ocupados, 0)
+        }
+
+class Notificacion(db.Model):
+    """Bandeja de salida de mensajes a clientes; la vacía ``notificaciones.despachador``"""
+    __tablename__ = 'notificaciones'
+    __table_args__ = (
+        # Un aviso de cada tipo por turno aunque se llame dos veces
+        db.UniqueConstraint('turno_id', 'tipo', name='uq_notificaciones_turno_tipo'),
+        db.Index('ix_notificaciones_envio', 'estado', 'proximo_intento'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    turno_id = db.Column(db.Integer, db.ForeignKey('turnos.id'), nullable=False)
+    tipo = db.Column(db.String(10), nullable=False)  # 'aviso' (faltan N) o 'turno'
+    telefono = db.Column(db.String(20), nullable=False)
+    mensaje = db.Column(db.String(255), nullable=False)
+    proveedor = db.Column(db.String(30), nullable=False)
+    estado = db.Column(db.String(10), nullable=False, default='pendiente')  # enviando, enviada, fallida, vencida
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    lote = db.Column(db.String(32))
+    fecha_creacion = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    fecha_envio = db.Column(db.DateTime)
+    error = db.Column(db.String(255))
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'turno_id': self.turno_id,
+            'tipo': self.tipo,
+            'telefono': self.telefono,
+            'mensaje': self.mensaje,
+            'proveedor': self.proveedor,
+            'estado': self.estado,
+            'intentos': self.intentos,
+            'fecha_creacion': self.fecha_creacion.isoformat() if self.fecha_creacion else None,
+            'fecha_envio': self.fecha_envio.isoformat() if self.fecha_envio else None,
+            'error': self.error
+        }
+
+class Cambio(db.Model):
+    """Registro de cambios en turnos y cola; el id es la versión para /api/sync"""
+    __tablename__ = 'cambios'
+    # AUTOINCREMENT en SQLite: las versiones nunca se reutilizan al podar
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    id = db.Column(db.Integer, primary_key=True)
+    entidad = db.Column(db.String(20), nullable=False)  # 'turno' o 'cola'
+    entidad_id = db.Column(db.Integer, nullable=False)
+    operacion = db.Column(db.String(10), nullable=False)  # alta, cambio, baja
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def to_dict(self):
+        return {
+            'version': self.id,
+            'entidad': self.entidad,
+            'entidad_id': self.entidad_id,
+            'operacion': self.operacion,
             'fecha': self.fecha.isoformat() if self.fecha else None
         }
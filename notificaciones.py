@@ -0,0 +1,336 @@
+import importlib
+import json
+import logging
+import os
+import threading
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import db, EstadoTurno, Notificacion, Turno
+from sucursales import en_sucursal
+
+logger = logging.getLogger(__name__)
+
+PENDIENTE = 'pendiente'
+ENVIANDO = 'enviando'
+ENVIADA = 'enviada'
+FALLIDA = 'fallida'
+VENCIDA = 'vencida'
+
+AVISO = 'aviso'   # faltan N lugares
+TURNO = 'turno'   # lo están llamando
+
+CLAVE_SESION = 'notificaciones_encoladas'
+# Tiempo que un lote queda reservado; si el worker muere se vuelve a tomar
+RESERVA_LOTE = timedelta(minutes=5)
+
+
+class Transporte:
+    """Proveedor de mensajería. ``enviar`` lanza una excepción si el envío falla
+    y el mensaje se reintenta más tarde."""
+    nombre = None
+    concurrencia = 1  # envíos simultáneos al proveedor
+
+    def __init__(self, config):
+        self.config = config
+
+    def enviar(self, telefono, mensaje):
+        raise NotImplementedError
+
+
+class TransporteStub(Transporte):
+    """No envía nada: guarda los mensajes en memoria y los escribe en el log"""
+    nombre = 'stub'
+    concurrencia = 4
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.enviados = []
+        self._lock = threading.Lock()
+
+    def enviar(self, telefono, mensaje):
+        with self._lock:
+            self.enviados.append((telefono, mensaje))
+        logger.info('Notificación a %s: %s', telefono, mensaje)
+
+
+class TransporteHTTP(Transporte):
+    """POST con ``{"telefono", "mensaje"}`` en JSON a ``NOTIFICACIONES_URL``
+    (pasarela de SMS o WhatsApp)"""
+    nombre = 'http'
+    concurrencia = 2
+
+    def enviar(self, telefono, mensaje):
+        peticion = urllib.request.Request(
+            self.config['NOTIFICACIONES_URL'],
+            data=json.dumps({'telefono': telefono, 'mensaje': mensaje}).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(peticion, timeout=self.config['NOTIFICACIONES_TIMEOUT_SEGUNDOS']) as respuesta:
+            if respuesta.status >= 300:
+                raise RuntimeError(f'HTTP {respuesta.status}')
+
+
+TRANSPORTES = {}
+
+
+def registrar_transporte(clase):
+    """Agrega un transporte; se elige con ``NOTIFICACIONES_TRANSPORTE=<nombre>``"""
+    TRANSPORTES[clase.nombre] = clase
+    return clase
+
+
+registrar_transporte(TransporteStub)
+registrar_transporte(TransporteHTTP)
+
+
+def _clase_transporte(nombre):
+    """Transporte registrado o ``paquete.modulo:Clase``"""
+    if nombre in TRANSPORTES:
+        return TRANSPORTES[nombre]
+    if ':' in nombre:
+        modulo, clase = nombre.split(':', 1)
+        return registrar_transporte(getattr(importlib.import_module(modulo), clase))
+    raise ValueError(f'Transporte de notificaciones desconocido: {nombre}')
+
+
+def _leer_concurrencia(valor):
+    """``'http=4,stub=8'`` -> ``{'http': 4, 'stub': 8}``"""
+    limites = {}
+    for parte in filter(None, (p.strip() for p in valor.split(','))):
+        nombre, _, cantidad = parte.partition('=')
+        limites[nombre.strip()] = int(cantidad)
+    return limites
+
+
+def configurar_notificaciones(app):
+    """Avisos por teléfono a los clientes según avanza la cola.
+
+    Los mensajes se escriben en la tabla ``notificaciones`` en la misma
+    transacción que el llamado; un hilo de fondo los envía por lotes, así
+    que la petición nunca espera al proveedor.
+    """
+    app.config['NOTIFICACIONES_HABILITADAS'] = os.getenv('NOTIFICACIONES_HABILITADAS', 'True') == 'True'
+    app.config['NOTIFICACIONES_TRANSPORTE'] = os.getenv('NOTIFICACIONES_TRANSPORTE', 'stub')
+    app.config['NOTIFICACIONES_URL'] = os.getenv('NOTIFICACIONES_URL')
+    app.config['NOTIFICACIONES_TIMEOUT_SEGUNDOS'] = float(os.getenv('NOTIFICACIONES_TIMEOUT_SEGUNDOS', 10))
+    # Envíos simultáneos por proveedor, p. ej. 'http=4'; si no, el del transporte
+    app.config['NOTIFICACIONES_CONCURRENCIA'] = _leer_concurrencia(os.getenv('NOTIFICACIONES_CONCURRENCIA', ''))
+    # Se avisa al cliente que queda en este lugar de la fila (0 = sin aviso)
+    app.config['NOTIFICACIONES_AVISO_LUGARES'] = int(os.getenv('NOTIFICACIONES_AVISO_LUGARES', 3))
+    app.config['NOTIFICACIONES_LOTE'] = int(os.getenv('NOTIFICACIONES_LOTE', 50))
+    app.config['NOTIFICACIONES_INTERVALO_SEGUNDOS'] = float(os.getenv('NOTIFICACIONES_INTERVALO_SEGUNDOS', 5))
+    app.config['NOTIFICACIONES_MAX_INTENTOS'] = int(os.getenv('NOTIFICACIONES_MAX_INTENTOS', 5))
+    # Espera antes del primer reintento; se duplica en cada fallo
+    app.config['NOTIFICACIONES_REINTENTO_SEGUNDOS'] = float(os.getenv('NOTIFICACIONES_REINTENTO_SEGUNDOS', 30))
+    # Un aviso más viejo que esto ya no sirve y no se envía
+    app.config['NOTIFICACIONES_VIGENCIA_MINUTOS'] = int(os.getenv('NOTIFICACIONES_VIGENCIA_MINUTOS', 60))
+
+    _clase_transporte(app.config['NOTIFICACIONES_TRANSPORTE'])
+    despachador.app = app
+
+
+def encolar(session, avisos):
+    """Agrega ``(turno, tipo, mensaje)`` a la bandeja de salida en la
+    transacción de ``session``; los turnos sin teléfono se omiten."""
+    config = despachador.app.config
+    if not config['NOTIFICACIONES_HABILITADAS']:
+        return 0
+    filas = [
+        {
+            'turno_id': turno.id,
+            'tipo': tipo,
+            'telefono': turno.telefono,
+            'mensaje': mensaje,
+            'proveedor': config['NOTIFICACIONES_TRANSPORTE'],
+            'estado': PENDIENTE,
+            'intentos': 0,
+            'proximo_intento': datetime.utcnow(),
+            'fecha_creacion': datetime.utcnow()
+        }
+        for turno, tipo, mensaje in avisos if turno.telefono
+    ]
+    if not filas:
+        return 0
+
+    conn = session.connection()
+    tabla = Notificacion.__table__
+    dialecto = conn.dialect.name
+    if dialecto in ('sqlite', 'postgresql'):
+        insertar = sqlite.insert if dialecto == 'sqlite' else postgresql.insert
+        conn.execute(insertar(tabla).on_conflict_do_nothing(index_elements=['turno_id', 'tipo']), filas)
+    else:
+        existentes = set(conn.execute(
+            select(tabla.c.turno_id, tabla.c.tipo)
+            .where(tabla.c.turno_id.in_([fila['turno_id'] for fila in filas]))
+        ).all())
+        filas = [fila for fila in filas if (fila['turno_id'], fila['tipo']) not in existentes]
+        if filas:
+            conn.execute(insert(tabla), filas)
+    session.info[CLAVE_SESION] = True
+    return len(filas)
+
+
+class Despachador:
+    """Hilo de fondo que vacía la bandeja de salida por lotes.
+
+    Cada lote se reserva con un UPDATE (varios workers no envían el mismo
+    mensaje), se envía fuera de la transacción con un límite de envíos
+    simultáneos por proveedor y se marca enviado o se reprograma con
+    espera exponencial hasta ``NOTIFICACIONES_MAX_INTENTOS``.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+        self._pid = None
+        self._ejecutor = None
+        self._transportes = {}  # nombre -> (transporte, semáforo)
+
+    def transporte(self, nombre):
+        with self._lock:
+            if nombre not in self._transportes:
+                clase = _clase_transporte(nombre)
+                limite = self.app.config['NOTIFICACIONES_CONCURRENCIA'].get(clase.nombre, clase.concurrencia)
+                self._transportes[nombre] = (clase(self.app.config), threading.BoundedSemaphore(limite))
+            return self._transportes[nombre][0]
+
+    def _preparar(self):
+        """Hilo y ejecutor propios de este proceso (gunicorn hace fork)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._hilo = None
+                self._ejecutor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='notificaciones')
+
+    def despertar(self):
+        """Arranca el hilo si hace falta y adelanta la próxima vuelta"""
+        if self.app is None or not self.app.config['NOTIFICACIONES_HABILITADAS']:
+            return
+        self._preparar()
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name='despachador-notificaciones', daemon=True)
+                self._hilo.start()
+        self._despertar.set()
+
+    def _bucle(self):
+        while True:
+            self._despertar.wait(self.app.config['NOTIFICACIONES_INTERVALO_SEGUNDOS'])
+            self._despertar.clear()
+            try:
+                self.procesar_pendientes()
+            except Exception:
+                logger.exception('Error al despachar notificaciones')
+
+    def procesar_pendientes(self):
+        """Envía todo lo que esté listo en todas las sucursales; devuelve cuántos procesó"""
+        self._preparar()
+        total = 0
+        with self.app.app_context():
+            for codigo in [None] + self.app.config['SUCURSALES']:
+                with en_sucursal(codigo):
+                    while True:
+                        procesados = self._procesar_lote()
+                        total += procesados
+                        if procesados < self.app.config['NOTIFICACIONES_LOTE']:
+                            break
+        return total
+
+    def _procesar_lote(self):
+        config = self.app.config
+        ahora = datetime.utcnow()
+        listos = (
+            (Notificacion.estado == PENDIENTE) | (Notificacion.estado == ENVIANDO),
+            Notificacion.proximo_intento <= ahora
+        )
+        ids = [fila.id for fila in db.session.query(Notificacion.id).filter(*listos)
+               .order_by(Notificacion.id).limit(config['NOTIFICACIONES_LOTE'])]
+        if not ids:
+            db.session.rollback()
+            return 0
+
+        lote = uuid.uuid4().hex
+        Notificacion.query.filter(Notificacion.id.in_(ids), *listos).update({
+            Notificacion.estado: ENVIANDO,
+            Notificacion.lote: lote,
+            Notificacion.proximo_intento: ahora + RESERVA_LOTE
+        }, synchronize_session=False)
+        db.session.commit()
+
+        mensajes = db.session.query(
+            Notificacion.id, Notificacion.tipo, Notificacion.telefono, Notificacion.mensaje,
+            Notificacion.proveedor, Notificacion.intentos, Notificacion.fecha_creacion, Turno.estado
+        ).join(Turno, Turno.id == Notificacion.turno_id).filter(Notificacion.lote == lote).all()
+        db.session.rollback()
+
+        vigencia = ahora - timedelta(minutes=config['NOTIFICACIONES_VIGENCIA_MINUTOS'])
+        # Un aviso de "faltan N" no sirve si el turno ya fue llamado o cancelado
+        vencidos = {m.id for m in mensajes if m.fecha_creacion < vigencia or (
+            m.tipo == AVISO and m.estado != EstadoTurno.PENDIENTE
+        )}
+        a_enviar = [m for m in mensajes if m.id not in vencidos]
+        errores = dict(zip(
+            (m.id for m in a_enviar),
+            self._ejecutor.map(self._enviar, a_enviar)
+        ))
+
+        enviados = [mensaje_id for mensaje_id, error in errores.items() if error is None]
+        if enviados:
+            Notificacion.query.filter(Notificacion.id.in_(enviados)).update(
+                {Notificacion.estado: ENVIADA, Notificacion.fecha_envio: datetime.utcnow()},
+                synchronize_session=False
+            )
+        if vencidos:
+            Notificacion.query.filter(Notificacion.id.in_(vencidos)).update(
+                {Notificacion.estado: VENCIDA}, synchronize_session=False
+            )
+        for mensaje in a_enviar:
+            error = errores[mensaje.id]
+            if error is None:
+                continue
+            intentos = mensaje.intentos + 1
+            agotado = intentos >= config['NOTIFICACIONES_MAX_INTENTOS']
+            espera = config['NOTIFICACIONES_REINTENTO_SEGUNDOS'] * 2 ** (intentos - 1)
+            Notificacion.query.filter(Notificacion.id == mensaje.id).update({
+                Notificacion.estado: FALLIDA if agotado else PENDIENTE,
+                Notificacion.intentos: intentos,
+                Notificacion.proximo_intento: datetime.utcnow() + timedelta(seconds=espera),
+                Notificacion.error: error[:255]
+            }, synchronize_session=False)
+        db.session.commit()
+        return len(mensajes)
+
+    def _enviar(self, mensaje):
+        """Devuelve None si se envió o el texto del error"""
+        try:
+            transporte = self.transporte(mensaje.proveedor)
+            with self._transportes[mensaje.proveedor][1]:
+                transporte.enviar(mensaje.telefono, mensaje.mensaje)
+            return None
+        except Exception as e:
+            logger.warning('No se pudo enviar la notificación %s: %s', mensaje.id, e)
+            return str(e) or type(e).__name__
+
+
+despachador = Despachador()
+
+
+@event.listens_for(Session, 'after_commit')
+def _despertar_despachador(session):
+    if session.info.pop(CLAVE_SESION, False):
+        despachador.despertar()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _olvidar_encoladas(session):
+    session.info.pop(CLAVE_SESION, None)
@@ -0,0 +1,188 @@
+import cProfile
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+CABECERA_TOKEN = 'HTTP_X_PERFIL_TOKEN'
+RUTA_ADMIN = re.compile(r'/api/admin/perfiles')
+NOMBRE_PERFIL = re.compile(r'^[0-9A-Za-z_.-]+\.(prof|folded)$')
+MODOS = ('cprofile', 'muestreo')
+
+
+def configurar_perfilador(app):
+    """Perfilado de peticiones a pedido, apagado por defecto.
+
+    Se activa con la cabecera ``X-Perfil-Token: <PERFIL_TOKEN>`` o para una
+    fracción ``PERFIL_MUESTREO`` de las peticiones. ``PERFIL_MODO`` elige
+    cProfile (``.prof``) o el muestreador de pilas (``.folded``, listo
+    para flamegraph.pl o speedscope).
+    """
+    app.config['PERFIL_TOKEN'] = os.getenv('PERFIL_TOKEN')
+    app.config['PERFIL_MUESTREO'] = float(os.getenv('PERFIL_MUESTREO', 0))
+    app.config['PERFIL_MODO'] = os.getenv('PERFIL_MODO', 'cprofile')
+    app.config['PERFIL_DIR'] = os.getenv('PERFIL_DIR', os.path.join(app.instance_path, 'perfiles'))
+    app.config['PERFIL_MAX_ARCHIVOS'] = int(os.getenv('PERFIL_MAX_ARCHIVOS', 200))
+    if app.config['PERFIL_MODO'] not in MODOS:
+        raise ValueError(f"PERFIL_MODO debe ser uno de: {', '.join(MODOS)}")
+
+
+def token_valido(config, token):
+    esperado = config.get('PERFIL_TOKEN')
+    return bool(esperado and token and hmac.compare_digest(token, esperado))
+
+
+class MuestreadorPilas:
+    """Toma la pila de un hilo cada ``intervalo`` segundos y cuenta las repetidas"""
+
+    def __init__(self, hilo_id, intervalo=0.002):
+        self.hilo_id = hilo_id
+        self.intervalo = intervalo
+        self.conteos = Counter()
+        self._fin = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+
+    def _muestrear(self):
+        while not self._fin.wait(self.intervalo):
+            frame = sys._current_frames().get(self.hilo_id)
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                pila.append(f'{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})')
+                frame = frame.f_back
+            if pila:
+                self.conteos[';'.join(reversed(pila))] += 1
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._fin.set()
+        self._hilo.join()
+
+    def escribir(self, ruta):
+        with open(ruta, 'w') as archivo:
+            for pila, cantidad in self.conteos.most_common():
+                archivo.write(f'{pila} {cantidad}\n')
+
+
+class PerfiladorMiddleware:
+    """Envuelve la petición completa (vista, SQL, QR y serialización JSON)"""
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def _perfilar(self, environ):
+        if RUTA_ADMIN.search(environ.get('PATH_INFO', '')):
+            return False
+        if token_valido(self.config, environ.get(CABECERA_TOKEN)):
+            return True
+        muestreo = self.config['PERFIL_MUESTREO']
+        return muestreo > 0 and random.random() < muestreo
+
+    def __call__(self, environ, start_response):
+        if not self._perfilar(environ):
+            return self.wsgi_app(environ, start_response)
+
+        modo = self.config['PERFIL_MODO']
+        inicio = datetime.now()
+        nombre = f"{inicio.strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+        extension = 'prof' if modo == 'cprofile' else 'folded'
+        estado = {}
+
+        def registrar_inicio(status, headers, exc_info=None):
+            estado['status'] = status
+            headers.append(('X-Perfil-Id', f'{nombre}.{extension}'))
+            return start_response(status, headers, exc_info)
+
+        t0 = time.perf_counter()
+        if modo == 'cprofile':
+            perfil = cProfile.Profile()
+            perfil.enable()
+            try:
+                cuerpo = self._consumir(environ, registrar_inicio)
+            finally:
+                perfil.disable()
+        else:
+            with MuestreadorPilas(threading.get_ident()) as perfil:
+                cuerpo = self._consumir(environ, registrar_inicio)
+        duracion = time.perf_counter() - t0
+
+        try:
+            self._guardar(perfil, nombre, extension, {
+                'archivo': f'{nombre}.{extension}',
+                'metodo': environ.get('REQUEST_METHOD'),
+                'ruta': environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                'consulta': environ.get('QUERY_STRING', ''),
+                'status': estado.get('status'),
+                'duracion_ms': round(duracion * 1000, 2),
+                'fecha': inicio.isoformat(),
+                'modo': modo
+            })
+        except OSError as e:
+            logger.warning('No se pudo guardar el perfil %s: %s', nombre, e)
+        return cuerpo
+
+    def _consumir(self, environ, start_response):
+        # La respuesta se arma completa dentro del perfil
+        resultado = self.wsgi_app(environ, start_response)
+        try:
+            return [b''.join(resultado)]
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+
+    def _guardar(self, perfil, nombre, extension, meta):
+        carpeta = self.config['PERFIL_DIR']
+        os.makedirs(carpeta, exist_ok=True)
+        ruta = os.path.join(carpeta, f'{nombre}.{extension}')
+        if extension == 'prof':
+            perfil.dump_stats(ruta)
+        else:
+            perfil.escribir(ruta)
+        with open(os.path.join(carpeta, f'{nombre}.json'), 'w') as archivo:
+            json.dump(meta, archivo)
+        rotar(carpeta, self.config['PERFIL_MAX_ARCHIVOS'])
+
+
+def rotar(carpeta, maximo):
+    """Deja solo los ``maximo`` perfiles más recientes"""
+    metas = sorted(
+        (entrada for entrada in os.scandir(carpeta) if entrada.name.endswith('.json')),
+        key=lambda entrada: entrada.name
+    )
+    for entrada in metas[:max(0, len(metas) - maximo)]:
+        base = entrada.path[:-len('.json')]
+        for ruta in (entrada.path, f'{base}.prof', f'{base}.folded'):
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass  # otro worker ya lo borró
+
+
+def listar_perfiles(carpeta, limite=20):
+    """Metadatos de los perfiles guardados, de la petición más lenta a la más rápida"""
+    if not os.path.isdir(carpeta):
+        return []
+    perfiles = []
+    for entrada in os.scandir(carpeta):
+        if not entrada.name.endswith('.json'):
+            continue
+        try:
+            with open(entrada.path) as archivo:
+                perfiles.append(json.load(archivo))
+        except (OSError, ValueError):
+            continue
+    perfiles.sort(key=lambda meta: meta.get('duracion_ms', 0), reverse=True)
+    return perfiles[:limite]
@@ -0,0 +1,251 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import current_app, g, has_request_context, jsonify, request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+logger_sql = logging.getLogger('sql')
+
+CABECERA_ID = 'X-Request-ID'
+# Ids que llegan de un proxy: se aceptan solo si son cortos y seguros
+ID_VALIDO = re.compile(r'^[0-9A-Za-z._:-]{1,64}$')
+FORMATOS = ('json', 'texto')
+MAX_SQL = 500  # caracteres de la sentencia en el log
+
+# Atributos propios de LogRecord; el resto son los ``extra`` de cada llamada
+_ATRIBUTOS_RECORD = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+# Umbral de consultas lentas en ms (None = sin registrar)
+_sql_lento_ms = None
+
+
+def configurar_registro(app):
+    """Logs estructurados que se escriben en un hilo aparte.
+
+    Las peticiones solo encolan el registro; un ``QueueListener`` lo
+    formatea y escribe. Cada petición recibe un id (``X-Request-ID``) que
+    aparece en todos sus logs, incluidas las consultas SQL lentas y la
+    generación de QR, y se devuelve en la respuesta.
+    """
+    global _sql_lento_ms
+    app.config['REGISTRO_NIVEL'] = os.getenv('REGISTRO_NIVEL', 'INFO').upper()
+    app.config['REGISTRO_FORMATO'] = os.getenv('REGISTRO_FORMATO', 'json')
+    app.config['REGISTRO_ARCHIVO'] = os.getenv('REGISTRO_ARCHIVO')
+    app.config['REGISTRO_ACCESOS'] = os.getenv('REGISTRO_ACCESOS', 'true').lower() == 'true'
+    # Consultas más lentas que esto (ms) se registran como advertencia; -1 apaga
+    app.config['REGISTRO_SQL_LENTO_MS'] = float(os.getenv('REGISTRO_SQL_LENTO_MS', 200))
+    app.config['REGISTRO_COLA_MAX'] = int(os.getenv('REGISTRO_COLA_MAX', 10000))
+    if app.config['REGISTRO_FORMATO'] not in FORMATOS:
+        raise ValueError(f"REGISTRO_FORMATO debe ser uno de: {', '.join(FORMATOS)}")
+    if not isinstance(logging.getLevelName(app.config['REGISTRO_NIVEL']), int):
+        raise ValueError(f"REGISTRO_NIVEL inválido: {app.config['REGISTRO_NIVEL']}")
+
+    if app.config['REGISTRO_ARCHIVO']:
+        # WatchedFileHandler reabre el archivo si logrotate lo movió
+        destino = logging.handlers.WatchedFileHandler(app.config['REGISTRO_ARCHIVO'], encoding='utf-8')
+    else:
+        destino = logging.StreamHandler(sys.stderr)
+    if app.config['REGISTRO_FORMATO'] == 'json':
+        destino.setFormatter(FormatoJSON())
+    else:
+        destino.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+        ))
+
+    raiz = logging.getLogger()
+    for manejador in list(raiz.handlers):
+        if isinstance(manejador, ManejadorCola):
+            manejador.detener()
+        raiz.removeHandler(manejador)
+    manejador = ManejadorCola(destino, app.config['REGISTRO_COLA_MAX'])
+    manejador.addFilter(FiltroContexto())
+    raiz.addHandler(manejador)
+    raiz.setLevel(app.config['REGISTRO_NIVEL'])
+    # Flask escribe sus errores directo a stderr; que pasen por la cola
+    app.logger.removeHandler(default_handler)
+
+    _sql_lento_ms = app.config['REGISTRO_SQL_LENTO_MS'] if app.config['REGISTRO_SQL_LENTO_MS'] >= 0 else None
+
+    app.before_request(asignar_id_peticion)
+    app.after_request(registrar_acceso)
+    app.register_error_handler(Exception, error_interno)
+
+
+class FiltroContexto(logging.Filter):
+    """Agrega el id de la petición y la sucursal; corre en el hilo que loguea"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id', '-')
+            record.sucursal = g.get('sucursal')
+        else:
+            record.request_id = getattr(record, 'request_id', '-')
+            record.sucursal = getattr(record, 'sucursal', None)
+        return True
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por registro"""
+
+    def format(self, record):
+        datos = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'mensaje': record.getMessage(),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_RECORD and valor is not None:
+                datos[clave] = valor
+        if record.exc_info:
+            datos['excepcion'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            datos['excepcion'] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class ManejadorCola(logging.handlers.QueueHandler):
+    """QueueHandler que no bloquea: si la cola se llena, descarta y cuenta.
+
+    El hilo escritor se crea de nuevo en cada proceso (workers de gunicorn
+    creados con fork después de configurar la app).
+    """
+
+    def __init__(self, destino, maximo):
+        super().__init__(queue.Queue(maximo))
+        self.destino = destino
+        self.maximo = maximo
+        self.descartados = 0
+        self._oyente = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.detener)
+
+    def _asegurar_escritor(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # La cola heredada del padre puede tener sus locks tomados
+            self.queue = queue.Queue(self.maximo)
+            self._oyente = logging.handlers.QueueListener(self.queue, self.destino, respect_handler_level=True)
+            self._oyente.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Se resuelve aquí el mensaje y la traza: los args y exc_info pueden
+        # no ser serializables ni seguir válidos cuando escriba el otro hilo
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._asegurar_escritor()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+    def detener(self):
+        if self._oyente is not None and self._pid == os.getpid():
+            self._oyente.stop()
+            self._pid = None
+
+
+def asignar_id_peticion():
+    recibido = request.headers.get(CABECERA_ID, '')
+    g.request_id = recibido if ID_VALIDO.match(recibido) else uuid.uuid4().hex
+    g.inicio_peticion = time.perf_counter()
+    g.sql_consultas = 0
+    g.sql_ms = 0.0
+
+
+def registrar_acceso(response):
+    request_id = g.get('request_id')
+    if request_id:
+        response.headers[CABECERA_ID] = request_id
+    if request_id and current_app.config['REGISTRO_ACCESOS']:
+        logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+            'estado': response.status_code,
+            'duracion_ms': round((time.perf_counter() - g.inicio_peticion) * 1000, 2),
+            'sql_consultas': g.sql_consultas,
+            'sql_ms': round(g.sql_ms, 2),
+        })
+    return response
+
+
+def error_interno(e):
+    """Respuesta 500 de cualquier error no previsto de una ruta (los errores
+    HTTP conservan su código).
+
+    Deshace la sesión para que el error de un commit no deje la
+    transacción inválida para lo que resta de la petición, y registra la
+    excepción con la ruta y el id de la petición.
+    """
+    if isinstance(e, HTTPException):
+        # get_or_404, abort(), JSON mal formado: la API responde siempre JSON
+        if request.path.startswith('/api/'):
+            return jsonify({'error': e.description}), e.code
+        return e
+    from models import db
+    try:
+        db.session.rollback()
+    except Exception:
+        logger.exception('No se pudo deshacer la sesión')
+    logger.error('Error en %s %s: %s', request.method, request.path, e, exc_info=e)
+    return jsonify({'error': str(e)}), 500
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_consulta', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get('inicio_consulta')
+    if not inicios:
+        return
+    duracion_ms = (time.perf_counter() - inicios.pop()) * 1000
+    if has_request_context() and 'sql_consultas' in g:
+        g.sql_consultas += 1
+        g.sql_ms += duracion_ms
+    if _sql_lento_ms is not None and duracion_ms >= _sql_lento_ms:
+        nivel = logging.WARNING
+    elif logger_sql.isEnabledFor(logging.DEBUG):
+        nivel = logging.DEBUG
+    else:
+        return
+    # Solo la sentencia: los parámetros pueden traer datos de clientes
+    logger_sql.log(nivel, 'Consulta de %.1f ms', duracion_ms, extra={
+        'sql': ' '.join(statement.split())[:MAX_SQL],
+        'duracion_ms': round(duracion_ms, 2),
+        'filas': cursor.rowcount,
+        'multiple': executemany,
+    })
+
+
+@event.listens_for(Engine, 'handle_error')
+def _consulta_fallida(contexto):
+    # Sin esto el inicio de la consulta fallida quedaría en la pila
+    if contexto.connection is not None and contexto.connection.info.get('inicio_consulta'):
+        contexto.connection.info['inicio_consulta'].pop()
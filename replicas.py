@@ -0,0 +1,180 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from sqlalchemy import text
+
+from sucursales import sucursal_actual
+
+logger = logging.getLogger(__name__)
+
+COOKIE_ESCRITURA = 'turnos_escritura'
+METODOS_LECTURA = ('GET', 'HEAD', 'OPTIONS')
+
+
+def bind_replica(codigo=None):
+    return f'replica_{codigo}' if codigo else 'replica'
+
+
+def configurar_replicas(app):
+    """Registra las réplicas de lectura definidas en el entorno.
+
+    ``DATABASE_URL_REPLICA`` es la réplica de la base principal y
+    ``DATABASE_URL_REPLICA_<CODIGO>`` la de cada sucursal. Puede ser una
+    copia SQLite refrescada con ``flask snapshot-replica`` o un standby de
+    Postgres. Sin réplica configurada todo sigue yendo a la principal.
+    """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    replicas = {}
+    for codigo in [None] + list(app.config.get('SUCURSALES', [])):
+        variable = f'DATABASE_URL_REPLICA_{codigo.upper()}' if codigo else 'DATABASE_URL_REPLICA'
+        url = os.getenv(variable)
+        if url:
+            binds[bind_replica(codigo)] = url
+            replicas[codigo] = bind_replica(codigo)
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['REPLICAS'] = replicas
+    # Retraso máximo aceptado antes de volver a la principal
+    app.config['REPLICA_MAX_RETRASO_SEGUNDOS'] = float(os.getenv('REPLICA_MAX_RETRASO_SEGUNDOS', 30))
+    # Tras una escritura, el mismo cliente lee de la principal durante esta ventana
+    app.config['REPLICA_VENTANA_ESCRITURA_SEGUNDOS'] = int(os.getenv('REPLICA_VENTANA_ESCRITURA_SEGUNDOS', 5))
+    # Cada cuánto se vuelve a medir el retraso de cada réplica
+    app.config['REPLICA_CHEQUEO_SEGUNDOS'] = float(os.getenv('REPLICA_CHEQUEO_SEGUNDOS', 5))
+    # La cookie de escritura solo sirve para elegir réplica
+    if replicas:
+        app.after_request(_marcar_escritura)
+
+
+def _medir_retraso(engine):
+    """Segundos de atraso de la réplica respecto de la principal"""
+    if engine.dialect.name == 'sqlite':
+        # La copia se reescribe completa en cada snapshot; vacía = nunca copiada
+        if os.path.getsize(engine.url.database) == 0:
+            return math.inf
+        return max(0.0, time.time() - os.path.getmtime(engine.url.database))
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            retraso = conn.execute(text(
+                'SELECT CASE WHEN NOT pg_is_in_recovery() '
+                'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+            )).scalar()
+        return float(retraso or 0)
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return 0.0
+
+
+class MonitorReplicas:
+    """Guarda por un rato el último retraso medido de cada réplica"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mediciones = {}  # nombre del bind -> (retraso, time.monotonic())
+
+    def retraso(self, nombre, engine, vigencia):
+        with self._lock:
+            medicion = self._mediciones.get(nombre)
+            if medicion and time.monotonic() - medicion[1] < vigencia:
+                return medicion[0]
+        try:
+            retraso = _medir_retraso(engine)
+        except Exception as e:
+            logger.warning('Réplica %s no disponible: %s', nombre, e)
+            retraso = math.inf
+        with self._lock:
+            self._mediciones[nombre] = (retraso, time.monotonic())
+        return retraso
+
+    def olvidar(self, nombre=None):
+        with self._lock:
+            if nombre is None:
+                self._mediciones.clear()
+            else:
+                self._mediciones.pop(nombre, None)
+
+
+monitor = MonitorReplicas()
+
+
+def _escritura_reciente():
+    try:
+        ultima = float(request.cookies.get(COOKIE_ESCRITURA, 0))
+    except ValueError:
+        return False
+    return time.time() - ultima < current_app.config['REPLICA_VENTANA_ESCRITURA_SEGUNDOS']
+
+
+def replica_disponible(max_retraso=None):
+    """Nombre del bind de réplica a usar en esta petición, o None para la principal"""
+    nombre = current_app.config.get('REPLICAS', {}).get(sucursal_actual())
+    if nombre is None or _escritura_reciente():
+        return None
+    from models import db
+    engine = db.engines[nombre]
+    if max_retraso is None:
+        max_retraso = current_app.config['REPLICA_MAX_RETRASO_SEGUNDOS']
+    retraso = monitor.retraso(nombre, engine, current_app.config['REPLICA_CHEQUEO_SEGUNDOS'])
+    return nombre if retraso <= max_retraso else None
+
+
+def solo_lectura(vista=None, max_retraso=None):
+    """Marca una ruta como de solo lectura: sus SELECT pueden ir a la réplica.
+
+    Se usa como ``@solo_lectura`` o ``@solo_lectura(max_retraso=120)`` para
+    tolerar más atraso en reportes. Si la réplica está caída, atrasada o el
+    cliente acaba de escribir, la ruta lee de la principal.
+    """
+    def decorador(funcion):
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            g.bind_lectura = replica_disponible(max_retraso)
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                g.pop('bind_lectura', None)
+        return envoltura
+
+    if vista is not None:
+        return decorador(vista)
+    return decorador
+
+
+def conexion_lectura():
+    """Conexión de la sesión para consultas en bloque (réplica si corresponde)"""
+    from models import db
+    nombre = g.get('bind_lectura')
+    if nombre:
+        return db.session.connection(bind_arguments={'bind': db.engines[nombre]})
+    return db.session.connection()
+
+
+def _marcar_escritura(response):
+    if request.method not in METODOS_LECTURA and response.status_code < 400:
+        response.set_cookie(
+            COOKIE_ESCRITURA, str(int(time.time())),
+            max_age=current_app.config['REPLICA_VENTANA_ESCRITURA_SEGUNDOS'],
+            httponly=True, samesite='Lax'
+        )
+    return response
+
+
+def snapshot_sqlite(origen, destino):
+    """Copia consistente de una base SQLite con la API de backup.
+
+    Se copia en un solo paso: por tramos, cada escritura en la principal
+    obligaría a reiniciar la copia. El mtime de la réplica marca su antigüedad.
+    """
+    fuente = sqlite3.connect(origen)
+    copia = sqlite3.connect(destino)
+    try:
+        fuente.backup(copia)
+    finally:
+        copia.close()
+        fuente.close()
+    os.utime(destino)
@@ -1,14 +1,32 @@
-from flask import request, jsonify, send_file
+from flask import request, jsonify, send_file, Response
 from app import app
-from models import db, Turno, Servicio, Configuracion, Cola, EstadoTurno, TipoRegistro
-from datetime import datetime, timedelta, date
-from werkzeug.utils import secure_filename
-import qrcode
+from models import (
+    db, Turno, Servicio, Configuracion, Cola, Ventanilla, EstadoTurno, TipoRegistro,
+    PrioridadTurno, ORDEN_PRIORIDAD, EstadisticaDiaria, Cambio, Slot, ColaMaterializada
+)
+import estadisticas
+import cambios
+import busqueda
+import horarios
+import notificaciones
+import cola_diaria
+from analitica import calcular_heatmap
+from cola_memoria import cola_memoria, registrar_baja
+from sucursales import sucursal_actual
+from replicas import solo_lectura, conexion_lectura
+from tokens_qr import generar_token, verificar_token, TokenInvalido, CacheTTL
+from tablero import CacheTablero
+from perfilador import token_valido, listar_perfiles, NOMBRE_PERFIL
+from imagenes_qr import imagen_qr, extension, TAMANO_PREDETERMINADO
+from registro import error_interno
+from datetime import datetime, timedelta, date, timezone
 import io
-import base64
 import os
 import json
-import uuid
+from logos import (
+    guardar_logo, generar_variantes_en_segundo_plano, variantes_logo,
+    LogoDemasiadoGrande, LogoInvalido, UPLOAD_URL
+)
 
 # ============ RUTAS DE CONFIGURACIÓN ============
 @app.route('/api/configuracion', methods=['GET'])
@@ -19,7 +37,9 @@ def get_configuracion():
             return jsonify({'error': 'Configuración no encontrada'}), 404
         return jsonify(config.to_dict())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+CAMPOS_HORARIOS = ('horario_inicio', 'horario_fin', 'intervalo_citas', 'capacidad_horario')
 
 @app.route('/api/configuracion', methods=['PUT', 'POST'])
 def update_configuracion():
@@ -34,6 +54,11 @@ def update_configuracion():
             config.nombre_empresa = data['nombre_empresa']
         if 'logo_url' in data:
             config.logo_url = data['logo_url']
+            # Logos subidos antes de existir las variantes: generarlas ahora
+            if config.logo_url and config.logo_url.startswith(f'{UPLOAD_URL}/') \
+                    and not variantes_logo(config.logo_url) \
+                    and os.path.exists(config.logo_url):
+                generar_variantes_en_segundo_plano(config.logo_url[len(UPLOAD_URL) + 1:])
         if 'horario_inicio' in data:
             config.horario_inicio = datetime.strptime(data['horario_inicio'], '%H:%M').time()
         if 'horario_fin' in data:
@@ -48,17 +73,27 @@ def update_configuracion():
             config.tiempo_espera_cancelacion = data['tiempo_espera_cancelacion']
         if 'reinicio_diario' in data:
             config.reinicio_diario = data['reinicio_diario']
+        if 'capacidad_horario' in data:
+            config.capacidad_horario = data['capacidad_horario']
             
         db.session.add(config)
+        # Los horarios ya generados se rehacen con la grilla nueva
+        if any(campo in data for campo in CAMPOS_HORARIOS):
+            horarios.regenerar(db.session.connection(), config, date.today())
         db.session.commit()
+        cache_tablero.invalidar(sucursal_actual())
         
         return jsonify({'success': True, 'config': config.to_dict()})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/upload-logo', methods=['POST'])
 def upload_logo():
     try:
+        limite = app.config['MAX_LOGO_BYTES']
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': f'El logo supera el tamaño máximo ({limite // 1024} KB)'}), 413
+        
         if 'logo' not in request.files:
             return jsonify({'error': 'No se encontró archivo'}), 400
         
@@ -72,30 +107,34 @@ def upload_logo():
                 file.filename.rsplit('.', 1)[1].lower() in allowed_extensions):
             return jsonify({'error': 'Tipo de archivo no permitido'}), 400
         
-        # Generar nombre único
-        filename = secure_filename(file.filename)
-        name, ext = os.path.splitext(filename)
-        filename = f'logo_{uuid.uuid4().hex}{ext}'
+        ext_logo = file.filename.rsplit('.', 1)[1].lower()
+        if ext_logo == 'jpeg':
+            ext_logo = 'jpg'
         
-        # Crear directorio si no existe
-        upload_folder = os.path.join('static', 'img', 'uploads')
-        os.makedirs(upload_folder, exist_ok=True)
+        # Guardar por bloques con límite de tamaño; el nombre es el hash del contenido
+        try:
+            filename, nuevo = guardar_logo(file.stream, ext_logo, limite)
+        except LogoDemasiadoGrande:
+            return jsonify({'error': f'El logo supera el tamaño máximo ({limite // 1024} KB)'}), 413
+        except LogoInvalido:
+            return jsonify({'error': 'El archivo no es una imagen válida'}), 400
         
-        # Guardar archivo
-        filepath = os.path.join(upload_folder, filename)
-        file.save(filepath)
+        # Las variantes redimensionadas se generan en segundo plano
+        if nuevo or not variantes_logo(f'{UPLOAD_URL}/{filename}'):
+            generar_variantes_en_segundo_plano(filename)
         
         # URL relativa para el frontend
-        logo_url = f'static/img/uploads/{filename}'
+        logo_url = f'{UPLOAD_URL}/{filename}'
         
         return jsonify({
             'success': True,
             'logo_url': logo_url,
+            'logo_variantes': variantes_logo(logo_url),
             'message': 'Logo subido correctamente'
         })
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 # ============ RUTAS DE SERVICIOS ============
 @app.route('/api/servicios', methods=['GET'])
@@ -104,7 +143,7 @@ def get_servicios():
         servicios = Servicio.query.filter_by(activo=True).all()
         return jsonify([servicio.to_dict() for servicio in servicios])
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/servicios', methods=['POST'])
 def create_servicio():
@@ -119,7 +158,79 @@ def create_servicio():
         db.session.commit()
         return jsonify(servicio.to_dict()), 201
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+def buscar_servicio(valores):
+    """Servicio indicado por ``servicio_id`` o, por compatibilidad, por nombre.
+    
+    Devuelve None si no se indicó ninguno; ValueError si no existe.
+    """
+    if valores.get('servicio_id') not in (None, ''):
+        servicio = db.session.get(Servicio, int(valores['servicio_id']))
+        if servicio is None:
+            raise ValueError(f"Servicio no encontrado: {valores['servicio_id']}")
+        return servicio
+    if valores.get('servicio'):
+        servicio = Servicio.query.filter_by(nombre=valores['servicio']).first()
+        if servicio is None:
+            raise ValueError(f"Servicio no encontrado: {valores['servicio']}")
+        return servicio
+    return None
+
+# ============ RUTAS DE VENTANILLAS ============
+def _servicios_por_nombre(nombres):
+    servicios = Servicio.query.filter(Servicio.nombre.in_(nombres)).all()
+    faltantes = set(nombres) - {servicio.nombre for servicio in servicios}
+    if faltantes:
+        raise ValueError(f"Servicios no encontrados: {', '.join(sorted(faltantes))}")
+    return servicios
+
+@app.route('/api/ventanillas', methods=['GET'])
+def get_ventanillas():
+    try:
+        ventanillas = Ventanilla.query.filter_by(activa=True).order_by(Ventanilla.nombre).all()
+        return jsonify([ventanilla.to_dict() for ventanilla in ventanillas])
+    except Exception as e:
+        return error_interno(e)
+
+@app.route('/api/ventanillas', methods=['POST'])
+def create_ventanilla():
+    try:
+        data = request.get_json()
+        if 'nombre' not in data:
+            return jsonify({'error': 'Campo requerido: nombre'}), 400
+        
+        ventanilla = Ventanilla(
+            nombre=data['nombre'],
+            servicios=_servicios_por_nombre(data.get('servicios', []))
+        )
+        db.session.add(ventanilla)
+        db.session.commit()
+        return jsonify(ventanilla.to_dict()), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return error_interno(e)
+
+@app.route('/api/ventanillas/<int:ventanilla_id>', methods=['PUT'])
+def update_ventanilla(ventanilla_id):
+    try:
+        data = request.get_json()
+        ventanilla = Ventanilla.query.get_or_404(ventanilla_id)
+        
+        if 'nombre' in data:
+            ventanilla.nombre = data['nombre']
+        if 'activa' in data:
+            ventanilla.activa = data['activa']
+        if 'servicios' in data:
+            ventanilla.servicios = _servicios_por_nombre(data['servicios'])
+        
+        db.session.commit()
+        return jsonify(ventanilla.to_dict())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return error_interno(e)
 
 # ============ RUTAS DE TURNOS ============
 def generar_numero_turno():
@@ -143,20 +254,25 @@ def generar_numero_turno():
     
     return f"{prefijo}-{nuevo_numero:03d}"
 
-def generar_qr_code(data):
-    """Genera un código QR para el turno"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(data)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    img_io = io.BytesIO()
-    img.save(img_io, 'PNG')
-    img_io.seek(0)
+def parsear_fecha_cita(texto):
+    """``fecha_cita`` recibida como fecha y hora local.
     
-    # Convertir a base64
-    img_base64 = base64.b64encode(img_io.getvalue()).decode('utf-8')
-    return img_base64
+    Acepta ISO con hora (con zona o ``Z``: se pasa a la hora local) o solo
+    la fecha, que queda a las 9:00. Devuelve ``(fecha_cita, con_hora)``.
+    """
+    if 'T' in texto:
+        return horarios.hora_local(datetime.fromisoformat(texto.replace('Z', '+00:00'))), True
+    # Solo fecha, agregar hora por defecto (9:00 AM)
+    return datetime.combine(datetime.strptime(texto, '%Y-%m-%d').date(), horarios.HORA_SOLO_FECHA), False
+
+def token_qr(turno):
+    """Contenido del QR: token firmado con id, fecha y vencimiento del turno"""
+    return generar_token(
+        turno,
+        app.config['SECRET_KEY'],
+        sucursal_actual(),
+        timedelta(hours=app.config['QR_TOKEN_GRACIA_HORAS'])
+    )
 
 @app.route('/api/turnos', methods=['POST'])
 def create_turno():
@@ -164,66 +280,99 @@ def create_turno():
         data = request.get_json()
         
         # Validar datos requeridos
-        required_fields = ['nombre_cliente', 'servicio', 'fecha_cita', 'tipo_registro']
+        required_fields = ['nombre_cliente', 'fecha_cita', 'tipo_registro']
         for field in required_fields:
             if field not in data:
                 return jsonify({'error': f'Campo requerido: {field}'}), 400
+        try:
+            servicio = buscar_servicio(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if servicio is None:
+            return jsonify({'error': 'Campo requerido: servicio'}), 400
         
         # Generar número de turno
         numero_turno = generar_numero_turno()
         
-        # Procesar fecha_cita - manejar diferentes formatos
-        fecha_cita_str = data['fecha_cita']
         try:
-            # Intentar parsing directo primero
-            if 'T' in fecha_cita_str:
-                # Formato ISO con tiempo
-                fecha_cita = datetime.fromisoformat(fecha_cita_str.replace('Z', ''))
-            else:
-                # Solo fecha, agregar hora por defecto
-                fecha_date = datetime.strptime(fecha_cita_str, '%Y-%m-%d')
-                # Agregar hora por defecto (9:00 AM)
-                fecha_cita = fecha_date.replace(hour=9, minute=0)
-        except:
+            fecha_cita, con_hora = parsear_fecha_cita(data['fecha_cita'])
+        except (TypeError, ValueError):
             return jsonify({'error': 'Formato de fecha inválido'}), 400
         
+        # Reservar el horario en la misma transacción que el alta del turno;
+        # sin hora, sin cita (fecha_cita es la llegada) o a una hora fuera
+        # de la grilla no se reserva nada
+        slot_id = None
+        if con_hora and not data.get('sin_cita'):
+            try:
+                slot_id = horarios.reservar(db.session.connection(), Configuracion.query.first(), fecha_cita)
+            except horarios.HorarioCompleto as e:
+                return jsonify({'error': str(e)}), 409
+        
         # Crear turno
         turno = Turno(
             numero_turno=numero_turno,
             nombre_cliente=data['nombre_cliente'],
             telefono=data.get('telefono', ''),
-            servicio=data['servicio'],
+            servicio_id=servicio.id,
+            servicio=servicio.nombre,
             fecha_cita=fecha_cita,
+            slot_id=slot_id,
             tipo_registro=TipoRegistro(data['tipo_registro']),
+            prioridad=PrioridadTurno(data.get('prioridad', PrioridadTurno.NORMAL.value)),
             observaciones=data.get('observaciones', '')
         )
         
-        # Generar QR si es necesario
-        if turno.tipo_registro == TipoRegistro.QR:
-            qr_data = {
-                'numero_turno': numero_turno,
-                'nombre': data['nombre_cliente'],
-                'servicio': data['servicio'],
-                'fecha_cita': fecha_cita.isoformat()
-            }
-            turno.qr_code = generar_qr_code(json.dumps(qr_data))
-        
         db.session.add(turno)
         db.session.commit()
         
-        # Agregar a la cola solo si es para hoy
-        if fecha_cita.date() == date.today():
-            posicion = Cola.query.filter_by(fecha=date.today()).count() + 1
-            cola_item = Cola(turno_id=turno.id, posicion=posicion, fecha=date.today())
+        # Agregar a la cola si es para hoy o para un día ya materializado
+        fecha_cola = fecha_cita.date()
+        if fecha_cola == date.today() or (
+            fecha_cola > date.today() and db.session.get(ColaMaterializada, fecha_cola)
+        ):
+            cola_item = Cola(
+                turno_id=turno.id,
+                posicion=cola_diaria.posicion(turno, app.config['COLA_POLITICA_SIN_CITA']),
+                fecha=fecha_cola,
+                servicio_id=turno.servicio_id,
+                estado=turno.estado,
+                prioridad=ORDEN_PRIORIDAD[turno.prioridad]
+            )
             db.session.add(cola_item)
             db.session.commit()
         
         return jsonify(turno.to_dict()), 201
     except Exception as e:
-        print(f"Error creating turno: {str(e)}")  # Para debug
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+def cambiar_estado(turno, nuevo_estado):
+    """Cambia el estado del turno, marca los tiempos y sincroniza la cola.
+    
+    Cancelar libera el horario reservado; reactivar el turno lo reserva de
+    nuevo (``horarios.HorarioCompleto`` si ya no hay lugar).
+    """
+    if turno.slot_id and turno.estado != nuevo_estado:
+        if nuevo_estado == EstadoTurno.CANCELADO:
+            horarios.liberar(db.session.connection(), turno.slot_id)
+        elif turno.estado == EstadoTurno.CANCELADO:
+            # Solo vuelve a reservar quien tenía horario (no los turnos sin cita)
+            turno.slot_id = horarios.reservar(
+                db.session.connection(), Configuracion.query.first(), turno.fecha_cita
+            )
+    
+    turno.estado = nuevo_estado
+    
+    if nuevo_estado == EstadoTurno.LLAMADO:
+        turno.tiempo_llamado = datetime.utcnow()
+    elif nuevo_estado == EstadoTurno.ATENDIDO:
+        turno.tiempo_atencion = datetime.utcnow()
+    
+    for item in turno.cola_info:
+        item.estado = nuevo_estado
 
 @app.route('/api/turnos', methods=['GET'])
+@solo_lectura
 def get_turnos():
     try:
         fecha = request.args.get('fecha')
@@ -241,7 +390,41 @@ def get_turnos():
         turnos = query.order_by(Turno.fecha_creacion).all()
         return jsonify([turno.to_dict() for turno in turnos])
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+MAX_RESULTADOS_BUSQUEDA = 50
+
+@app.route('/api/turnos/buscar', methods=['GET'])
+def buscar_turnos():
+    """Busca turnos por nombre, teléfono o número, sin importar acentos.
+    
+    Cada palabra de ``q`` se busca como prefijo; resultados por relevancia,
+    paginados con ``pagina`` y ``por_pagina``.
+    """
+    try:
+        q = request.args.get('q', '').strip()
+        if not q:
+            return jsonify({'error': 'Parámetro requerido: q'}), 400
+        pagina = max(request.args.get('pagina', 1, type=int), 1)
+        por_pagina = min(max(request.args.get('por_pagina', 20, type=int), 1), MAX_RESULTADOS_BUSQUEDA)
+        
+        # Uno de más para saber si hay otra página sin contar todo
+        ids = busqueda.buscar_ids(
+            db.session.connection(), q, por_pagina + 1, (pagina - 1) * por_pagina
+        )
+        hay_mas = len(ids) > por_pagina
+        ids = ids[:por_pagina]
+        
+        por_id = {turno.id: turno for turno in Turno.query.filter(Turno.id.in_(ids)).all()} if ids else {}
+        return jsonify({
+            'q': q,
+            'pagina': pagina,
+            'por_pagina': por_pagina,
+            'hay_mas': hay_mas,
+            'resultados': [por_id[turno_id].to_dict() for turno_id in ids if turno_id in por_id]
+        })
+    except Exception as e:
+        return error_interno(e)
 
 @app.route('/api/turnos/<int:turno_id>', methods=['PUT'])
 def update_turno(turno_id):
@@ -250,90 +433,354 @@ def update_turno(turno_id):
         turno = Turno.query.get_or_404(turno_id)
         
         if 'estado' in data:
-            nuevo_estado = EstadoTurno(data['estado'])
-            turno.estado = nuevo_estado
-            
-            if nuevo_estado == EstadoTurno.LLAMADO:
-                turno.tiempo_llamado = datetime.utcnow()
-            elif nuevo_estado == EstadoTurno.ATENDIDO:
-                turno.tiempo_atencion = datetime.utcnow()
+            cambiar_estado(turno, EstadoTurno(data['estado']))
+            if turno.estado == EstadoTurno.LLAMADO:
+                notificar_llamado(turno)
         
         if 'observaciones' in data:
             turno.observaciones = data['observaciones']
         
         db.session.commit()
         return jsonify(turno.to_dict())
+    except horarios.HorarioCompleto as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return error_interno(e)
+
+CAMPOS_FILTRO_MASIVO = {'fecha', 'estado', 'servicio_id', 'servicio'}
+
+@app.route('/api/turnos', methods=['PATCH'])
+def update_turnos_masivo():
+    """Cambia de estado muchos turnos con UPDATEs por conjunto.
+    
+    Recibe ``ids`` o un ``filtro`` (fecha, estado, servicio_id) y el ``estado``
+    destino; solo devuelve conteos.
+    """
+    try:
+        data = request.get_json()
+        if 'estado' not in data:
+            return jsonify({'error': 'Campo requerido: estado'}), 400
+        nuevo_estado = EstadoTurno(data['estado'])
+        
+        seleccion = Turno.query.filter(Turno.estado != nuevo_estado)
+        if data.get('ids'):
+            seleccion = seleccion.filter(Turno.id.in_(data['ids']))
+        elif data.get('filtro'):
+            filtro = data['filtro']
+            if not isinstance(filtro, dict):
+                return jsonify({'error': 'El filtro debe ser un objeto'}), 400
+            # Una clave mal escrita no puede terminar actualizando toda la tabla
+            desconocidos = set(filtro) - CAMPOS_FILTRO_MASIVO
+            if desconocidos:
+                return jsonify({'error': f"Filtro desconocido: {', '.join(sorted(desconocidos))}"}), 400
+            criterios = 0
+            if filtro.get('fecha'):
+                fecha_obj = datetime.strptime(filtro['fecha'], '%Y-%m-%d').date()
+                seleccion = seleccion.filter(db.func.date(Turno.fecha_cita) == fecha_obj)
+                criterios += 1
+            if filtro.get('estado'):
+                seleccion = seleccion.filter(Turno.estado == EstadoTurno(filtro['estado']))
+                criterios += 1
+            servicio = buscar_servicio(filtro)
+            if servicio:
+                seleccion = seleccion.filter(Turno.servicio_id == servicio.id)
+                criterios += 1
+            if not criterios:
+                return jsonify({'error': 'El filtro necesita fecha, estado o servicio'}), 400
+        else:
+            return jsonify({'error': 'Indique ids o filtro'}), 400
+        
+        por_estado = dict(
+            seleccion.with_entities(Turno.estado, db.func.count(Turno.id))
+            .group_by(Turno.estado).all()
+        )
+        fechas_afectadas = [
+            fecha_cita.date() for (fecha_cita,) in
+            seleccion.with_entities(Turno.fecha_cita).distinct().all()
+        ]
+        
+        # Mismos tiempos que cambiar_estado
+        valores = {Turno.estado: nuevo_estado}
+        ahora = datetime.utcnow()
+        if nuevo_estado == EstadoTurno.LLAMADO:
+            valores[Turno.tiempo_llamado] = ahora
+        elif nuevo_estado == EstadoTurno.ATENDIDO:
+            valores[Turno.tiempo_atencion] = ahora
+        
+        conn = db.session.connection()
+        if nuevo_estado == EstadoTurno.CANCELADO:
+            # Liberar los horarios reservados (reactivar en masa no los vuelve a reservar)
+            reservas = (
+                seleccion.filter(Turno.slot_id.isnot(None))
+                .with_entities(Turno.slot_id, db.func.count(Turno.id))
+                .group_by(Turno.slot_id).all()
+            )
+            for slot_id, cantidad in reservas:
+                horarios.liberar(conn, slot_id, cantidad)
+        else:
+            # Reactivados en masa: su horario ya liberado deja de ser suyo
+            seleccion.filter(
+                Turno.estado == EstadoTurno.CANCELADO, Turno.slot_id.isnot(None)
+            ).update({Turno.slot_id: None}, synchronize_session=False)
+        
+        # La cola primero: después del UPDATE de turnos la selección ya no coincide
+        cola_afectada = Cola.query.filter(Cola.turno_id.in_(seleccion.with_entities(Turno.id)))
+        cambios.registrar_seleccion(conn, 'cola', cola_afectada.with_entities(Cola.id))
+        cambios.registrar_seleccion(conn, 'turno', seleccion.with_entities(Turno.id))
+        cola_afectada.update({Cola.estado: nuevo_estado}, synchronize_session=False)
+        actualizados = seleccion.update(valores, synchronize_session=False)
+        # Los UPDATE directos no pasan por el ORM: recalcular esos días
+        estadisticas.recalcular(conn, fechas_afectadas)
+        db.session.commit()
+        
+        if actualizados:
+            cola_memoria.cargar(date.today())
+        
+        return jsonify({
+            'actualizados': actualizados,
+            'estado': nuevo_estado.value,
+            'por_estado_anterior': {estado.value: total for estado, total in por_estado.items()}
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 # ============ RUTAS DE COLA ============
+@app.before_request
+def materializar_cola_del_dia():
+    """La primera petición de cola o tablero del día vuelca las citas de hoy a la cola"""
+    if request.path.startswith(('/api/cola', '/api/tablero')):
+        cola_diaria.asegurar(date.today())
+
 @app.route('/api/cola', methods=['GET'])
 def get_cola():
     try:
         fecha = request.args.get('fecha', date.today().isoformat())
         fecha_obj = datetime.strptime(fecha, '%Y-%m-%d').date()
         
-        cola_items = Cola.query.filter_by(fecha=fecha_obj).order_by(Cola.posicion).all()
+        cola_items = Cola.query.filter_by(fecha=fecha_obj).order_by(Cola.prioridad, Cola.posicion).all()
         return jsonify([item.to_dict() for item in cola_items])
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+MAX_REINTENTOS_LLAMADO = 5
+
+def servicios_de_ventanilla(ventanilla_id):
+    """Ids de los servicios que atiende la ventanilla (None = todos)"""
+    if ventanilla_id is None:
+        return None
+    ventanilla = Ventanilla.query.get_or_404(ventanilla_id)
+    # Una ventanilla sin servicios asignados atiende todos
+    return [servicio.id for servicio in ventanilla.servicios] or None
+
+def consulta_despacho(servicios=None):
+    """Filas de cola pendientes de hoy, en orden de atención.
+    
+    Usa el índice (fecha, servicio_id, estado, prioridad, posicion) de la cola.
+    """
+    query = Cola.query.filter(
+        Cola.fecha == date.today(),
+        Cola.estado == EstadoTurno.PENDIENTE
+    )
+    if servicios:
+        query = query.filter(Cola.servicio_id.in_(servicios))
+    return query.order_by(Cola.prioridad, Cola.posicion)
+
+def siguiente_en_cola(servicios=None):
+    """``(cola_id, turno_id)`` del próximo turno pendiente de hoy, o None.
+    
+    Se lee del espejo en memoria; si está vacío se confirma contra la base,
+    porque otro worker pudo agregar turnos que este aún no conoce.
+    """
+    siguiente = cola_memoria.siguiente(date.today(), servicios)
+    if siguiente is None and consulta_despacho(servicios).first() is not None:
+        cola_memoria.reconciliar(date.today())
+        siguiente = cola_memoria.siguiente(date.today(), servicios)
+    return siguiente
+
+def mensaje_voz(turno, ventanilla=None):
+    """Texto que se lee en voz alta al llamar un turno"""
+    if ventanilla:
+        return f"Turno {turno.numero_turno}, {turno.nombre_cliente}, acérquese a {ventanilla.nombre}"
+    return f"Turno {turno.numero_turno}, {turno.nombre_cliente}, acérquese por favor"
+
+def notificar_llamado(turno, ventanilla=None):
+    """Encola el mensaje al cliente llamado y el aviso al que quedó a
+    ``NOTIFICACIONES_AVISO_LUGARES`` lugares en la fila de su servicio"""
+    lugar = ventanilla.nombre if ventanilla else 'la ventanilla'
+    avisos = [(turno, notificaciones.TURNO, f"Es su turno {turno.numero_turno}: acérquese a {lugar}")]
+    
+    lugares = app.config['NOTIFICACIONES_AVISO_LUGARES']
+    if lugares > 0:
+        en_espera = consulta_despacho([turno.servicio_id]).offset(lugares - 1).first()
+        if en_espera and en_espera.turno:
+            avisos.append((en_espera.turno, notificaciones.AVISO, (
+                f"Su turno {en_espera.turno.numero_turno} está en el lugar {lugares} "
+                f"de la fila, acérquese a la sala de espera"
+            )))
+    notificaciones.encolar(db.session, avisos)
 
 @app.route('/api/cola/siguiente', methods=['GET'])
 def get_siguiente_turno():
     try:
-        siguiente = Cola.query.join(Turno).filter(
-            Cola.fecha == date.today(),
-            Turno.estado == EstadoTurno.PENDIENTE
-        ).order_by(Cola.posicion).first()
+        servicios = servicios_de_ventanilla(request.args.get('ventanilla_id', type=int))
         
-        if not siguiente:
-            return jsonify({'message': 'No hay turnos pendientes'}), 404
+        for _ in range(MAX_REINTENTOS_LLAMADO):
+            candidato = siguiente_en_cola(servicios)
+            if not candidato:
+                break
+            
+            siguiente = db.session.get(Cola, candidato[0])
+            if siguiente and siguiente.estado == EstadoTurno.PENDIENTE:
+                return jsonify(siguiente.to_dict())
+            
+            # Cambiado por otro worker: sacarlo del espejo y seguir
+            cola_memoria.quitar(candidato[0])
         
-        return jsonify(siguiente.to_dict())
+        return jsonify({'message': 'No hay turnos pendientes'}), 404
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/cola/llamar/<int:turno_id>', methods=['POST'])
 def llamar_turno(turno_id):
     try:
         turno = Turno.query.get_or_404(turno_id)
-        turno.estado = EstadoTurno.LLAMADO
-        turno.tiempo_llamado = datetime.utcnow()
+        cambiar_estado(turno, EstadoTurno.LLAMADO)
+        notificar_llamado(turno)
         db.session.commit()
         
         # Retornar datos para síntesis de voz
         return jsonify({
             'turno': turno.to_dict(),
-            'mensaje_voz': f"Turno {turno.numero_turno}, {turno.nombre_cliente}, acérquese por favor"
+            'mensaje_voz': mensaje_voz(turno)
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+@app.route('/api/cola/llamar-siguiente', methods=['POST'])
+def llamar_siguiente_turno():
+    """Selecciona y llama el primer turno pendiente en una sola transacción.
+    
+    El cambio de estado es un UPDATE condicionado a que la fila de la cola
+    siga PENDIENTE: si otra ventanilla la tomó primero no se afecta ninguna
+    fila y se reintenta con el siguiente. Con ``ventanilla_id`` solo se
+    consideran los servicios de esa ventanilla.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        ventanilla_id = data.get('ventanilla_id')
+        ventanilla = Ventanilla.query.get_or_404(ventanilla_id) if ventanilla_id is not None else None
+        servicios = servicios_de_ventanilla(ventanilla_id)
+        
+        for _ in range(MAX_REINTENTOS_LLAMADO):
+            siguiente = siguiente_en_cola(servicios)
+            
+            if not siguiente:
+                db.session.rollback()
+                return jsonify({'message': 'No hay turnos pendientes'}), 404
+            
+            cola_id, turno_id = siguiente
+            antes = estadisticas.instantanea(db.session.get(Turno, turno_id))
+            ahora = datetime.utcnow()
+            reclamados = Cola.query.filter(
+                Cola.id == cola_id,
+                Cola.estado == EstadoTurno.PENDIENTE
+            ).update({
+                Cola.estado: EstadoTurno.LLAMADO,
+                Cola.ventanilla_id: ventanilla_id
+            }, synchronize_session=False)
+            
+            if reclamados == 1:
+                actualizados = Turno.query.filter(
+                    Turno.id == turno_id,
+                    Turno.estado == EstadoTurno.PENDIENTE
+                ).update({
+                    Turno.estado: EstadoTurno.LLAMADO,
+                    Turno.tiempo_llamado: ahora
+                }, synchronize_session=False)
+                
+                if actualizados == 1:
+                    despues = dict(antes, estado=EstadoTurno.LLAMADO, tiempo_llamado=ahora)
+                    conn = db.session.connection()
+                    estadisticas.aplicar_delta(conn, antes, despues)
+                    cambios.registrar(conn, 'cola', [cola_id])
+                    cambios.registrar(conn, 'turno', [turno_id])
+                    registrar_baja(db.session, cola_id)
+                    notificar_llamado(db.session.get(Turno, turno_id), ventanilla)
+                    db.session.commit()
+                    turno = db.session.get(Turno, turno_id)
+                    return jsonify({
+                        'turno': turno.to_dict(),
+                        'ventanilla': ventanilla.nombre if ventanilla else None,
+                        'mensaje_voz': mensaje_voz(turno, ventanilla)
+                    })
+                
+                # La copia del estado en la cola quedó desfasada: corregirla
+                db.session.rollback()
+                turno = db.session.get(Turno, turno_id)
+                Cola.query.filter(Cola.id == cola_id).update(
+                    {Cola.estado: turno.estado}, synchronize_session=False
+                )
+                cambios.registrar(db.session.connection(), 'cola', [cola_id])
+                db.session.commit()
+                cola_memoria.quitar(cola_id)
+                continue
+            
+            # Otra ventanilla ganó la carrera: descartar y probar el siguiente
+            db.session.rollback()
+            cola_memoria.quitar(cola_id)
+        
+        return jsonify({'error': 'Cola con mucha concurrencia, intente nuevamente'}), 409
+    except Exception as e:
+        return error_interno(e)
 
 # ============ RUTAS DE QR ============
+# Tokens validados recientemente, para absorber ráfagas de escaneos en la puerta
+tokens_validados = CacheTTL(ttl=30)
+
 @app.route('/api/qr/validate', methods=['POST'])
 def validate_qr():
+    """Valida un QR. Los tokens firmados se verifican sin tocar la base;
+    los datos completos del turno solo se buscan si se pide ``detalle``.
+    """
     try:
         data = request.get_json()
-        qr_data = json.loads(data['qr_data'])
+        qr_data = data['qr_data'].strip()
         
-        turno = Turno.query.filter_by(numero_turno=qr_data['numero_turno']).first()
+        # QR antiguos: JSON con el número de turno
+        if qr_data.startswith('{'):
+            numero_turno = json.loads(qr_data)['numero_turno']
+            turno = Turno.query.filter_by(numero_turno=numero_turno).first()
+            if not turno:
+                return jsonify({'error': 'Turno no encontrado'}), 404
+            return jsonify({'valid': True, 'turno_id': turno.id, 'turno': turno.to_dict()})
         
-        if not turno:
-            return jsonify({'error': 'Turno no encontrado'}), 404
+        clave_cache = (sucursal_actual(), qr_data)
+        resultado = tokens_validados.get(clave_cache)
+        if resultado is None:
+            try:
+                resultado = verificar_token(qr_data, app.config['SECRET_KEY'], sucursal_actual())
+            except TokenInvalido as e:
+                return jsonify({'valid': False, 'error': str(e)}), 400
+            tokens_validados.set(clave_cache, resultado)
         
-        return jsonify({
-            'valid': True,
-            'turno': turno.to_dict()
-        })
+        respuesta = {'valid': True, **resultado}
+        if data.get('detalle'):
+            turno = db.session.get(Turno, resultado['turno_id'])
+            if not turno:
+                return jsonify({'error': 'Turno no encontrado'}), 404
+            respuesta['turno'] = turno.to_dict()
+        
+        return jsonify(respuesta)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/qr/historial', methods=['GET'])
 def get_qr_historial():
     try:
-        # Obtener turnos que tienen QR generado
+        # Obtener turnos registrados por QR
         turnos_qr = Turno.query.filter(
-            Turno.qr_code.isnot(None),
             Turno.tipo_registro == TipoRegistro.QR
         ).order_by(Turno.fecha_creacion.desc()).limit(20).all()
         
@@ -343,85 +790,107 @@ def get_qr_historial():
                 'id': turno.id,
                 'numero_turno': turno.numero_turno,
                 'nombre_cliente': turno.nombre_cliente,
-                'servicio': turno.servicio,
+                'servicio': turno.nombre_servicio,
+                'servicio_id': turno.servicio_id,
                 'fecha_cita': turno.fecha_cita.isoformat() if turno.fecha_cita else None,
                 'fecha_creacion': turno.fecha_creacion.isoformat() if turno.fecha_creacion else None,
                 'estado': turno.estado.value if turno.estado else None,
-                'qr_data': turno.qr_code
+                'qr_url': turno.qr_url
             })
         
         return jsonify(historial)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/qr/generate', methods=['POST'])
 def generate_qr():
     try:
         data = request.get_json()
+        try:
+            servicio = buscar_servicio(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if servicio is None:
+            return jsonify({'error': 'Campo requerido: servicio'}), 400
+        
+        try:
+            fecha_cita, con_hora = parsear_fecha_cita(data['fecha_cita'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Formato de fecha inválido'}), 400
+        slot_id = None
+        if con_hora:
+            try:
+                slot_id = horarios.reservar(db.session.connection(), Configuracion.query.first(), fecha_cita)
+            except horarios.HorarioCompleto as e:
+                return jsonify({'error': str(e)}), 409
         
         # Crear nuevo turno con QR
         nuevo_turno = Turno(
             numero_turno=data.get('numero_turno'),
             nombre_cliente=data.get('nombre_cliente'),
             telefono=data.get('telefono', ''),
-            servicio=data.get('servicio'),
-            fecha_cita=datetime.fromisoformat(data['fecha_cita'].replace('Z', '+00:00')),
+            servicio_id=servicio.id,
+            servicio=servicio.nombre,
+            fecha_cita=fecha_cita,
+            slot_id=slot_id,
             tipo_registro=TipoRegistro.QR,
             observaciones=data.get('observaciones', '')
         )
         
-        # Generar datos para el QR
-        qr_data = {
-            'numero_turno': nuevo_turno.numero_turno,
-            'nombre_cliente': nuevo_turno.nombre_cliente,
-            'servicio': nuevo_turno.servicio,
-            'fecha_cita': nuevo_turno.fecha_cita.isoformat(),
-        }
-        
-        nuevo_turno.qr_code = generar_qr_code(json.dumps(qr_data))
-        
         db.session.add(nuevo_turno)
         db.session.commit()
         
         return jsonify({
             'success': True,
             'turno': nuevo_turno.to_dict(),
-            'qr_data': nuevo_turno.qr_code
+            # La imagen se genera al pedirla; acepta ?formato=svg&tamano=termica
+            'qr_url': nuevo_turno.qr_url
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+def respuesta_qr(turno, descarga=False):
+    """Imagen del QR en bytes con su mimetype.
+    
+    ``formato`` (png, svg) y ``tamano`` (pantalla, termica, email) llegan
+    por query string.
+    """
+    formato = request.args.get('formato', 'png')
+    tamano = request.args.get('tamano', TAMANO_PREDETERMINADO)
+    try:
+        contenido, mimetype = imagen_qr(token_qr(turno), formato, tamano)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    respuesta = send_file(
+        io.BytesIO(contenido),
+        mimetype=mimetype,
+        as_attachment=descarga,
+        download_name=f'qr_{turno.numero_turno}.{extension(formato)}'
+    )
+    # El token no cambia mientras el turno no cambie de fecha
+    respuesta.headers['Cache-Control'] = 'private, max-age=300'
+    return respuesta
+
+@app.route('/api/qr/<int:turno_id>/imagen', methods=['GET'])
+def get_qr_imagen(turno_id):
+    try:
+        turno = db.session.get(Turno, turno_id)
+        if not turno or turno.tipo_registro != TipoRegistro.QR:
+            return jsonify({'error': 'QR no encontrado'}), 404
+        return respuesta_qr(turno)
+    except Exception as e:
+        return error_interno(e)
 
 @app.route('/api/qr/<qr_id>/download', methods=['GET'])
 def download_qr(qr_id):
     try:
         turno = Turno.query.filter_by(id=qr_id).first()
-        if not turno or not turno.qr_code:
+        if not turno or turno.tipo_registro != TipoRegistro.QR:
             return jsonify({'error': 'QR no encontrado'}), 404
-        
-        # Generar imagen QR para descarga
-        import io
-        import base64
-        from PIL import Image
-        
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(turno.qr_code)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convertir a base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-        
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=f'qr_{turno.numero_turno}.png',
-            mimetype='image/png'
-        )
+        return respuesta_qr(turno, descarga=True)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/turno/<int:turno_id>', methods=['GET'])
 def get_turno(turno_id):
@@ -429,77 +898,154 @@ def get_turno(turno_id):
         turno = Turno.query.get_or_404(turno_id)
         return jsonify(turno.to_dict())
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 # ============ RUTAS DE CALENDARIO ============
 @app.route('/api/calendario/disponibilidad', methods=['GET'])
 def get_disponibilidad():
+    """Horarios del día con su disponibilidad, leídos de la tabla ``slots``"""
     try:
         fecha = request.args.get('fecha')
         if not fecha:
             return jsonify({'error': 'Fecha requerida'}), 400
         
-        fecha_obj = datetime.strptime(fecha, '%Y-%m-%d')
-        config = Configuracion.query.first()
+        dia = datetime.strptime(fecha, '%Y-%m-%d').date()
+        desde = datetime.combine(dia, datetime.min.time())
+        consulta = Slot.query.filter(
+            Slot.inicio >= desde, Slot.inicio < desde + timedelta(days=1)
+        ).order_by(Slot.inicio)
         
-        # Obtener turnos existentes para la fecha
-        turnos_existentes = Turno.query.filter(
-            db.func.date(Turno.fecha_cita) == fecha_obj.date(),
-            Turno.estado != EstadoTurno.CANCELADO
-        ).all()
-        
-        # Generar horarios disponibles
-        horarios = []
-        hora_inicio = datetime.combine(fecha_obj.date(), config.horario_inicio)
-        hora_fin = datetime.combine(fecha_obj.date(), config.horario_fin)
-        
-        current = hora_inicio
-        while current < hora_fin:
-            # Verificar si el horario está ocupado
-            ocupado = any(
-                turno.fecha_cita.replace(second=0, microsecond=0) == current
-                for turno in turnos_existentes
-            )
-            
-            horarios.append({
-                'hora': current.strftime('%H:%M'),
-                'disponible': not ocupado
-            })
-            
-            current += timedelta(minutes=config.intervalo_citas)
+        slots = consulta.all()
+        # Primer pedido de un día que todavía no se generó
+        if not slots and horarios.generar_dia(db.session.connection(), Configuracion.query.first(), dia):
+            db.session.commit()
+            slots = consulta.all()
         
         return jsonify({
             'fecha': fecha,
-            'horarios': horarios
+            'horarios': [slot.to_dict() for slot in slots]
         })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 # ============ RUTAS DE ESTADÍSTICAS ============
+def _resumen_estadisticas(filas):
+    """Convierte sumas de la tabla de acumulados en la respuesta de la API"""
+    (total, pendientes, llamados, atendidos, cancelados, qr, manual,
+     espera_segundos, esperas, atencion_segundos, atenciones) = [valor or 0 for valor in filas]
+    return {
+        'total_turnos': total,
+        'pendientes': pendientes,
+        'llamados': llamados,
+        'atendidos': atendidos,
+        'cancelados': cancelados,
+        'qr': qr,
+        'manual': manual,
+        'espera_promedio_min': round(espera_segundos / esperas / 60, 1) if esperas else None,
+        'atencion_promedio_min': round(atencion_segundos / atenciones / 60, 1) if atenciones else None
+    }
+
+def _sumas_estadisticas():
+    return [db.func.sum(getattr(EstadisticaDiaria, campo)) for campo in estadisticas.CONTADORES]
+
 @app.route('/api/estadisticas', methods=['GET'])
+@solo_lectura
 def get_estadisticas():
     try:
         fecha = request.args.get('fecha', date.today().isoformat())
         fecha_obj = datetime.strptime(fecha, '%Y-%m-%d').date()
         
-        turnos_dia = Turno.query.filter(
-            db.func.date(Turno.fecha_cita) == fecha_obj
-        )
+        # Lectura de la tabla de acumulados: O(servicios x horas), no O(turnos)
+        sumas = db.session.query(*_sumas_estadisticas()).filter(
+            EstadisticaDiaria.fecha == fecha_obj
+        ).one()
         
-        stats = {
-            'total_turnos': turnos_dia.count(),
-            'pendientes': turnos_dia.filter(Turno.estado == EstadoTurno.PENDIENTE).count(),
-            'llamados': turnos_dia.filter(Turno.estado == EstadoTurno.LLAMADO).count(),
-            'atendidos': turnos_dia.filter(Turno.estado == EstadoTurno.ATENDIDO).count(),
-            'cancelados': turnos_dia.filter(Turno.estado == EstadoTurno.CANCELADO).count()
+        return jsonify(_resumen_estadisticas(sumas))
+    except Exception as e:
+        return error_interno(e)
+
+@app.route('/api/estadisticas/historico', methods=['GET'])
+@solo_lectura(max_retraso=300)
+def get_estadisticas_historico():
+    """Reporte por rango de fechas agrupado por día, hora o servicio"""
+    try:
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta', date.today().isoformat())
+        servicio = buscar_servicio(request.args)
+        agrupar = request.args.get('agrupar', 'fecha')
+        if not desde:
+            return jsonify({'error': 'Fecha requerida: desde'}), 400
+        
+        columnas = {
+            'fecha': EstadisticaDiaria.fecha,
+            'hora': EstadisticaDiaria.hora,
+            'servicio': EstadisticaDiaria.servicio_id
         }
+        if agrupar not in columnas:
+            return jsonify({'error': 'agrupar debe ser fecha, hora o servicio'}), 400
+        columna = columnas[agrupar]
+        
+        query = db.session.query(columna, *_sumas_estadisticas()).filter(
+            EstadisticaDiaria.fecha >= datetime.strptime(desde, '%Y-%m-%d').date(),
+            EstadisticaDiaria.fecha <= datetime.strptime(hasta, '%Y-%m-%d').date()
+        )
+        if servicio:
+            query = query.filter(EstadisticaDiaria.servicio_id == servicio.id)
         
-        return jsonify(stats)
+        filas = query.group_by(columna).order_by(columna).all()
+        
+        def clave(valor):
+            if agrupar == 'fecha':
+                return {'fecha': valor.isoformat()}
+            if agrupar == 'servicio':
+                return {'servicio_id': valor, 'servicio': nombres.get(valor)}
+            return {agrupar: valor}
+        
+        nombres = {}
+        if agrupar == 'servicio':
+            nombres = dict(db.session.query(Servicio.id, Servicio.nombre).filter(
+                Servicio.id.in_([fila[0] for fila in filas])
+            ).all())
+        
+        return jsonify({
+            'desde': desde,
+            'hasta': hasta,
+            'agrupar': agrupar,
+            'servicio': servicio.nombre if servicio else None,
+            'filas': [{**clave(fila[0]), **_resumen_estadisticas(fila[1:])} for fila in filas]
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+# ============ RUTAS DE ANALÍTICA ============
+@app.route('/api/analitica/heatmap', methods=['GET'])
+@solo_lectura(max_retraso=300)
+def get_heatmap():
+    """Mapas día de semana x hora de llegadas, esperas y ausencias"""
+    try:
+        hasta = request.args.get('hasta', date.today().isoformat())
+        hasta_obj = datetime.strptime(hasta, '%Y-%m-%d').date()
+        desde = request.args.get('desde')
+        desde_obj = datetime.strptime(desde, '%Y-%m-%d').date() if desde else hasta_obj - timedelta(days=90)
+        if desde_obj > hasta_obj:
+            return jsonify({'error': 'desde debe ser anterior a hasta'}), 400
+        
+        servicio = buscar_servicio(request.args)
+        resultado = calcular_heatmap(
+            conexion_lectura(), desde_obj, hasta_obj, servicio.id if servicio else None
+        )
+        resultado['servicio'] = servicio.nombre if servicio else None
+        return jsonify(resultado)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return error_interno(e)
 
 # ============ RUTAS DE CITAS ============
 @app.route('/api/citas/<fecha>', methods=['GET'])
+@solo_lectura
 def get_citas_por_fecha(fecha):
     try:
         fecha_obj = datetime.strptime(fecha, '%Y-%m-%d').date()
@@ -513,21 +1059,176 @@ def get_citas_por_fecha(fecha):
             'numero': cita.numero_turno,
             'nombre_cliente': cita.nombre_cliente,
             'telefono': cita.telefono,
-            'servicio_nombre': cita.servicio,
+            'servicio_nombre': cita.nombre_servicio,
+            'servicio_id': cita.servicio_id,
             'fecha_cita': cita.fecha_cita.isoformat(),
             'estado': cita.estado.value,
             'observaciones': cita.observaciones
         } for cita in citas])
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
 
 @app.route('/api/cita/<int:cita_id>/cancelar', methods=['POST'])
 def cancelar_cita(cita_id):
     try:
         cita = Turno.query.get_or_404(cita_id)
-        cita.estado = EstadoTurno.CANCELADO
+        cambiar_estado(cita, EstadoTurno.CANCELADO)
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Cita cancelada correctamente'})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_interno(e)
+
+# ============ RUTAS DE SINCRONIZACIÓN ============
+MAX_CAMBIOS_SYNC = 5000
+
+@app.route('/api/sync', methods=['GET'])
+@solo_lectura
+def sync():
+    """Cambios de turnos y cola desde la versión ``since``.
+    
+    Sin ``since`` devuelve solo la versión actual, para empezar después de
+    una carga completa. 204 si no hubo cambios; 410 si la versión ya se podó
+    del registro y hay que recargar todo.
+    """
+    try:
+        version = cambios.version_actual(db.session)
+        if 'since' not in request.args:
+            return jsonify({'version': version})
+        
+        since = request.args.get('since', type=int)
+        limite = min(request.args.get('limite', 500, type=int), MAX_CAMBIOS_SYNC)
+        if since is None or since < 0 or limite < 1:
+            return jsonify({'error': 'since y limite deben ser enteros positivos'}), 400
+        if since >= version:
+            return '', 204
+        
+        primera = db.session.query(db.func.min(Cambio.id)).scalar()
+        if since < primera - 1:
+            return jsonify({'error': 'Versión demasiado antigua, recargue todo', 'version': version}), 410
+        
+        registros = Cambio.query.filter(Cambio.id > since).order_by(Cambio.id).limit(limite + 1).all()
+        hay_mas = len(registros) > limite
+        registros = registros[:limite]
+        
+        ids = {'turno': set(), 'cola': set()}
+        for registro in registros:
+            ids[registro.entidad].add(registro.entidad_id)
+        
+        turnos = Turno.query.filter(Turno.id.in_(ids['turno'])).all() if ids['turno'] else []
+        cola_items = Cola.query.filter(Cola.id.in_(ids['cola'])).all() if ids['cola'] else []
+        
+        return jsonify({
+            'version': registros[-1].id,
+            'hay_mas': hay_mas,
+            'turnos': [turno.to_dict() for turno in turnos],
+            'cola': [item.to_dict() for item in cola_items],
+            'eliminados': {
+                'turnos': sorted(ids['turno'] - {turno.id for turno in turnos}),
+                'cola': sorted(ids['cola'] - {item.id for item in cola_items})
+            }
+        })
+    except Exception as e:
+        return error_interno(e)
+
+# ============ RUTAS DE TABLERO ============
+# Una sola construcción por intervalo para todas las pantallas de la sala
+cache_tablero = CacheTablero(ttl=app.config['TABLERO_TTL_SEGUNDOS'])
+cambios.al_confirmar(cache_tablero.invalidar)
+
+LLAMADOS_TABLERO = 5
+MAX_SIGUIENTES_TABLERO = 20
+
+def armar_tablero(cantidad):
+    """Todo lo que muestra una TV de sala de espera, como JSON compacto"""
+    hoy = date.today()
+    config = Configuracion.query.first()
+    logo = variantes_logo(config.logo_url).get('kiosk', {}) if config else {}
+    
+    llamados = Cola.query.join(Turno, Cola.turno_id == Turno.id).outerjoin(
+        Servicio, Cola.servicio_id == Servicio.id
+    ).outerjoin(
+        Ventanilla, Cola.ventanilla_id == Ventanilla.id
+    ).filter(
+        Cola.fecha == hoy,
+        Cola.estado == EstadoTurno.LLAMADO
+    ).order_by(Turno.tiempo_llamado.desc()).limit(LLAMADOS_TABLERO).with_entities(
+        Turno.numero_turno, Servicio.nombre, Ventanilla.nombre, Turno.tiempo_llamado
+    ).all()
+    
+    siguientes = consulta_despacho().join(Turno, Cola.turno_id == Turno.id).outerjoin(
+        Servicio, Cola.servicio_id == Servicio.id
+    ).limit(cantidad).with_entities(
+        Turno.numero_turno, Servicio.nombre, Turno.prioridad
+    ).all()
+    
+    conteos = _resumen_estadisticas(db.session.query(*_sumas_estadisticas()).filter(
+        EstadisticaDiaria.fecha == hoy
+    ).one())
+    
+    tablero = {
+        'empresa': config.nombre_empresa if config else None,
+        'logo': logo.get('webp') or logo.get('png') or (config.logo_url if config else None),
+        'llamados': [
+            {'numero': numero, 'servicio': servicio, 'ventanilla': ventanilla,
+             # tiempo_llamado se guarda en UTC; la sala ve la hora local
+             'hora': horarios.hora_local(llamado.replace(tzinfo=timezone.utc)).strftime('%H:%M') if llamado else None}
+            for numero, servicio, ventanilla, llamado in llamados
+        ],
+        'siguientes': [
+            {'numero': numero, 'servicio': servicio,
+             'prioridad': prioridad.value if prioridad else PrioridadTurno.NORMAL.value}
+            for numero, servicio, prioridad in siguientes
+        ],
+        'conteos': {
+            'pendientes': conteos['pendientes'],
+            'llamados': conteos['llamados'],
+            'atendidos': conteos['atendidos'],
+            'total': conteos['total_turnos'],
+            'espera_promedio_min': conteos['espera_promedio_min']
+        }
+    }
+    return json.dumps(tablero, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+@app.route('/api/tablero', methods=['GET'])
+def get_tablero():
+    """Instantánea del tablero (empresa, llamados, próximos y conteos del día).
+    
+    ``n`` es la cantidad de próximos turnos (máximo 20). Responde 304 si el
+    ETag no cambió.
+    """
+    try:
+        cantidad = min(max(request.args.get('n', 5, type=int), 1), MAX_SIGUIENTES_TABLERO)
+        entrada = cache_tablero.obtener(sucursal_actual(), cantidad, lambda: armar_tablero(cantidad))
+        
+        respuesta = Response(entrada.cuerpo, mimetype='application/json')
+        respuesta.set_etag(entrada.etag)
+        respuesta.headers['Cache-Control'] = 'no-cache'
+        return respuesta.make_conditional(request)
+    except Exception as e:
+        return error_interno(e)
+
+# ============ RUTAS DE ADMINISTRACIÓN ============
+@app.route('/api/admin/perfiles', methods=['GET'])
+def get_perfiles():
+    """Peticiones perfiladas, de la más lenta a la más rápida"""
+    try:
+        if not token_valido(app.config, request.headers.get('X-Perfil-Token')):
+            return jsonify({'error': 'No autorizado'}), 403
+        limite = request.args.get('limite', 20, type=int)
+        return jsonify(listar_perfiles(app.config['PERFIL_DIR'], limite))
+    except Exception as e:
+        return error_interno(e)
+
+@app.route('/api/admin/perfiles/<nombre>', methods=['GET'])
+def download_perfil(nombre):
+    """Descarga un perfil (.prof para pstats/snakeviz, .folded para flamegraph)"""
+    try:
+        if not token_valido(app.config, request.headers.get('X-Perfil-Token')):
+            return jsonify({'error': 'No autorizado'}), 403
+        ruta = os.path.join(app.config['PERFIL_DIR'], nombre)
+        if not NOMBRE_PERFIL.match(nombre) or not os.path.exists(ruta):
+            return jsonify({'error': 'Perfil no encontrado'}), 404
+        return send_file(os.path.abspath(ruta), as_attachment=True, download_name=nombre)
+    except Exception as e:
+        return error_interno(e)
@@ -2,12 +2,15 @@
 function getApiBaseUrl() {
     const hostname = window.location.hostname;
     const port = '8080';
+    // Sucursal indicada en la ruta (/s/<codigo>/)
+    const sucursal = window.location.pathname.match(/^\/s\/[a-z0-9_-]+/);
+    const prefijo = sucursal ? sucursal[0] : '';
     
     if (hostname === 'localhost' || hostname === '127.0.0.1') {
-        return `http://127.0.0.1:${port}/api`;
+        return `http://127.0.0.1:${port}${prefijo}/api`;
     } else {
         // Para acceso desde red local, usar la IP actual del servidor
-        return `http://${hostname}:${port}/api`;
+        return `http://${hostname}:${port}${prefijo}/api`;
     }
 }
 
@@ -182,11 +185,20 @@ function updateSidebarInfo() {
         document.getElementById('sidebarTitle').textContent = currentConfig.nombre_empresa;
         const logoImg = document.getElementById('sidebarLogo');
         if (currentConfig.logo_url) {
-            logoImg.src = currentConfig.logo_url;
+            logoImg.src = getLogoUrl(currentConfig, 'header');
         }
     }
 }
 
+// Devuelve la variante más liviana disponible del logo (WebP > PNG > original)
+function getLogoUrl(config, variante) {
+    const variantes = (config.logo_variantes || {})[variante];
+    if (variantes) {
+        return variantes.webp || variantes.png || config.logo_url;
+    }
+    return config.logo_url;
+}
+
 // Dashboard Functions
 async function loadDashboard() {
     try {
@@ -337,16 +349,24 @@ function displayQueue(queue) {
 
 async function callNextTurn() {
     try {
-        const result = await apiRequest('/cola/siguiente');
-        if (result && result.turno) {
-            // Llamar el turno
-            await callTurn(result.turno.id);
-        } else {
+        // Selección y llamado en una sola petición atómica
+        const response = await fetch(`${API_BASE_URL}/cola/llamar-siguiente`, { method: 'POST' });
+        if (response.status === 404) {
             showNotification('No hay turnos pendientes para llamar', 'warning');
+            return;
+        }
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.error || `HTTP error! status: ${response.status}`);
         }
+        const mensaje = result.mensaje_voz || `Turno ${result.turno.numero_turno}, ${result.turno.nombre_cliente}, acérquese por favor`;
+        speakText(mensaje);
+        showNotification(`Llamando turno ${result.turno.numero_turno}`, 'success');
+        loadQueue();
+        loadStatistics();
     } catch (error) {
         console.error('Error calling next turn:', error);
-        showNotification('No hay turnos pendientes para llamar', 'warning');
+        showNotification('Error al llamar el siguiente turno', 'error');
     }
 }
 
@@ -891,16 +911,13 @@ async function showQRCode(turnoId) {
     try {
         const turno = await apiRequest(`/turno/${turnoId}`);
         
-        // Generar imagen QR en base64 desde los datos
-        const qrData = JSON.parse(turno.qr_code);
-        
         const modal = document.createElement('div');
         modal.className = 'modal';
         modal.innerHTML = `
             <div class="modal-content">
                 <h3>Código QR - ${turno.numero_turno}</h3>
                 <div class="qr-display">
-                    <canvas id="qrCanvas" style="max-width: 300px; border: 1px solid #ccc;"></canvas>
+                    <img src="${turno.qr_url}" alt="Código QR ${turno.numero_turno}" style="max-width: 300px; border: 1px solid #ccc;">
                 </div>
                 <div class="qr-details">
                     <p><strong>Cliente:</strong> ${turno.nombre_cliente}</p>
@@ -917,39 +934,12 @@ async function showQRCode(turnoId) {
         
         document.body.appendChild(modal);
         
-        // Generar QR en canvas
-        generateQRCanvas(turno.qr_code, 'qrCanvas');
-        
     } catch (error) {
         console.error('Error showing QR code:', error);
         showNotification('Error al mostrar código QR', 'error');
     }
 }
 
-function generateQRCanvas(data, canvasId) {
-    // Simple QR representation - for production use a proper QR library
-    const canvas = document.getElementById(canvasId);
-    const ctx = canvas.getContext('2d');
-    canvas.width = 200;
-    canvas.height = 200;
-    
-    // Fill background
-    ctx.fillStyle = 'white';
-    ctx.fillRect(0, 0, 200, 200);
-    
-    // Simple pattern representation
-    ctx.fillStyle = 'black';
-    ctx.font = '12px Arial';
-    ctx.fillText('QR Code Data:', 10, 30);
-    ctx.font = '8px monospace';
-    
-    // Display data in a readable way
-    const lines = data.substring(0, 300).match(/.{1,25}/g) || [];
-    lines.forEach((line, index) => {
-        ctx.fillText(line, 10, 50 + (index * 10));
-    });
-}
-
 function downloadQR(qrId) {
     const link = document.createElement('a');
     link.href = `${API_BASE_URL}/qr/${qrId}/download`;
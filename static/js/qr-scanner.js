@@ -147,7 +147,7 @@ async function handleQRResult(qrData) {
         // Validate QR code with server
         const response = await apiRequest('/qr/validate', {
             method: 'POST',
-            body: JSON.stringify({ qr_data: qrData })
+            body: JSON.stringify({ qr_data: qrData, detalle: true })
         });
         
         if (response.valid) {
@@ -242,7 +242,12 @@ function processManualQR(event) {
     const formData = new FormData(event.target);
     const qrData = formData.get('qrData');
     
-    // Try to parse as JSON first, if not treat as turn number
+    // Token firmado (payload.firma) o JSON antiguo; si no, número de turno
+    if (/^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$/.test(qrData.trim())) {
+        handleQRResult(qrData.trim());
+        closeModal();
+        return;
+    }
     try {
         JSON.parse(qrData);
         handleQRResult(qrData);
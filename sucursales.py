@@ -0,0 +1,99 @@
+import os
+import re
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+
+PREFIJO_RUTA = re.compile(r'^/s/([a-z0-9_-]+)(/.*)?$')
+CLAVE_ENTORNO = 'turnos.sucursal'
+
+
+def bind_sucursal(codigo):
+    return f'sucursal_{codigo}'
+
+
+def configurar_sucursales(app):
+    """Registra una base de datos (bind) por cada sucursal de ``SUCURSALES``.
+
+    Cada sucursal usa ``DATABASE_URL_<CODIGO>`` o, si no está definida, su
+    propio archivo SQLite ``turnos_<codigo>.db``.
+    """
+    codigos = [c.strip().lower() for c in os.getenv('SUCURSALES', '').split(',') if c.strip()]
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for codigo in codigos:
+        binds[bind_sucursal(codigo)] = os.getenv(
+            f'DATABASE_URL_{codigo.upper()}', f'sqlite:///turnos_{codigo}.db'
+        )
+    app.config['SUCURSALES'] = codigos
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['SUCURSALES_POR_SUBDOMINIO'] = os.getenv('SUCURSALES_POR_SUBDOMINIO', 'False') == 'True'
+
+
+class SucursalMiddleware:
+    """Identifica la sucursal por prefijo de ruta (``/s/<codigo>/...``) o subdominio.
+
+    El prefijo se quita de ``PATH_INFO`` y se agrega a ``SCRIPT_NAME``, así
+    las rutas existentes no cambian y ``url_for`` genera URLs de la sucursal.
+    """
+
+    def __init__(self, wsgi_app, sucursales, por_subdominio=False):
+        self.wsgi_app = wsgi_app
+        self.sucursales = set(sucursales)
+        self.por_subdominio = por_subdominio
+
+    def __call__(self, environ, start_response):
+        ruta = environ.get('PATH_INFO', '')
+        coincidencia = PREFIJO_RUTA.match(ruta)
+        if coincidencia:
+            codigo = coincidencia.group(1)
+            if codigo not in self.sucursales:
+                start_response('404 NOT FOUND', [('Content-Type', 'application/json')])
+                return [b'{"error": "Sucursal no encontrada"}']
+            environ[CLAVE_ENTORNO] = codigo
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f'/s/{codigo}'
+            environ['PATH_INFO'] = coincidencia.group(2) or '/'
+        elif self.por_subdominio:
+            host = environ.get('HTTP_HOST', '').split(':')[0]
+            codigo = host.split('.')[0].lower()
+            if codigo in self.sucursales:
+                environ[CLAVE_ENTORNO] = codigo
+        return self.wsgi_app(environ, start_response)
+
+
+def sucursal_actual():
+    """Código de la sucursal de la petición en curso (None = base principal)"""
+    if has_app_context():
+        return g.get('sucursal')
+    return None
+
+
+@contextmanager
+def en_sucursal(codigo):
+    """Ejecuta el bloque contra la base de una sucursal (CLI, tareas de fondo)"""
+    anterior = g.get('sucursal')
+    g.sucursal = codigo
+    try:
+        yield
+    finally:
+        g.sucursal = anterior
+
+
+class SesionSucursal(Session):
+    """Sesión que envía cada consulta a la base de la sucursal actual.
+
+    En rutas de solo lectura (``replicas.solo_lectura``) los SELECT van a la
+    réplica; cualquier otra sentencia vuelve a la principal hasta el final
+    de la petición.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('bind_lectura'):
+            if clause is not None and getattr(clause, 'is_select', False):
+                return self._db.engines[g.bind_lectura]
+            g.bind_lectura = None
+        if bind is None:
+            codigo = sucursal_actual()
+            if codigo is not None:
+                return self._db.engines[bind_sucursal(codigo)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
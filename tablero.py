@@ -0,0 +1,68 @@
+import hashlib
+import threading
+import time
+
+
+class EntradaTablero:
+    __slots__ = ('cuerpo', 'etag', 'vence', 'generacion')
+
+    def __init__(self, cuerpo, vence, generacion):
+        self.cuerpo = cuerpo
+        self.etag = hashlib.sha1(cuerpo).hexdigest()[:16]
+        self.vence = vence
+        self.generacion = generacion
+
+
+class CacheTablero:
+    """Micro-cache con coalescencia de peticiones para el tablero de las TVs.
+
+    Cada clave se construye una sola vez por intervalo: si varias pantallas
+    piden a la vez, una arma la respuesta y las demás esperan ese resultado.
+    Un cambio de turnos o cola invalida la sucursal al confirmarse; entre
+    workers la diferencia dura como mucho ``ttl`` segundos.
+    """
+
+    def __init__(self, ttl=1.0, espera_maxima=5.0):
+        self.ttl = ttl
+        self.espera_maxima = espera_maxima
+        self._lock = threading.Lock()
+        self._entradas = {}     # clave -> EntradaTablero
+        self._en_curso = {}     # clave -> threading.Event
+        self._generacion = {}   # sucursal -> contador de invalidaciones
+
+    def invalidar(self, sucursal=None):
+        with self._lock:
+            self._generacion[sucursal] = self._generacion.get(sucursal, 0) + 1
+
+    def obtener(self, sucursal, clave, construir):
+        """Entrada vigente de ``(sucursal, clave)``; ``construir()`` devuelve bytes"""
+        clave = (sucursal, clave)
+        while True:
+            with self._lock:
+                generacion = self._generacion.get(sucursal, 0)
+                entrada = self._entradas.get(clave)
+                if entrada and entrada.generacion == generacion and time.monotonic() < entrada.vence:
+                    return entrada
+                evento = self._en_curso.get(clave)
+                constructor = evento is None
+                if constructor:
+                    evento = self._en_curso[clave] = threading.Event()
+
+            if not constructor:
+                # Se usa lo que armó la otra petición aunque ya la hayan invalidado
+                if evento.wait(self.espera_maxima):
+                    with self._lock:
+                        entrada = self._entradas.get(clave)
+                    if entrada is not None:
+                        return entrada
+                continue
+
+            try:
+                entrada = EntradaTablero(construir(), time.monotonic() + self.ttl, generacion)
+                with self._lock:
+                    self._entradas[clave] = entrada
+                return entrada
+            finally:
+                with self._lock:
+                    del self._en_curso[clave]
+                evento.set()
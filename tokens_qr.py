@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+# Versión (1 byte), turno_id (4), fecha en días desde 1970 (2), vencimiento unix (4)
+FORMATO_PAYLOAD = '>BIHI'
+VERSION_TOKEN = 1
+LARGO_FIRMA = 12
+EPOCA = date(1970, 1, 1)
+
+
+class TokenInvalido(Exception):
+    """El token de QR está mal formado, adulterado o vencido"""
+
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b'=').decode('ascii')
+
+
+def _desde_b64(texto):
+    return base64.urlsafe_b64decode(texto + '=' * (-len(texto) % 4))
+
+
+def _clave(secreto, sucursal=None):
+    # Una clave derivada por sucursal: un QR de una sucursal no vale en otra
+    return hmac.new(secreto.encode(), f'qr:{sucursal or ""}'.encode(), hashlib.sha256).digest()
+
+
+def _firmar(clave, payload):
+    return hmac.new(clave, payload, hashlib.sha256).digest()[:LARGO_FIRMA]
+
+
+def generar_token(turno, secreto, sucursal=None, gracia=timedelta(hours=0)):
+    """Token firmado y compacto (~30 caracteres) para el QR de un turno.
+
+    Vence al terminar el día de la cita más ``gracia``.
+    """
+    fecha = turno.fecha_cita.date()
+    vencimiento = datetime.combine(fecha + timedelta(days=1), datetime.min.time()) + gracia
+    payload = struct.pack(
+        FORMATO_PAYLOAD,
+        VERSION_TOKEN,
+        turno.id,
+        (fecha - EPOCA).days,
+        int(vencimiento.timestamp())
+    )
+    return f'{_b64(payload)}.{_b64(_firmar(_clave(secreto, sucursal), payload))}'
+
+
+def verificar_token(token, secreto, sucursal=None, ahora=None):
+    """Verifica firma y vencimiento sin consultar la base de datos"""
+    try:
+        payload_b64, firma_b64 = token.strip().split('.')
+        payload = _desde_b64(payload_b64)
+        firma = _desde_b64(firma_b64)
+        version, turno_id, dias, vencimiento = struct.unpack(FORMATO_PAYLOAD, payload)
+    except (ValueError, struct.error):
+        raise TokenInvalido('Código QR mal formado')
+
+    if version != VERSION_TOKEN:
+        raise TokenInvalido('Versión de código QR no soportada')
+    if not hmac.compare_digest(firma, _firmar(_clave(secreto, sucursal), payload)):
+        raise TokenInvalido('Firma del código QR inválida')
+    if (ahora or time.time()) > vencimiento:
+        raise TokenInvalido('Código QR vencido')
+
+    return {
+        'turno_id': turno_id,
+        'fecha': (EPOCA + timedelta(days=dias)).isoformat(),
+        'expira': datetime.fromtimestamp(vencimiento).isoformat()
+    }
+
+
+class CacheTTL:
+    """Cache LRU pequeña con vencimiento, segura entre hilos"""
+
+    def __init__(self, max_items=1024, ttl=30):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                return None
+            valor, vence = item
+            if time.monotonic() > vence:
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)